@@ -0,0 +1,352 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# bench_loopback.py
+# end to end packet rate between two routers in one process, connected over
+# loopback udp.  the tun/tap devices are socketpairs, so no root needed.
+#
+# python -m pylans.bench.bench_loopback --help
+
+import errno
+import optparse
+import os
+import socket
+import struct
+import sys
+import time
+from twisted.internet import reactor, defer, task
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implements
+
+from .. import settings
+from .. import util
+from ..router import TapRouter
+from ..tuntap.twisted import TwistedTTL
+from .bench_router import BenchNetwork, SIZES
+
+ETHERTYPE = '\x88\xb5'  # local experimental
+
+
+class LoopTunTap(TwistedTTL):
+    '''
+        TwistedTTL on one end of a unix datagram socketpair instead of
+        /dev/net/tun.  The other end (host) is the kernel side of the device:
+        frames sent on it are read by the router, frames the router writes
+        come out of it.
+    '''
+
+    def __init__(self, mac, ips, callback=None, burst_callback=None,
+                 burst_size=1):
+        self.callback = callback
+        self.burst_callback = burst_callback
+        self.burst_size = max(1, burst_size)
+
+        self._sock, self.host = socket.socketpair(socket.AF_UNIX,
+                                                  socket.SOCK_DGRAM)
+        if self.burst_size > 1:
+            self._sock.setblocking(False)
+        self._f = self._sock.fileno()
+
+        self.ifname = 'looptap'
+        self.mode = self.TAPMODE
+        self.mtu = 1500
+        self._mac = mac
+        self._ips = ips
+
+    def close(self):
+        self._sock.close()
+        self.host.close()
+
+    def up(self):
+        return defer.succeed(None)
+
+    def down(self):
+        return defer.succeed(None)
+
+    def configure_iface(self, **options):
+        return defer.succeed(None)
+
+    def set_mtu(self, mtu):
+        self.mtu = mtu
+        return defer.succeed(None)
+
+    def get_mtu(self):
+        return self.mtu
+
+    def get_mac(self):
+        return self._mac
+
+    def get_ips(self):
+        return self._ips
+
+
+class Sink(object):
+    '''Reads frames coming out of a LoopTunTap host socket'''
+    implements(IReadDescriptor)
+
+    def __init__(self, sock, callback):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.callback = callback
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def doRead(self):
+        recv = self.sock.recv
+        callback = self.callback
+        while True:
+            try:
+                data = recv(0x10000)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            callback(data)
+
+    def logPrefix(self):
+        return 'sink'
+
+    def connectionLost(self, reason):
+        reactor.removeReader(self)
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Run(object):
+    '''
+        Push count frames of size bytes from a to b, keeping at most window
+        frames in flight.  Frames still missing after a stall are counted as
+        lost and replaced, so a drop doesn't end the run.
+    '''
+    STALL = 0.5
+
+    def __init__(self, bench, size, count, window):
+        self.bench = bench
+        self.size = size
+        self.count = count
+        self.window = window
+
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.stamps = {}
+        self.latencies = []
+        self.d = defer.Deferred()
+
+        hdr = bench.mac_b + bench.mac_a + ETHERTYPE
+        self._hdr = hdr
+        self._pad = '\x00' * (size - len(hdr) - 4)
+
+    def start(self):
+        self.bench.sink.callback = self.got_frame
+        self._last = -1
+        self._watchdog = task.LoopingCall(self.check_stall)
+        self._watchdog.start(self.STALL, now=False)
+
+        self.t = time.time()
+        self.fill()
+        return self.d
+
+    def fill(self):
+        send = self.bench.tap_a.host.send
+        hdr, pad = self._hdr, self._pad
+        stamps = self.stamps
+        n = min(self.window - (self.sent - self.received - self.lost),
+                self.count - self.sent)
+        for i in xrange(n):
+            seq = self.sent
+            stamps[seq] = time.time()
+            send(hdr + struct.pack('!I', seq) + pad)
+            self.sent += 1
+
+    def got_frame(self, data):
+        if data[12:14] != ETHERTYPE:
+            return
+        seq = struct.unpack('!I', data[14:18])[0]
+        t = self.stamps.pop(seq, None)
+        if t is None:
+            return  # already counted lost
+        self.latencies.append(time.time() - t)
+        self.received += 1
+
+        if self.received + self.lost >= self.count:
+            self.finish()
+        else:
+            self.fill()
+
+    def check_stall(self):
+        if self.received != self._last:
+            self._last = self.received
+            return
+
+        # nothing came back since the last check, write off what's in flight
+        self.lost += len(self.stamps)
+        self.stamps.clear()
+        if self.received + self.lost >= self.count:
+            self.finish()
+        else:
+            self.fill()
+
+    def finish(self):
+        elapsed = time.time() - self.t
+        self._watchdog.stop()
+        self.bench.sink.callback = lambda data: None
+
+        pps = self.received / elapsed
+        # not from inside Sink.doRead, the next run (or stop) starts from here
+        reactor.callLater(0, self.d.callback, dict(
+            size=self.size,
+            pps=pps,
+            mbps=pps * self.size * 8 / 1e6,
+            p50=percentile(self.latencies, 50) * 1000,
+            p99=percentile(self.latencies, 99) * 1000,
+            lost=self.lost))
+
+
+class LoopbackBench(object):
+    '''two TapRouters talking to each other over 127.0.0.1'''
+
+    def __init__(self, suite='aes-ctr', burst=1, use_mmsg=False,
+                 workers=0):
+        # don't touch settings.ini
+        settings.new(None)
+        key = os.urandom(16)
+
+        self.mac_a = '\x02\x00\x00\x00\x00\x0a'
+        self.mac_b = '\x02\x00\x00\x00\x00\x0b'
+        self.net_a = self._network('bench-a', key, '10.1.1.1', suite, burst,
+                                   use_mmsg, workers)
+        self.net_b = self._network('bench-b', key, '10.1.1.2', suite, burst,
+                                   use_mmsg, workers)
+        self.tap_a = self._router(self.net_a, self.mac_a, burst)
+        self.tap_b = self._router(self.net_b, self.mac_b, burst)
+
+        self.sink = Sink(self.tap_b.host, lambda data: None)
+
+    def _network(self, name, key, ip, suite, burst, use_mmsg, workers):
+        net = BenchNetwork(name)
+        net.key = key
+        net.ip = ip
+        net.virtual_address = ip + '/24'
+        net.port = net.wan_port = free_port()
+        net.is_running = False
+        settings.set_option(name + '/' + 'cipher_suites', [suite])
+        settings.set_option(name + '/' + 'read_burst', burst)
+        settings.set_option(name + '/' + 'use_mmsg', use_mmsg)
+        settings.set_option(name + '/' + 'crypto_workers', workers)
+        return net
+
+    def _router(self, net, mac, burst):
+        tap = LoopTunTap(mac, [net.ip], burst_size=burst)
+        net.router = TapRouter(net, tap)
+        tap.callback = net.router.send_packet
+        tap.burst_callback = net.router.send_packets
+        return tap
+
+    @defer.inlineCallbacks
+    def start(self, timeout=30):
+        for net in (self.net_a, self.net_b):
+            yield net.router.start()
+            net.is_running = True
+        reactor.addReader(self.sink)
+
+        # handshake and wait for both sides to register each other
+        self.net_a.router.sm.try_greet(('127.0.0.1', self.net_b.port))
+        t = time.time()
+        while (self.mac_b not in self.net_a.router.addr_map
+               or self.mac_a not in self.net_b.router.addr_map):
+            if time.time() - t > timeout:
+                raise Exception('routers did not connect in time')
+            yield util.sleep(0.1)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        reactor.removeReader(self.sink)
+        for net in (self.net_a, self.net_b):
+            yield net.router.stop()
+        self.tap_a.close()
+        self.tap_b.close()
+
+    def run(self, size, count, window):
+        return Run(self, size, count, window).start()
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+failed = []
+
+@defer.inlineCallbacks
+def main(opts, sizes):
+    try:
+        bench = LoopbackBench(opts.suite, opts.burst, opts.mmsg, opts.workers)
+        yield bench.start()
+
+        # warm up (sessions, caches)
+        yield bench.run(SIZES[0], min(opts.count, 1000), opts.window)
+
+        for size in sizes:
+            r = yield bench.run(size, opts.count, opts.window)
+            print ('%(size)5dB: %(pps)8.0f pps %(mbps)8.1f Mbit/s'
+                   '   p50 %(p50)7.3f ms   p99 %(p99)7.3f ms   lost %(lost)d'
+                   % r)
+            if opts.min_pps is not None and r['pps'] < opts.min_pps:
+                print '%5dB: below --min-pps %d' % (size, opts.min_pps)
+                failed.append(size)
+
+        yield bench.stop()
+    except Exception, e:
+        print 'benchmark failed: %s' % e
+        failed.append(e)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type='int', default=20000,
+                      help='frames per size [%default]')
+    parser.add_option('-w', '--window', type='int', default=32,
+                      help='max frames in flight [%default]')
+    parser.add_option('-s', '--sizes', default=','.join(map(str, SIZES)),
+                      help='frame sizes [%default]')
+    parser.add_option('--suite', default='aes-ctr',
+                      help='cipher suite [%default]')
+    parser.add_option('--burst', type='int', default=1,
+                      help='tun/tap read_burst setting [%default]')
+    parser.add_option('--mmsg', action='store_true', default=False,
+                      help='use sendmmsg/recvmmsg')
+    parser.add_option('--workers', type='int', default=0,
+                      help='crypto_workers setting [%default]')
+    parser.add_option('--min-pps', type='int', default=None,
+                      help='exit with an error if any size is slower')
+    opts, args = parser.parse_args()
+
+    sizes = [int(x) for x in opts.sizes.split(',')]
+    reactor.callWhenRunning(main, opts, sizes)
+    reactor.run()
+    sys.exit(1 if failed else 0)
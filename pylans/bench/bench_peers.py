@@ -0,0 +1,74 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# bench_peers.py
+# size and encode/decode time of a peer list, pickle vs the binary format
+#
+# python -m pylans.bench.bench_peers [count]
+
+import cPickle as pickle
+import os
+import sys
+import time
+
+from .. import peers
+from ..peers import PeerInfo
+
+PEERS = (10, 100, 1000)
+
+
+def new_peer(i):
+    pi = PeerInfo()
+    pi.id = os.urandom(16)
+    pi.name = 'peer%d' % i
+    pi.vip = chr(10) + chr(1) + chr(i / 256) + chr(i % 256)
+    pi.addr = '\x02\x00\x00\x00' + chr(i / 256) + chr(i % 256)
+    pi.address = ('192.168.%d.%d' % (i / 256, i % 256), 8015)
+    pi.port = 8015
+    pi.direct_addresses = [pi.address, ('10.0.%d.%d' % (i / 256, i % 256),
+                                        8015)]
+    pi.is_direct = (i % 2 == 0)
+    pi.relays = 0 if pi.is_direct else 1
+    return pi
+
+
+def timeit(func, arg, count):
+    '''Returns seconds per call'''
+    t = time.time()
+    for i in xrange(count):
+        func(arg)
+    return (time.time() - t) / count
+
+
+def formats():
+    return [('pickle', lambda pl: pickle.dumps(pl, -1), pickle.loads),
+            ('binary', lambda pl: peers.dump_peer_list(pl.values()),
+             peers.load_peer_list)]
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    for n in PEERS:
+        peer_list = dict((p.id, p) for p in (new_peer(i) for i in range(n)))
+        # keep the total work about the same for each size
+        c = max(1, count * 100 / n)
+        for name, dump, load in formats():
+            data = dump(peer_list)
+            print '%4d peers %s: %7d bytes  encode %8.1f us  decode %8.1f us' % (
+                n, name, len(data),
+                timeit(dump, peer_list, c) * 1e6,
+                timeit(load, data, c) * 1e6)
@@ -0,0 +1,112 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# bench_router.py
+# time Router.send_packet for one peer, with a socket that drops everything
+#
+# python -m pylans.bench.bench_router [suite] [count]
+
+import os
+import sys
+import time
+
+from .. import settings
+from .. import tuntap
+from ..crypto import suites
+from ..router import TapRouter
+
+SIZES = (64, 512, 1400)
+
+
+class BenchNetwork(object):
+    '''just enough of a Network to build a Router'''
+    adapter_mode = 'TAP'
+    ip = '10.1.1.1'
+    port = 0
+    wan_port = 0
+
+    def __init__(self, name):
+        self.name = name
+        self.username = name
+        self.id = os.urandom(16)
+        self.key = os.urandom(16)
+        self.known_addresses = {}
+
+
+class NullTunTap(object):
+    '''tun/tap stand in, drops what gets written to it'''
+    is_tap = True
+    is_broadcast = staticmethod(tuntap.TunTapBase.is_broadcast)
+
+    def doWrite(self, packet):
+        pass
+
+
+class NullTransport(object):
+    '''udp transport stand in, drops what gets written to it'''
+
+    def write(self, data, address):
+        pass
+
+
+class Harness(object):
+    def setup(self, suite='aes-ctr'):
+        # don't touch settings.ini
+        settings.new(None)
+
+        self.net = BenchNetwork('bench')
+        self.router = TapRouter(self.net, NullTunTap())
+        self.router.sm.proto.transport = NullTransport()
+
+        # fake an open session to one peer
+        sm = self.router.sm
+        suite = suites.get(suite)
+        self.sid = os.urandom(16)
+        sm.shaking[self.sid] = [None, 0, ('127.0.0.1', 9)]
+        sm.suites[self.sid] = suite.id
+        sm.open(self.sid, os.urandom(suite.cls.key_size))
+
+        self.mac = '\x02\x00\x00\x00\x00\x01'
+        self.router.map_addr(self.mac, ('127.0.0.1', 9), self.sid)
+
+    def frame(self, size):
+        return self.mac + self.router.pm._self.addr + os.urandom(size - 12)
+
+    def send_packet(self, size, count):
+        '''Returns packets per second'''
+        send_packet = self.router.send_packet
+        packet = self.frame(size)
+
+        t = time.time()
+        for i in xrange(count):
+            send_packet(packet)
+        return count / (time.time() - t)
+
+
+h = Harness()
+
+if __name__ == '__main__':
+    suite = sys.argv[1] if len(sys.argv) > 1 else 'aes-ctr'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    h.setup(suite)
+    for zero_copy in (True, False):
+        h.router.sm.zero_copy = zero_copy
+        for size in SIZES:
+            pps = h.send_packet(size, count)
+            print '%s send_packet %4dB (%s): %8.0f pps, %7.1f Mbit/s' % (
+                suite, size, 'zero copy' if zero_copy else 'join',
+                pps, pps * size * 8 / 1e6)
@@ -200,9 +200,38 @@ class Prompt(Cmd):
                 print '# of peers:  {0}'.format(len(net.router.pm))
                 print 'my vip       {0}'.format(net.router.pm._self.vip_str)
                 print 'my addr      {0}'.format(net.router.pm._self.addr_str)
+                self._print_stats(net)
             else:
                 print 'network offline'
   
+    def _print_stats(self, net):
+        stats = self.iface.get_network_stats(net)
+        print 'packets in:  {0} ({1} bytes)'.format(stats['packets_in'],
+                                                    stats['bytes_in'])
+        print 'packets out: {0} ({1} bytes)'.format(stats['packets_out'],
+                                                    stats['bytes_out'])
+        print 'crypto time: {0:.3f}s encrypt, {1:.3f}s decrypt'.format(
+                                stats['encrypt_time'], stats['decrypt_time'])
+        print 'relayed:     {0} ({1} bytes)'.format(stats['relays'],
+                                                    stats['relay_bytes'])
+        print 'dropped:     {0}'.format(', '.join('{0} {1}'.format(v, k)
+                                for k, v in sorted(stats['drops'].items())))
+        an = stats['announces']
+        print 'announces:   {0} sent in {1} packets, {2} suppressed'.format(
+                                an['sent'], an['packets'], an['suppressed'])
+        hs = stats.get('handshakes')
+        if hs is not None:
+            print ('handshakes:  {0} running, {1} waiting, {2} started, '
+                   '{3} rejected, {4} cookies sent').format(
+                                hs['shaking'], hs['waiting'], hs['admitted'],
+                                hs['rejected'], hs['cookies_sent'])
+        for sid, ps in stats['peers'].items():
+            peer = self.iface.get_peer_info(sid, net)
+            name = peer.name if peer is not None else sid.encode('hex')
+            print '  {0:15} in {1} ({2} bytes), out {3} ({4} bytes)'.format(
+                    name, ps['packets_in'], ps['bytes_in'],
+                    ps['packets_out'], ps['bytes_out'])
+
     def complete_status(self, text, line, begidx, endidx):
         nets = self.iface.get_network_names()
         if not text:
@@ -28,6 +28,9 @@ import hmac
 import os
 import logging
 
+from .replay import CounterWindow
+
+
 logger = logging.getLogger(__name__)
 
 # encryption classes
@@ -51,6 +54,9 @@ except ImportError:
 
 
 
+class AuthenticationError(Exception): pass
+
+
 ## PyCrypto's CTR mode requires a custom counter
 class _Counter(object):
     def __init__(self, n=0, maxn=0xEFFFFFFFFFFFFFFF, salt=None, iv=None):
@@ -223,45 +229,193 @@ class AESCrypter3(object):
         return string[:-ord(string[-1])]
 
 
+def ctr_process(key, jobs):
+    '''Process a list of (string, r, iv) with aes-ctr, each starting r bytes
+    into counter block iv.  A job that starts where the last one ended keeps
+    using its context, so a burst in order costs one AES setup.  Stateless,
+    so it can run in a worker thread.'''
+    out = []
+    e = after = None
+    for string, r, iv in jobs:
+        if (r, iv) != after:
+            e = aes.AES(key, iv=iv)
+            if r & 0x7f:  # the top bit is the key phase
+                e.process('\x00'*(r & 0x7f))
+        out.append(e.process(string))
+
+        l = (r & 0x7f) + len(string)
+        after = (l % 16 | r & 0x80,
+                 unhexlify('%032x' % (int(hexlify(iv), 16) + l // 16)))
+    return out
+
+def ctr_encrypt(key, jobs):
+    '''Encrypt a list of (string, r, iv) jobs from _Crypter0.reserve'''
+    return [data + chr(r) + iv
+            for data, (string, r, iv) in zip(ctr_process(key, jobs), jobs)]
+
+def ctr_decrypt(key, strings, pos_sz=17):
+    '''Decrypt a list of strings produced by _Crypter0.encrypt/ctr_encrypt'''
+    return ctr_process(key, [(s[:-pos_sz], ord(s[-pos_sz]), s[-pos_sz+1:])
+                             for s in strings])
+
+
 # test pycryptopp, using one object for all encryptions.  need to keep track of count/position
 # faster encryption, slower decryption
 class _Crypter0(object):
-    '''aes 128 (pycryptopp) in ctr mode'''
+    '''aes 128 (pycryptopp) in ctr mode
+
+    The top bit of the offset byte in the trailer is the key phase.  While
+    rekeying, `other` is the crypter for the other phase, and packets
+    marked with it are decrypted by it.'''
     block_size = 16
     key_size = 16
-    def __init__(self, key, can_rollover=False, callback=None, args=None): #pycryptopp uses CTR mode
+    decrypt_cache_size = 4  # running decrypt contexts kept per session
+    # pycryptopp holds the GIL, so the crypto pipeline would only add
+    # overhead
+    releases_gil = False
+    replay_window = 1024  # packets
+    job_encrypt = staticmethod(ctr_encrypt)
+    job_decrypt = staticmethod(ctr_decrypt)
+    def __init__(self, key, can_rollover=False, callback=None, args=None,
+                 phase=0): #pycryptopp uses CTR mode
         assert len(key) == self.key_size, "Invalid key size"
-        self.key = key
+        self.key = self.job_key = key
         self.can_rollover = can_rollover
         self.callback = callback
         self.args = args or ()
+        self.phase_bit = phase << 7
+        self.other = None
         self.pos_q = 0
         self.max_q = int(hexlify('\xFF'*(self.block_size-2)), 16)
         self.pos_r = 0
         self.pos_sz = self.block_size + 1
         self.__fmt = '%%0.%dx'%(self.block_size*2)
         self.obj = aes.AES(self.key, iv='\x00'*self.block_size)
+        self._obj_stale = False
+        # expected next position (as packed in the trailer) -> CTR obj
+        self._dcache = {}
+        self.decrypt_seeks = 0
+        self.replay = CounterWindow(self.replay_window)
 
     def encrypt(self, string):
         # need to reset before 64-bit counter overflows
         if self.pos_q > self.max_q:
             self._reset()
 
+        # keystream was handed out by reserve(), move obj up to pos
+        if self._obj_stale:
+            self._seek()
+
         l = len(string)
-        iv = chr(self.pos_r) + unhexlify(self.__fmt%self.pos_q) #seems like fastest
+        iv = chr(self.pos_r | self.phase_bit) + unhexlify(self.__fmt%self.pos_q) #seems like fastest
 
         # keep track of pos
         self.pos_q += (self.pos_r + l) // self.block_size
         self.pos_r = (self.pos_r + l) % self.block_size
         return self.obj.process(string) + iv
 
+    def encrypt_into(self, string, buf, offset):
+        '''Encrypt string into buf (a bytearray) at offset, followed by the
+        iv.  Returns the end offset.  Skips building ciphertext + iv as a new
+        string.'''
+        if self.pos_q > self.max_q:
+            self._reset()
+
+        if self._obj_stale:
+            self._seek()
+
+        l = len(string)
+        iv = chr(self.pos_r | self.phase_bit) + unhexlify(self.__fmt%self.pos_q)
+
+        self.pos_q += (self.pos_r + l) // self.block_size
+        self.pos_r = (self.pos_r + l) % self.block_size
+
+        end = offset + l
+        buf[offset:end] = self.obj.process(string)
+        buf[end:end+self.pos_sz] = iv
+        return end + self.pos_sz
+
+    def _seek(self):
+        # move obj up to the current pos
+        self.obj = aes.AES(self.key, iv=unhexlify(self.__fmt%self.pos_q))
+        self.obj.process('\x00'*self.pos_r)
+        self._obj_stale = False
+
     def decrypt(self, string):
+        # in-order packets pick up where the last one left off, otherwise
         # create a CTR obj with the right iv, then process stream to starting spot
-        r, iv = ord(string[-self.pos_sz]), string[-self.pos_sz+1:]
+        # string can be a str or a buffer, the payload is not copied
+        pos_sz = self.pos_sz
+        pos = string[-pos_sz:]
+        r = ord(pos[0])
+        e = self._dcache.pop(pos, None)
+        if e is None:
+            if r & 0x80 != self.phase_bit and self.other is not None:
+                return self.other.decrypt(string)
+            e = aes.AES(self.key, iv=pos[1:])
+            e.process('\x00'*(r & 0x7f))
+            self.decrypt_seeks += 1
+
+        data = e.process(buffer(string, 0, len(string) - pos_sz))
+
+        # remember where the next packet should start
+        l = (r & 0x7f) + len(data)
+        q = int(hexlify(pos[1:]), 16) + l // self.block_size
+        cache = self._dcache
+        if len(cache) >= self.decrypt_cache_size:
+            cache.popitem()
+        cache[chr(l % self.block_size | r & 0x80)
+              + unhexlify(self.__fmt%q)] = e
+        return data
+
+    @property
+    def overhead(self):
+        '''bytes encrypt adds to a packet'''
+        return self.pos_sz
+
+    def _window(self, string):
+        '''The replay window for string's phase, and the keystream offset
+        its trailer says it starts at'''
+        pos = string[-self.pos_sz:]
+        r = ord(pos[0])
+        obj = self
+        if r & 0x80 != self.phase_bit and self.other is not None:
+            obj = self.other
+        return obj.replay, int(hexlify(pos[1:]), 16) * self.block_size \
+                           + (r & 0x7f)
+
+    def check(self, string):
+        '''False if string is a replay, or too old to tell.  Looks at the
+        trailer only, see CounterWindow.'''
+        window, offset = self._window(string)
+        return window.check(offset)
+
+    def mark(self, string):
+        '''Remember string's offset once it decrypted.  False if it turned
+        out to be a replay after all.'''
+        window, offset = self._window(string)
+        return window.mark(offset)
+
+    def reserve(self, strings):
+        '''Reserve keystream for a list of strings without encrypting them.
+        Returns a list of (string, r, iv) jobs for ctr_encrypt, so the cipher
+        work can be done off the reactor while positions stay in order.'''
+        jobs = []
+        fmt = self.__fmt
+        bs = self.block_size
+        pb = self.phase_bit
+        for string in strings:
+            if self.pos_q > self.max_q:
+                self._reset()
 
-        e = aes.AES(self.key, iv=iv)
-        e.process('\x00'*r)
-        return e.process(string[:-self.pos_sz])
+            l = len(string)
+            jobs.append((string, self.pos_r | pb, unhexlify(fmt%self.pos_q)))
+
+            self.pos_q += (self.pos_r + l) // bs
+            self.pos_r = (self.pos_r + l) % bs
+
+        self._obj_stale = True
+        return jobs
 
     def _reset(self):
         # re-salt & reset counter
@@ -276,7 +430,7 @@ class _Crypter0(object):
         else:
             # so we don't keep calling this function over and over
             self.max_q = self.max_q << 1
-            self.callback(self, *args)
+            self.callback(*self.args)
 
 class _Crypter1(_Crypter0):
     '''aes 256 (pycryptopp) in ctr mode'''
@@ -320,13 +474,27 @@ if __name__ == "__main__":
             if t2 - t1 > tmax:
                 break
         print "%d MB encrypted in %0.1f seconds: %0.1f MB/s" % (n/1024., t2-t1, n/(t2-t1)/1024. )
+        n = len(pd)
+        t1 = time()
+
+        # new CTR obj for every packet (no decrypt cache)
+        for blk in pd:
+            ctr_decrypt(e.key, [blk], e.pos_sz)
+        t2 = time()
+        print "%d MB decrypted (uncached) in %0.1f seconds: %0.1f MB/s" % (n/1024., t2-t1, n/(t2-t1)/1024. )
+        t1 = time()
+
+        # one pipeline job, in order packets share a CTR obj
+        ctr_decrypt(e.key, pd, e.pos_sz)
+        t2 = time()
+        print "%d MB decrypted (job) in %0.1f seconds: %0.1f MB/s" % (n/1024., t2-t1, n/(t2-t1)/1024. )
         t1 = time()
 
         dec = e.decrypt
         for blk in pd:
             dec(blk)
         #map(dec, pd) - slower
-        n = len(pd)
         t2 = time()
-        print "%d MB decrypted in %0.1f seconds: %0.1f MB/s" % (n/1024., t2-t1, n/(t2-t1)/1024. )
+        print "%d MB decrypted (cached) in %0.1f seconds: %0.1f MB/s" % (n/1024., t2-t1, n/(t2-t1)/1024. )
+        print "  %d seeks for %d packets" % (e.decrypt_seeks, n)
         print
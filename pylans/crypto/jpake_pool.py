@@ -0,0 +1,205 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# jpake_pool.py
+# run J-PAKE handshake math on a worker pool, with round one precomputed
+
+import binascii
+import collections
+import logging
+import os
+from twisted.internet import defer
+
+from . import jpake
+from .pipeline import CryptoPipeline
+
+logger = logging.getLogger(__name__)
+
+
+# Worker jobs.  They take and return the JPAKE object itself, so each round
+# hands the state on to the next.
+
+def _one(params, tag):
+    # round one doesn't use the password, a placeholder is swapped out later
+    j = jpake.JPAKE(1, params, binascii.hexlify(os.urandom(16)) + tag)
+    return j, j.pack_one(j.one())
+
+def _two(j, recv1):
+    return j, j.pack_two(j.two(j.unpack_one(recv1)))
+
+def _three(j, recv2):
+    return j, j.three(j.unpack_two(recv2))
+
+
+class JPAKEPool(object):
+    '''
+        Keeps up to `size` precomputed J-PAKE round one results (x1, x2, gx1,
+        gx2 and their proofs) ready, refilling them on the worker pool, and
+        runs rounds two and three there too.
+
+        Without workers (or before start) everything runs inline, like it
+        used to.  Pure python modular exponentiation holds the GIL, so
+        threads don't run it in parallel, but they do take it out of the
+        reactor's packet handlers and let round one be ready in advance.
+
+        tag is appended to our signer ids, the other side sees it in round
+        one (see Handshake.their_id).
+    '''
+
+    def __init__(self, workers=1, size=4, params=jpake.params_80, tag=''):
+        self.params = params
+        self.size = size
+        self.tag = tag
+        if workers > 0:
+            self.pipeline = CryptoPipeline(workers)
+        else:
+            self.pipeline = None
+        # (j, send1) ready to go
+        self.ready = collections.deque()
+        self.filling = 0
+        # handshakes started from a precomputed result, or not
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        if self.pipeline is not None:
+            self.pipeline.start()
+            self.fill()
+
+    def stop(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        self.filling = 0
+
+    @property
+    def running(self):
+        return self.pipeline is not None and self.pipeline.running
+
+    def run(self, key, func, args):
+        '''Deferred result of func(*args), on the pool if it's running'''
+        if not self.running:
+            return defer.maybeDeferred(func, *args)
+
+        d = defer.Deferred()
+        self.pipeline.submit(('jpake', key), func, args, d.callback,
+                             d.errback)
+        return d
+
+    def discard(self, key):
+        '''Drop pending jobs for key, their deferreds never fire'''
+        if self.pipeline is not None:
+            self.pipeline.discard(('jpake', key))
+
+    def fill(self):
+        '''Top the precomputed round one results back up to size'''
+        if not self.running:
+            return
+
+        while len(self.ready) + self.filling < self.size:
+            self.filling += 1
+            self.pipeline.submit(('jpake', None), _one,
+                                 (self.params, self.tag),
+                                 self._filled, self._fill_failed)
+
+    def _filled(self, result):
+        self.filling -= 1
+        self.ready.append(result)
+
+    def _fill_failed(self, e):
+        self.filling -= 1
+        logger.warning('jpake precompute failed: {0}', e)
+
+    def handshake(self, sid, password):
+        '''Start one side of a handshake with sid'''
+        return Handshake(self, sid, password)
+
+
+class Handshake(object):
+    '''
+        One side of a J-PAKE exchange.  Each round is queued behind the one
+        before it, so a handshake2 can be handled while our round two is
+        still on the pool.  Every round returns a Deferred with its output.
+    '''
+
+    def __init__(self, pool, sid, password):
+        self.pool = pool
+        self.sid = sid
+        # the JPAKE object, once round one is done
+        self.j = None
+        # set when their round one has been queued, before it's done
+        self.got_one = False
+        # their signer id, from their round one
+        self.their_id = None
+        self._error = None
+
+        if pool.ready:
+            pool.hits += 1
+            j, send1 = pool.ready.popleft()
+            d = defer.succeed((j, send1))
+        else:
+            pool.misses += 1
+            d = pool.run(sid, _one, (pool.params, pool.tag))
+        pool.fill()
+
+        # round one is the same for any password, so it's set afterwards
+        s = jpake.JPAKE(password, pool.params).s
+        def set_password((j, send1)):
+            j.s = s
+            return j, send1
+        d.addCallback(set_password)
+
+        self.send1 = self._step(d)
+        # fires (with None) each time the last queued round is done
+        self._last = d
+
+    def _step(self, d):
+        '''Record the JPAKE object coming out of the round d is running,
+        returns a Deferred with that round's output'''
+        result = defer.Deferred()
+        def done((j, out)):
+            self.j = j
+            result.callback(out)
+        def failed(f):
+            self._error = f
+            result.errback(f)
+        d.addCallbacks(done, failed)
+        return result
+
+    def _then(self, func, arg):
+        result = defer.Deferred()
+        def run(_):
+            if self._error is not None:
+                result.errback(self._error)
+                return
+            d = self._step(self.pool.run(self.sid, func, (self.j, arg)))
+            # hold later rounds until this one is delivered
+            return d.chainDeferred(result)
+        self._last.addCallback(run)
+        return result
+
+    def one(self):
+        '''Deferred with our round one packet'''
+        return self.send1
+
+    def two(self, recv1):
+        '''Deferred with our round two packet, for their round one'''
+        self.got_one = True
+        self.their_id = recv1[6 * self.pool.params.orderlen:]
+        return self._then(_two, recv1)
+
+    def three(self, recv2):
+        '''Deferred with the session key, for their round two'''
+        return self._then(_three, recv2)
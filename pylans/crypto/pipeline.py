@@ -0,0 +1,129 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# pipeline.py
+# run bulk encrypt/decrypt on a worker thread pool, off the reactor thread
+
+import collections
+import logging
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+def _call(func, args):
+    '''Run func in a worker.  Exceptions are returned, not raised, so a
+    failed job can't stall the queue it belongs to.'''
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, e
+
+
+class CryptoPipeline(object):
+    '''
+        Runs crypto jobs on a pool of worker threads.  Results are handed back
+        on the reactor thread in the order they were submitted for each queue
+        (session), even if the workers finish out of order.
+
+        Only worth it with backends that release the GIL while they work,
+        so sessions only use it if their crypter has releases_gil set (the
+        aead suites).  aes-ctr stays on the reactor thread.
+    '''
+    MAX_PENDING = 1024  # per queue, drop (like UDP would) past this
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.dropped = 0
+        self._pool = None
+        self._queues = {}
+
+    def start(self):
+        if self._pool is not None:
+            return
+
+        self._pool = ThreadPool(self.workers, self.workers, name='crypto')
+        self._pool.start()
+
+        logger.info('started crypto pool with {0} workers', self.workers)
+
+    def stop(self):
+        if self._pool is None:
+            return
+
+        self._pool.stop()
+        self._pool = None
+        self._queues.clear()
+
+        logger.info('stopped crypto pool')
+
+    @property
+    def running(self):
+        return self._pool is not None
+
+    def submit(self, key, func, args, callback, errback=None):
+        '''
+            Run func(*args) on the pool.  callback(result) is called on the
+            reactor thread once every job submitted earlier with the same key
+            has been delivered.  If func raises, errback(exception) is called
+            in its place, when given.
+        '''
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+        elif len(queue) >= self.MAX_PENDING:
+            self.dropped += 1
+            logger.trace('crypto queue full, dropping job')
+            return
+
+        # [done, ok, result, callback, errback]
+        slot = [False, False, None, callback, errback]
+        queue.append(slot)
+
+        def done((ok, result)):
+            slot[0:3] = True, ok, result
+            if self._queues.get(key) is queue:
+                self._deliver(key, queue)
+
+        self._pool.callInThreadWithCallback(
+            lambda ok, result: reactor.callFromThread(
+                done, result if ok else (False, result)),
+            _call, func, args)
+
+    def discard(self, key):
+        '''Forget pending jobs for key, their results are dropped'''
+        if key in self._queues:
+            del self._queues[key]
+
+    @property
+    def pending(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _deliver(self, key, queue):
+        while len(queue) > 0 and queue[0][0]:
+            done, ok, result, callback, errback = queue.popleft()
+            if not ok and errback is None:
+                logger.warning('crypto job failed: {0}', result)
+                continue
+            try:
+                (callback if ok else errback)(result)
+            except Exception, e:
+                logger.error('crypto pipeline callback raised exception:'
+                             + ' {0}', e, exc_info=True)
+
+        if len(queue) == 0 and self._queues.get(key) is queue:
+            del self._queues[key]
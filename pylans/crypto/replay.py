@@ -0,0 +1,175 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# replay.py
+# sliding window replay filters over packet positions, a packet is checked
+# against one before decrypting and marked in it once it authenticated (or
+# for ctr, which can't tell, once it decrypted)
+
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayWindow(object):
+    '''
+        Sliding window over packet positions, like IPsec's: the highest
+        position accepted, and a bitmap of which of the `size` below it
+        were.  Anything further back is too old to tell, and refused.
+
+        check() is cheap enough to run before decrypting, mark() is only for
+        packets that authenticated, so a forged position can't move the
+        window.
+    '''
+    __slots__ = ('size', 'top', 'bitmap', 'replayed', 'old', '_mask')
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.top = -1
+        self.bitmap = 0     # bit n set: top - n was accepted
+        self.replayed = 0   # seen before
+        self.old = 0        # behind the window
+        self._mask = (1 << size) - 1
+
+    def reset(self):
+        '''Start over, for positions that count from zero again'''
+        self.top = -1
+        self.bitmap = 0
+
+    def check(self, pos):
+        '''True if pos could be new, False to drop it'''
+        if pos > self.top:
+            return True
+        n = self.top - pos
+        if n >= self.size:
+            self.old += 1
+            return False
+        if self.bitmap >> n & 1:
+            self.replayed += 1
+            return False
+        return True
+
+    def mark(self, pos):
+        '''Accept pos, once its packet authenticated.  False if it was
+        accepted already (a replay that got past check()).'''
+        if not self.check(pos):
+            return False
+        n = pos - self.top
+        if n > 0:
+            self.bitmap = (self.bitmap << n | 1) & self._mask \
+                if n < self.size else 1
+            self.top = pos
+        else:
+            self.bitmap |= 1 << -n
+        return True
+
+
+class SaltedWindow(object):
+    '''
+        Replay window for aead nonces, salt + counter.  The sender picks a
+        new salt when its counter rolls over, so the first authenticated
+        packet with a new salt starts the window over, and salts left
+        behind are refused from then on.  Stragglers from the last salt
+        are lost at the switch, it's only once every 2^32 packets.
+    '''
+    __slots__ = ('window', 'salt', 'retired')
+
+    def __init__(self, size=1024):
+        self.window = ReplayWindow(size)
+        self.salt = None
+        self.retired = set()
+
+    @property
+    def replayed(self):
+        return self.window.replayed
+
+    @property
+    def old(self):
+        return self.window.old
+
+    def check(self, nonce):
+        salt = nonce[:-4]
+        if salt == self.salt:
+            return self.window.check(struct.unpack('>I', nonce[-4:])[0])
+        if salt in self.retired:
+            self.window.old += 1
+            return False
+        return True
+
+    def mark(self, nonce):
+        salt = nonce[:-4]
+        if salt != self.salt:
+            if salt in self.retired:
+                self.window.old += 1
+                return False
+            if self.salt is not None:
+                logger.debug('peer changed nonce salt, restarting window')
+                self.retired.add(self.salt)
+                self.window.reset()
+            self.salt = salt
+        return self.window.mark(struct.unpack('>I', nonce[-4:])[0])
+
+
+class CounterWindow(object):
+    '''
+        Replay window for ctr trailers, over the keystream offset each
+        packet starts at.  Packets aren't all one size, so instead of a
+        bitmap it keeps the offsets of the last `size` packets (up to twice
+        that between trims) and refuses anything at or below the highest
+        offset it let go of.
+
+        ctr has no mac, so forged offsets get marked like the rest.  They
+        can only take up room: the floor rises past offsets dropped for
+        being the lowest kept, never past ones still to come in order.  The
+        most a forger can do is take the exact offset of a packet that
+        hasn't arrived yet.
+    '''
+    __slots__ = ('size', 'top', 'floor', 'seen', 'replayed', 'old')
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.top = -1
+        self.floor = -1     # this and below are too old to tell
+        self.seen = set()
+        self.replayed = 0
+        self.old = 0
+
+    def check(self, pos):
+        '''True if pos could be new, False to drop it'''
+        if pos > self.top:
+            return True
+        if pos <= self.floor:
+            self.old += 1
+            return False
+        if pos in self.seen:
+            self.replayed += 1
+            return False
+        return True
+
+    def mark(self, pos):
+        '''Accept pos, once its packet decrypted.  False if it was accepted
+        already.'''
+        if not self.check(pos):
+            return False
+        self.seen.add(pos)
+        if pos > self.top:
+            self.top = pos
+        if len(self.seen) > 2 * self.size:
+            keep = sorted(self.seen)
+            self.floor = keep[-self.size - 1]
+            self.seen = set(keep[-self.size:])
+        return True
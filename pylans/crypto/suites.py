@@ -0,0 +1,287 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# suites.py
+# cipher suite registry, suites are negotiated during the handshake
+# TODO: more backends?
+
+import logging
+import os
+import struct
+
+from .crypto import Crypter, AuthenticationError
+from .replay import SaltedWindow
+
+logger = logging.getLogger(__name__)
+
+# aead backends, use whatever is installed
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        AESGCM, ChaCha20Poly1305)
+    from cryptography.exceptions import InvalidTag
+
+    # backends are (new, seal, unseal): new(key) builds a context once per
+    # crypter, seal and unseal take it with each packet
+    def _cryptography_aead(cls):
+        def seal(aead, nonce, string):
+            return aead.encrypt(nonce, string, None)
+
+        def unseal(aead, nonce, string):
+            try:
+                return aead.decrypt(nonce, string, None)
+            except InvalidTag:
+                raise AuthenticationError("message authentication failed")
+        return cls, seal, unseal
+
+    _gcm = _cryptography_aead(AESGCM)
+    _chacha = _cryptography_aead(ChaCha20Poly1305)
+
+except ImportError:
+    _gcm = _chacha = None
+
+if _gcm is None:
+    # pycryptodome installs as Crypto, like pycrypto (which has no aead)
+    try:
+        from Crypto.Cipher import AES
+        AES.MODE_GCM
+        try:
+            from Crypto.Cipher import ChaCha20_Poly1305
+        except ImportError:
+            ChaCha20_Poly1305 = None
+
+        # these cipher objects are single use, so the context is the key
+        def _pycryptodome_aead(new):
+            def seal(key, nonce, string):
+                ct, tag = new(key, nonce).encrypt_and_digest(string)
+                return ct + tag
+
+            def unseal(key, nonce, string):
+                try:
+                    return new(key, nonce).decrypt_and_verify(string[:-16],
+                                                              string[-16:])
+                except ValueError:
+                    raise AuthenticationError("message authentication failed")
+            return str, seal, unseal
+
+        _gcm = _pycryptodome_aead(
+            lambda key, nonce: AES.new(key, AES.MODE_GCM, nonce=nonce))
+        if ChaCha20_Poly1305 is not None:
+            _chacha = _pycryptodome_aead(
+                lambda key, nonce: ChaCha20_Poly1305.new(key=key,
+                                                         nonce=nonce))
+    except (ImportError, AttributeError):
+        pass
+
+
+# job functions for the crypto pipeline
+def gcm_encrypt(aead, jobs):
+    seal = _gcm[1]
+    return [seal(aead, nonce, string) + nonce for string, nonce in jobs]
+
+def gcm_decrypt(aead, strings):
+    unseal = _gcm[2]
+    return [unseal(aead, s[-12:], s[:-12]) for s in strings]
+
+def chacha_encrypt(aead, jobs):
+    seal = _chacha[1]
+    return [seal(aead, nonce, string) + nonce for string, nonce in jobs]
+
+def chacha_decrypt(aead, strings):
+    unseal = _chacha[2]
+    return [unseal(aead, s[-12:], s[:-12]) for s in strings]
+
+
+class _AEADCrypter(object):
+    '''aead cipher with a 96-bit nonce (64-bit salt + 32-bit counter).  The
+    top bit of the salt is the key phase, see _Crypter0.'''
+    key_size = 32
+    nonce_size = 12
+    overhead = 28  # tag + nonce
+    # both backends call out to C without the GIL, see CryptoPipeline
+    releases_gil = True
+    replay_window = 1024  # packets
+    backend = None
+
+    def __init__(self, key, can_rollover=False, callback=None, args=None,
+                 phase=0):
+        assert len(key) == self.key_size, "Invalid key size"
+        self.key = key
+        self.can_rollover = can_rollover
+        self.callback = callback
+        self.args = args or ()
+        self.phase_bit = phase << 7
+        self.other = None
+        self.salt = self._salt()
+        self.n = 0
+        self.max_n = 0xFFFFFFFF
+        self.replay = SaltedWindow(self.replay_window)
+        new, self._seal, self._unseal = self.backend
+        # the job functions get this in place of the key
+        self.job_key = self._aead = new(key)
+
+    def _nonce(self):
+        # never reuse a nonce with the same key
+        if self.n > self.max_n:
+            self._reset()
+        nonce = self.salt + struct.pack('>I', self.n & 0xFFFFFFFF)
+        self.n += 1
+        return nonce
+
+    def encrypt(self, string):
+        nonce = self._nonce()
+        return self._seal(self._aead, nonce, string) + nonce
+
+    def encrypt_into(self, string, buf, offset):
+        '''Encrypt string into buf (a bytearray) at offset, followed by the
+        nonce.  Returns the end offset.'''
+        nonce = self._nonce()
+        ct = self._seal(self._aead, nonce, str(string))
+        end = offset + len(ct)
+        buf[offset:end] = ct
+        buf[end:end+self.nonce_size] = nonce
+        return end + self.nonce_size
+
+    def _salt(self):
+        salt = os.urandom(8)
+        return chr(ord(salt[0]) & 0x7f | self.phase_bit) + salt[1:]
+
+    def decrypt(self, string):
+        # the backends want str, so a buffer gets copied here
+        nonce = string[-self.nonce_size:]
+        if ord(nonce[0]) & 0x80 != self.phase_bit and self.other is not None:
+            return self.other.decrypt(string)
+        return self._unseal(self._aead, nonce,
+                            string[:-self.nonce_size])
+
+    def _window(self, string):
+        if (ord(string[-self.nonce_size]) & 0x80 != self.phase_bit
+                and self.other is not None):
+            return self.other.replay
+        return self.replay
+
+    def check(self, string):
+        '''False if string is a replay, or too old to tell.  Looks at the
+        nonce only, so it's cheap enough to call before decrypt.'''
+        return self._window(string).check(string[-self.nonce_size:])
+
+    def mark(self, string):
+        '''Remember string's nonce, once string authenticated.  False if
+        it turned out to be a replay after all.'''
+        return self._window(string).mark(string[-self.nonce_size:])
+
+    def reserve(self, strings):
+        '''Reserve nonces for a list of strings, returns jobs for
+        job_encrypt'''
+        nonce = self._nonce
+        return [(string, nonce()) for string in strings]
+
+    def _reset(self):
+        if self.callback is None and not self.can_rollover:
+            raise ValueError, 'AEAD nonce counter rolled over'
+
+        # new salt so the counter can start over without reusing a nonce
+        self.salt = self._salt()
+        self.n = 0
+        if self.callback is not None:
+            self.callback(*self.args)
+
+
+class AESGCMCrypter(_AEADCrypter):
+    '''aes 256 in gcm mode'''
+    backend = _gcm
+    job_encrypt = staticmethod(gcm_encrypt)
+    job_decrypt = staticmethod(gcm_decrypt)
+
+
+class ChaChaCrypter(_AEADCrypter):
+    '''chacha20-poly1305'''
+    backend = _chacha
+    job_encrypt = staticmethod(chacha_encrypt)
+    job_decrypt = staticmethod(chacha_decrypt)
+
+
+###### Registry
+
+class CipherSuite(object):
+    def __init__(self, id, name, cls):
+        self.id = id
+        self.name = name
+        self.cls = cls
+
+    def __repr__(self):
+        return '<CipherSuite {0} ({1})>'.format(self.name, self.id)
+
+_by_id = {}
+_by_name = {}
+
+def register(id, name, cls):
+    '''Register a crypter class as a cipher suite.  id is sent on the wire in
+    handshake1, so it must fit in a byte and never change.'''
+    if id in _by_id:
+        raise ValueError, "suite id {0} already assigned to {1}"\
+                            .format(id, _by_id[id].name)
+    suite = CipherSuite(id, name, cls)
+    _by_id[id] = suite
+    _by_name[name] = suite
+    return suite
+
+def get(item):
+    '''Get a suite by id or name'''
+    if isinstance(item, str):
+        return _by_name[item]
+    return _by_id[item]
+
+def available():
+    '''Names of suites that can be used with the installed libraries'''
+    return [s.name for i, s in sorted(_by_id.items())
+            if getattr(s.cls, 'backend', True) is not None]
+
+def ids(names):
+    '''Map configured suite names to ids, skipping unknown/unavailable ones'''
+    ok = available()
+    ret = []
+    for name in names:
+        if name in ok:
+            ret.append(_by_name[name].id)
+        else:
+            logger.warning('cipher suite {0} not available, skipping', name)
+    return ret
+
+def negotiate(ours, theirs, ours_first):
+    '''Pick a suite id both sides support.  Both peers have to pick the same
+    one, so the list of the peer with the lower id wins.'''
+    prefs, other = (ours, theirs) if ours_first else (theirs, ours)
+    for id in prefs:
+        if id in other:
+            return id
+    return None
+
+def transcript(ours, theirs, ours_first, suite):
+    '''Both suite offers (None for the old handshake1 format) and the pick,
+    the same on both sides.  It is hashed into the handshake confirmation,
+    so a downgrade on the way fails the handshake.  Empty if neither side
+    offered, to still agree with versions from before suites.'''
+    if ours is None and theirs is None:
+        return ''
+    offers = (ours, theirs) if ours_first else (theirs, ours)
+    return ''.join('\xff' if ids is None
+                   else chr(len(ids)) + ''.join(chr(x) for x in ids)
+                   for ids in offers) + chr(suite)
+
+
+DEFAULT = register(0, 'aes-ctr', Crypter)
+register(1, 'aes-gcm', AESGCMCrypter)
+register(2, 'chacha20-poly1305', ChaChaCrypter)
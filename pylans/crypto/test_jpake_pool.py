@@ -0,0 +1,97 @@
+import time
+import unittest
+
+from twisted.internet import defer, reactor
+
+from .jpake_pool import JPAKEPool
+
+
+class Handshakes(unittest.TestCase):
+    def results(self, d):
+        out = []
+        d.addBoth(out.append)
+        return out
+
+    def test_inline(self):
+        # not started, so every round runs inline
+        pool = JPAKEPool(workers=0)
+        a = pool.handshake('b', 'password')
+        b = pool.handshake('a', 'password')
+
+        send1a, send1b = self.results(a.one()), self.results(b.one())
+        send2a = self.results(a.two(send1b[0]))
+        send2b = self.results(b.two(send1a[0]))
+        key_a = self.results(a.three(send2b[0]))
+        key_b = self.results(b.three(send2a[0]))
+        self.assertEqual(key_a, key_b)
+        self.assertEqual(len(key_a[0]), 32)
+
+    def test_queued(self):
+        pool = JPAKEPool(workers=0)
+        a = pool.handshake('b', 'password')
+        b = pool.handshake('a', 'password')
+        send1a, send1b = self.results(a.one()), self.results(b.one())
+        send2b = self.results(b.two(send1a[0]))
+
+        # hold a's round two, three has to wait for it
+        held = defer.Deferred()
+        run = pool.run
+        pool.run = lambda key, func, args: held.addCallback(
+            lambda _: run(key, func, args))
+        send2a = self.results(a.two(send1b[0]))
+        key_a = self.results(a.three(send2b[0]))
+        self.assertEqual((send2a, key_a), ([], []))
+        pool.run = run
+
+        held.callback(None)
+        self.assertEqual(key_a, self.results(b.three(send2a[0])))
+
+    def test_bad_password(self):
+        pool = JPAKEPool(workers=0)
+        a = pool.handshake('b', 'password')
+        b = pool.handshake('a', 'wrong')
+        send2a = self.results(a.two(self.results(b.one())[0]))
+        send2b = self.results(b.two(self.results(a.one())[0]))
+        key_a = self.results(a.three(send2b[0]))
+        self.assertNotEqual(key_a, self.results(b.three(send2a[0])))
+
+
+class Pooled(unittest.TestCase):
+    def run_until(self, done):
+        # results come back through callFromThread, run those by hand
+        deadline = time.time() + 30
+        while not done() and time.time() < deadline:
+            reactor.runUntilCurrent()
+            time.sleep(0.001)
+        self.assertTrue(done())
+
+    def wait(self, d):
+        out = []
+        d.addBoth(out.append)
+        self.run_until(lambda: len(out) > 0)
+        return out[0]
+
+    def test_thread_pool(self):
+        pool = JPAKEPool(workers=2, size=2)
+        pool.start()
+        try:
+            self.assertTrue(pool.running)
+            self.run_until(lambda: len(pool.ready) == 2)
+            a = pool.handshake('b', 'password')
+            b = pool.handshake('a', 'password')
+            send1a, send1b = self.wait(a.one()), self.wait(b.one())
+            send2a, send2b = (self.wait(a.two(send1b)),
+                              self.wait(b.two(send1a)))
+            key_a = self.wait(a.three(send2b))
+            self.assertEqual(key_a, self.wait(b.three(send2a)))
+            self.assertEqual(len(key_a), 32)
+
+            # round one came from the precomputed ones
+            self.assertEqual((pool.hits, pool.misses), (2, 0))
+        finally:
+            pool.stop()
+        self.assertFalse(pool.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
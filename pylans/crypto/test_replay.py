@@ -0,0 +1,133 @@
+import os
+import random
+import unittest
+
+from . import suites
+from .crypto import AuthenticationError
+from .replay import ReplayWindow, CounterWindow
+
+
+class Window(unittest.TestCase):
+    def test_reordered(self):
+        window = ReplayWindow(size=64)
+        positions = range(1000)
+        # shuffled in runs of 32, well inside the window
+        for i in range(0, 1000, 32):
+            run = positions[i:i+32]
+            random.shuffle(run)
+            positions[i:i+32] = run
+        self.assertTrue(all(window.mark(x) for x in positions))
+        self.assertEqual(bin(window.bitmap).count('1'), 64)
+
+    def test_duplicated(self):
+        window = ReplayWindow(size=64)
+        stream = [x * 7 for x in range(200)]
+        stream = stream + stream[-10:] + stream[:10]
+        kept = [x for x in stream if window.check(x) and window.mark(x)]
+        self.assertEqual(kept, stream[:200])
+        self.assertEqual((window.replayed, window.old), (10, 10))
+
+    def test_check(self):
+        window = ReplayWindow(size=4)
+        self.assertTrue(window.check(100))
+        for x in range(5):
+            window.mark(x)
+        # only marked positions move the window
+        self.assertEqual(window.top, 4)
+        self.assertTrue(window.check(100))
+        self.assertFalse(window.mark(4))
+
+    def test_counter_forged(self):
+        window = CounterWindow(size=64)
+        # offsets of packets 1 to 40 bytes long, a forged one far ahead
+        stream = [0]
+        for x in range(1000):
+            stream.append(stream[-1] + random.randint(1, 40))
+        self.assertTrue(window.mark(1 << 100))
+        # it takes a slot, but in order packets all still get in
+        self.assertTrue(all(window.mark(x) for x in stream))
+        self.assertFalse(window.check(stream[-1]))
+        self.assertFalse(window.check(stream[0]))
+        self.assertEqual((window.replayed, window.old), (1, 1))
+
+
+def aead_suites():
+    for name in suites.available():
+        cls = suites.get(name).cls
+        if issubclass(cls, suites._AEADCrypter):
+            yield name, cls
+
+
+class Crypters(unittest.TestCase):
+    def test_stream(self):
+        for name, cls in aead_suites():
+            tx = cls(os.urandom(cls.key_size))
+            rx = cls(tx.key)
+            sent = [tx.encrypt(os.urandom(random.randint(1, 40)))
+                    for x in range(300)]
+            stream = sent[:]
+            random.shuffle(stream)
+            stream += random.sample(sent, 50)
+            kept = [s for s in stream if rx.check(s) and rx.mark(s)]
+            self.assertEqual(sorted(kept), sorted(sent), name)
+            self.assertEqual(rx.replay.replayed, 50, name)
+
+    def test_ctr(self):
+        cls = suites.DEFAULT.cls
+        tx = cls(os.urandom(cls.key_size))
+        rx = cls(tx.key)
+        sent = [tx.encrypt(os.urandom(random.randint(1, 40)))
+                for x in range(300)]
+        stream = sent[:]
+        random.shuffle(stream)
+        stream += random.sample(sent, 50)
+        kept = [s for s in stream if rx.check(s) and rx.mark(s)]
+        self.assertEqual(sorted(kept), sorted(sent))
+        self.assertEqual(rx.replay.replayed, 50)
+
+        # the other phase has its own window
+        tx2 = cls(tx.key, phase=1)
+        rx.other = cls(tx.key, phase=1)
+        s = tx2.encrypt('x')
+        self.assertTrue(rx.check(s) and rx.mark(s))
+        self.assertFalse(rx.check(s))
+        self.assertEqual(rx.other.replay.replayed, 1)
+
+    def test_forged(self):
+        for name, cls in aead_suites():
+            tx = cls(os.urandom(cls.key_size))
+            rx = cls(tx.key)
+            s = tx.encrypt('x')
+            forged = s[:-4] + '\xff\xff\xff\xf0'
+            self.assertTrue(rx.check(forged), name)
+            self.assertRaises(AuthenticationError, rx.decrypt, forged)
+            # never marked, so it can't push the window past s
+            self.assertTrue(rx.check(s) and rx.mark(s), name)
+
+    def test_salt(self):
+        for name, cls in aead_suites():
+            tx = cls(os.urandom(cls.key_size), can_rollover=True)
+            rx = cls(tx.key)
+            before = [tx.encrypt('x') for x in range(10)]
+            self.assertTrue(all(rx.mark(s) for s in before[:-1]), name)
+            # counter starts over with a new salt, and isn't too old
+            tx._reset()
+            after = tx.encrypt('x')
+            self.assertTrue(rx.check(after) and rx.mark(after), name)
+            self.assertFalse(rx.mark(after), name)
+            # the old salt is done with
+            self.assertFalse(rx.check(before[-1]), name)
+
+    def test_phases(self):
+        for name, cls in aead_suites():
+            old = cls(os.urandom(cls.key_size))
+            new = cls(os.urandom(cls.key_size), phase=1)
+            new.other = old
+            # the same positions, in windows of their own
+            a, b = old.encrypt('x'), new.encrypt('x')
+            self.assertTrue(new.mark(a) and new.mark(b), name)
+            self.assertFalse(new.check(a) or new.check(b), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import unittest
+
+from . import suites
+from .crypto import AuthenticationError
+
+
+class KeyPhase(unittest.TestCase):
+    def test_grace(self):
+        for name in suites.available():
+            cls = suites.get(name).cls
+            old_a, old_b = cls(os.urandom(cls.key_size)), None
+            old_b = cls(old_a.key)
+            new_key = os.urandom(cls.key_size)
+            new_a, new_b = cls(new_key, phase=1), cls(new_key, phase=1)
+
+            # a switched, b still has packets from before in flight
+            late = old_b.encrypt('old')
+            new_a.other = old_a
+            self.assertEqual(new_a.decrypt(old_b.encrypt('old')), 'old', name)
+            self.assertEqual(new_a.decrypt(late), 'old', name)
+
+            # b switched too, and has a's new key
+            old_b.other = new_b
+            self.assertEqual(old_b.decrypt(new_a.encrypt('new')), 'new', name)
+
+            # after the grace period the old phase is just the wrong key
+            new_a.other = None
+            try:
+                self.assertNotEqual(new_a.decrypt(old_b.encrypt('old')),
+                                    'old', name)
+            except AuthenticationError:
+                pass
+
+
+class Negotiate(unittest.TestCase):
+    def test_lower_id_wins(self):
+        a, b = [1, 2, 0], [2, 0]
+        self.assertEqual(suites.negotiate(a, b, True), 2)
+        self.assertEqual(suites.negotiate(b, a, False), 2)
+        self.assertEqual(suites.negotiate(b, a, True), 2)
+        self.assertEqual(suites.negotiate([1, 0], [0, 1], True), 1)
+        self.assertEqual(suites.negotiate([0, 1], [1, 0], False), 1)
+        self.assertEqual(suites.negotiate([1], [2], True), None)
+
+    def test_transcript(self):
+        a, b = [1, 0], [2, 0]
+        self.assertEqual(suites.transcript(a, b, True, 0),
+                         suites.transcript(b, a, False, 0))
+        self.assertEqual(suites.transcript(None, None, True, 0), '')
+        # an offer stripped to the old format on the way
+        self.assertNotEqual(suites.transcript(a, None, True, 0),
+                            suites.transcript(None, b, False, 0))
+        self.assertNotEqual(suites.transcript(a, b, True, 0),
+                            suites.transcript(b, [0], False, 0))
+
+
+class AEAD(unittest.TestCase):
+    def test_round_trip(self):
+        for name in suites.available():
+            cls = suites.get(name).cls
+            if not issubclass(cls, suites._AEADCrypter):
+                continue
+            a = cls(os.urandom(cls.key_size))
+            b = cls(a.key)
+            for string in ('', 'x', 'data' * 400):
+                ct = a.encrypt(string)
+                self.assertEqual(len(ct), len(string) + cls.overhead, name)
+                self.assertEqual(b.decrypt(ct), string, name)
+                self.assertEqual(b.decrypt(buffer(ct)), string, name)
+
+            # job functions, as run by the crypto pipeline
+            cts = a.job_encrypt(a.job_key, a.reserve(['one', 'two']))
+            self.assertEqual(b.job_decrypt(b.job_key, cts), ['one', 'two'],
+                             name)
+
+            ct = a.encrypt('data')
+            forged = ct[:2] + chr(ord(ct[2]) ^ 1) + ct[3:]
+            self.assertRaises(AuthenticationError, b.decrypt, forged)
+            self.assertRaises(AuthenticationError, b.job_decrypt, b.job_key,
+                              [forged])
+
+
+if __name__ == '__main__':
+    unittest.main()
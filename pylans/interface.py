@@ -21,6 +21,7 @@
 
 import logging
 
+from . import plogging
 from . import settings
 from .mods.chatter import ChatterBox
 from .util.event import Event
@@ -77,6 +78,7 @@ class Interface(object):
         if self.log_level != value:
             settings.set_option('settings/loglevel', value)
             global_logger.setLevel(value)
+            plogging.rebind_data_path()
             settings.save()
 
     def _peer_added(self, pm, peer):
@@ -144,6 +146,15 @@ class Interface(object):
         return None
 
 
+    def get_network_stats(self, network=None):
+        '''Get the data path counters of a running network, see
+        Router.get_stats()'''
+        router = self._get_router(network)
+        if router is not None:
+            return router.get_stats()
+        return {}
+
+
     def create_new_network(self, name, key=None, username=None, address=None, port=None,
                 id=None, enabled=None, mode=None, key_str=None):
         if name not in self._mgr:
@@ -90,7 +90,7 @@ class Pinger(object):
         Set peer ping time and timeouts.
         '''
         if dt is not None:
-            self.router.pm.peer_list[peer.id].ping_time = dt
+            self.router.pm.set_ping_time(self.router.pm.peer_list[peer.id], dt)
         self.router.pm.peer_list[peer.id].timeouts = 0
 
 
@@ -0,0 +1,181 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# pmtu.py
+# path mtu discovery with padded pings, so encapsulated frames are never
+# fragmented on the way to a peer
+
+import logging
+from twisted.internet import reactor, defer
+from twisted.internet.task import LoopingCall
+from .. import settings
+from .. import util
+from ..util import event
+from ..packets import PacketType
+from . import pinger  # adds PacketType.PING
+
+logger = logging.getLogger(__name__)
+
+HEADER_SIZE = 36    # router packet header
+ETHER_SIZE = 14     # tap frames carry one
+IP4_SIZE = 28       # ip + udp headers
+IP6_SIZE = 48
+
+
+class PMTUProber(object):
+    '''
+        Finds the path mtu to each peer with PINGs padded to a size and sent
+        with the don't fragment bit set: the most the peer's address can
+        take first, then a binary search down to MIN_MTU.  Peers ack PINGs
+        whatever their size, so this works with old ones too.
+
+        Results are kept per session and redone every PROBE_INTERVAL.  The
+        tun/tap mtu is set to the smallest one less the encapsulation, and
+        never above the set_mtu option.
+    '''
+    MIN_MTU = 576
+    # stop once the answer is known to within this many bytes
+    PRECISION = 8
+    # pings sent at a size before it counts as too big
+    TRIES = 2
+    PROBE_TIMEOUT = 1.0     # seconds
+    PROBE_INTERVAL = 600    # seconds
+    # seconds after a session opens before probing it
+    PROBE_DELAY = 1
+
+    def __init__(self, router):
+        self.router = util.get_weakref_proxy(router)
+        # sid -> path mtu, and the tun/tap mtu it allows
+        self.pmtu = {}
+        self.frame_mtu = {}
+        # what we set the tun/tap mtu to
+        self.mtu = None
+        self.running = False
+        self._probing = set()
+        self._lp = LoopingCall(self.probe_all)
+
+        event.register_handler('session-opened', None, self.do_session_opened)
+        event.register_handler('session-closed', None, self.do_session_closed)
+
+    def _get(self, prop, default):
+        return settings.get_option(self.router.network.name+'/'+prop, default)
+
+    @property
+    def enabled(self):
+        return (self._get('pmtu_discovery', True)
+                and getattr(self.router.sm.proto, 'df_available', False))
+
+    def start(self):
+        if not self.enabled:
+            logger.info('path mtu discovery off for {0}',
+                        self.router.network.name)
+            return
+        self.running = True
+        self._lp.start(self.PROBE_INTERVAL, now=False)
+
+    def stop(self):
+        self.running = False
+        if self._lp.running:
+            self._lp.stop()
+
+    def do_session_opened(self, obj, sid, relays):
+        if self.running and self.router.sm == obj:
+            reactor.callLater(self.PROBE_DELAY, self.probe, sid)
+
+    def do_session_closed(self, obj, sid):
+        if self.router.sm == obj:
+            self.pmtu.pop(sid, None)
+            if self.frame_mtu.pop(sid, None) is not None:
+                self.update()
+
+    def probe_all(self):
+        for sid in self.router.sm.session_map.keys():
+            self.probe(sid)
+
+    @defer.inlineCallbacks
+    def probe(self, sid):
+        '''Find the path mtu to sid, and update the tun/tap mtu with it'''
+        sm = self.router.sm
+        if not self.running or sid in self._probing \
+                or sid not in sm.session_map:
+            return
+
+        self._probing.add(sid)
+        try:
+            address = sm.session_map[sid]
+            ip_size = IP6_SIZE if ':' in address[0] else IP4_SIZE
+            lo, hi = self.MIN_MTU, self._get('pmtu_max', 1500) + 1
+            size, found = hi - 1, False
+            while hi - lo > self.PRECISION:
+                ok = yield self.send_probe(sid, size - ip_size)
+                if not self.running or sid not in sm.session_map:
+                    return
+                if ok:
+                    lo, found = size, True
+                else:
+                    hi = size
+                size = (lo + hi) // 2
+
+            if not found:
+                # not even MIN_MTU, or they don't answer at all
+                ok = yield self.send_probe(sid, lo - ip_size)
+                if not ok or sid not in sm.session_map:
+                    logger.info('no path mtu found for {0}', sid.encode('hex'))
+                    return
+
+            obj = sm.session_objs.get(sid)
+            frame = (lo - ip_size - HEADER_SIZE - getattr(obj, 'overhead', 0)
+                     - (ETHER_SIZE if self.router._tuntap is not None
+                        and self.router._tuntap.is_tap else 0))
+            logger.info('path mtu to {0} is {1}, frames up to {2}',
+                        sid.encode('hex'), lo, frame)
+            self.pmtu[sid] = lo
+            self.frame_mtu[sid] = frame
+            self.update()
+        finally:
+            self._probing.discard(sid)
+
+    @defer.inlineCallbacks
+    def send_probe(self, sid, size):
+        '''True if a PING datagram of size bytes got through to sid'''
+        pad = '\x00' * (size - HEADER_SIZE)
+        for i in range(self.TRIES):
+            try:
+                yield self.router.send(PacketType.PING, pad, sid, clear=True,
+                                       ack=True, df=True,
+                                       ack_timeout=self.PROBE_TIMEOUT)
+            except Exception:
+                continue  # lost, or too big to leave this host
+            defer.returnValue(True)
+        defer.returnValue(False)
+
+    def update(self):
+        '''Set the tun/tap mtu to the most every session can carry'''
+        tuntap = self.router._tuntap
+        if tuntap is None or len(self.frame_mtu) == 0:
+            return
+        mtu = min(self.frame_mtu.values())
+        cap = self._get('set_mtu', None)
+        if cap is not None:
+            mtu = min(mtu, cap)
+        if mtu == self.mtu:
+            return
+
+        logger.info('setting mtu of {0} to {1}', self.router.network.name, mtu)
+        self.mtu = mtu
+        d = defer.maybeDeferred(tuntap.set_mtu, mtu)
+        d.addErrback(lambda f: logger.warning('could not set mtu: {0}',
+                                              f.getErrorMessage()))
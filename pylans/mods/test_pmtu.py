@@ -0,0 +1,81 @@
+import unittest
+
+from twisted.internet import defer
+
+from .pmtu import PMTUProber, HEADER_SIZE, IP4_SIZE
+
+
+class FakeTunTap(object):
+    is_tap = False
+
+    def __init__(self):
+        self.mtus = []
+
+    def set_mtu(self, mtu):
+        self.mtus.append(mtu)
+
+
+class FakeCrypter(object):
+    overhead = 17
+
+
+class FakeNetwork(object):
+    name = 'test-pmtu'
+
+
+class FakeSessions(object):
+    def __init__(self):
+        self.session_map = {}
+        self.session_objs = {}
+
+
+class FakeRouter(object):
+    '''acks PINGs that fit the path to each sid'''
+    def __init__(self):
+        self.network = FakeNetwork()
+        self.sm = FakeSessions()
+        self._tuntap = FakeTunTap()
+        self.paths = {}
+
+    def add(self, sid, path):
+        self.sm.session_map[sid] = ('10.0.0.1', 8015)
+        self.sm.session_objs[sid] = FakeCrypter()
+        self.paths[sid] = path
+
+    def send(self, type, data, sid, **kwargs):
+        if HEADER_SIZE + len(data) + IP4_SIZE <= self.paths[sid]:
+            return defer.succeed(None)
+        return defer.fail(Exception('timed out'))
+
+
+class Probing(unittest.TestCase):
+    def setUp(self):
+        self.router = FakeRouter()
+        self.prober = PMTUProber(self.router)
+        self.prober.running = True
+
+    def test_search(self):
+        self.router.add('a', 1500)
+        self.router.add('b', 1400)
+        self.prober.probe('a')
+        self.prober.probe('b')
+        self.assertEqual(self.prober.pmtu['a'], 1500)
+        self.assertTrue(1400 - PMTUProber.PRECISION
+                        <= self.prober.pmtu['b'] <= 1400)
+
+        # the tun/tap mtu is the smallest frame that fits every path
+        frame = self.prober.pmtu['b'] - IP4_SIZE - HEADER_SIZE - 17
+        self.assertEqual(self.router._tuntap.mtus, [1500 - 81, frame])
+
+        self.prober.do_session_closed(self.router.sm, 'b')
+        self.assertEqual(self.router._tuntap.mtus[-1], 1500 - 81)
+
+    def test_no_answer(self):
+        self.router.add('a', 0)
+        self.prober.probe('a')
+        self.assertEqual(self.prober.pmtu, {})
+        self.assertEqual(self.router._tuntap.mtus, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# sendmmsg/recvmmsg bindings for batching UDP syscalls (linux only)
+
+from ctypes import (
+    Structure, POINTER,
+    pointer, get_errno, cast, addressof, sizeof, string_at,
+    create_string_buffer,
+    c_ushort, c_char_p, c_void_p, c_uint, c_int, c_size_t, c_uint16, c_uint32
+)
+from socket import inet_aton, inet_ntoa, htons, ntohs, AF_INET
+from struct import pack, unpack
+import ctypes.util
+import ctypes
+import errno
+import os
+import platform
+
+MSG_DONTWAIT = 0x40
+UIO_MAXIOV = 1024
+
+socklen_t = c_uint
+
+
+# <sys/uio.h>
+class struct_iovec(Structure):
+    _fields_ = [
+        ('iov_base', c_void_p),
+        ('iov_len', c_size_t)]
+
+
+# <sys/socket.h>
+class struct_msghdr(Structure):
+    _fields_ = [
+        ('msg_name', c_void_p),
+        ('msg_namelen', socklen_t),
+        ('msg_iov', POINTER(struct_iovec)),
+        ('msg_iovlen', c_size_t),
+        ('msg_control', c_void_p),
+        ('msg_controllen', c_size_t),
+        ('msg_flags', c_int)]
+
+
+# <sys/socket.h>, with _GNU_SOURCE
+class struct_mmsghdr(Structure):
+    _fields_ = [
+        ('msg_hdr', struct_msghdr),
+        ('msg_len', c_uint)]
+
+
+# <netinet/in.h>
+class struct_sockaddr_in(Structure):
+    _fields_ = [
+        ('sin_family', c_ushort),
+        ('sin_port', c_uint16),
+        ('sin_addr', c_uint32),         # network byte order
+        ('sin_zero', ctypes.c_byte * 8)]
+
+
+libc = None
+if platform.system() == 'Linux':
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.sendmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint,
+                                  c_int]
+        libc.recvmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint,
+                                  c_int, c_void_p]
+    except (OSError, AttributeError):
+        # glibc < 2.14 has no sendmmsg
+        libc = None
+
+available = libc is not None
+
+
+def _raise_errno():
+    e = get_errno()
+    raise OSError(e, os.strerror(e))
+
+
+def _sockaddr(address):
+    '''Build a sockaddr_in from an (ip, port) tuple'''
+    return struct_sockaddr_in(AF_INET, htons(address[1]),
+                              unpack('=I', inet_aton(address[0]))[0])
+
+
+class MMsg(object):
+    '''
+        Batched send/receive on a (non-blocking) UDP socket.  The receive
+        vector and its buffers are allocated once and reused for every call.
+        Addresses are sockaddr_in, so only AF_INET sockets are supported.
+    '''
+
+    def __init__(self, fd, vlen=32, bufsize=8192, family=AF_INET):
+        if not available:
+            raise OSError('sendmmsg/recvmmsg not available on this platform')
+        if family != AF_INET:
+            raise ValueError('sendmmsg/recvmmsg only support AF_INET sockets')
+
+        self.fd = fd
+        self.vlen = vlen
+        self.bufsize = bufsize
+
+        self._bufs = [create_string_buffer(bufsize) for i in range(vlen)]
+        self._names = (struct_sockaddr_in * vlen)()
+        self._iovs = (struct_iovec * vlen)()
+        self._msgs = (struct_mmsghdr * vlen)()
+
+        for i in range(vlen):
+            self._iovs[i].iov_base = addressof(self._bufs[i])
+            self._iovs[i].iov_len = bufsize
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = addressof(self._names[i])
+            hdr.msg_namelen = sizeof(struct_sockaddr_in)
+            hdr.msg_iov = pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self):
+        '''
+            Read up to vlen datagrams without blocking.  Returns a list of
+            (data, (ip, port)) tuples, empty if nothing was waiting.
+        '''
+        msgs = self._msgs
+        namelen = sizeof(struct_sockaddr_in)
+        for i in xrange(self.vlen):
+            msgs[i].msg_hdr.msg_namelen = namelen
+
+        n = libc.recvmmsg(self.fd, msgs, self.vlen, MSG_DONTWAIT, None)
+        if n < 0:
+            if get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            _raise_errno()
+
+        ret = []
+        names = self._names
+        bufs = self._bufs
+        for i in xrange(n):
+            sa = names[i]
+            if sa.sin_family != AF_INET:
+                continue  # can't happen on an AF_INET socket
+            ret.append((string_at(addressof(bufs[i]), msgs[i].msg_len),
+                        (inet_ntoa(pack('=I', sa.sin_addr)),
+                         ntohs(sa.sin_port))))
+        return ret
+
+    def send(self, datas, address):
+        '''
+            Send a list of datagrams to one (ip, port) address.  Returns the
+            number of datagrams the kernel accepted.
+        '''
+        name = _sockaddr(address)
+        sent = 0
+        while sent < len(datas):
+            chunk = datas[sent:sent + UIO_MAXIOV]
+            n = len(chunk)
+            iovs = (struct_iovec * n)()
+            msgs = (struct_mmsghdr * n)()
+            for i, data in enumerate(chunk):
+                # points at the str's own buffer, chunk keeps it alive
+                iovs[i].iov_base = cast(c_char_p(data), c_void_p).value
+                iovs[i].iov_len = len(data)
+                hdr = msgs[i].msg_hdr
+                hdr.msg_name = addressof(name)
+                hdr.msg_namelen = sizeof(name)
+                hdr.msg_iov = pointer(iovs[i])
+                hdr.msg_iovlen = 1
+
+            r = libc.sendmmsg(self.fd, msgs, n, 0)
+            if r < 0:
+                if sent > 0 and get_errno() in (errno.EAGAIN,
+                                                errno.EWOULDBLOCK):
+                    break
+                _raise_errno()
+            elif r == 0:
+                break
+            sent += r
+
+        return sent
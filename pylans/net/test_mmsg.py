@@ -0,0 +1,38 @@
+import socket
+import unittest
+
+from . import mmsg
+
+
+@unittest.skipUnless(mmsg.available, 'sendmmsg/recvmmsg not available')
+class Loopback(unittest.TestCase):
+    def setUp(self):
+        self.a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.a.bind(('127.0.0.1', 0))
+        self.b.bind(('127.0.0.1', 0))
+        self.b.setblocking(False)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_round_trip(self):
+        send = mmsg.MMsg(self.a.fileno(), vlen=4)
+        recv = mmsg.MMsg(self.b.fileno(), vlen=4)
+        datas = ['packet %d' % i for i in range(6)] + ['']
+        self.assertEqual(send.send(datas, self.b.getsockname()), 7)
+
+        # more than vlen waiting takes two calls
+        got = recv.recv() + recv.recv()
+        self.assertEqual([x[0] for x in got], datas)
+        self.assertTrue(all(x[1] == self.a.getsockname() for x in got))
+        self.assertEqual(recv.recv(), [])
+
+    def test_ipv6(self):
+        self.assertRaises(ValueError, mmsg.MMsg, self.b.fileno(),
+                          family=socket.AF_INET6)
+
+
+if __name__ == '__main__':
+    unittest.main()
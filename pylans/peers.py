@@ -25,13 +25,20 @@
 import cPickle as pickle
 import logging
 from twisted.internet import reactor, defer
+from twisted.internet.task import LoopingCall
+import copy
 import os
+import socket
+import struct
+from cStringIO import StringIO
 from struct import pack, unpack
 
 from . import util
 from .util import event
 from . import settings
 from .packets import PacketType
+from .routing import RoutingTable
+from .stats import AnnounceStats
 
 import hmac, hashlib
 
@@ -43,7 +50,8 @@ PEER_XCHANGE        = 18,
 PEER_XCHANGE_ACK    = 19,
 PEER_ANNOUNCE       = 20,
 REGISTER            = 21,
-REGISTER_ACK        = 22)
+REGISTER_ACK        = 22,
+PEER_ANNOUNCE_BATCH = 23)
 
 
 class PeerInfo(object):
@@ -84,22 +92,242 @@ class PeerInfo(object):
                 self.address)
                 
 
+
+###### Wire Format
+#
+# PeerInfo objects and peer lists used to be sent as cPickle dumps.  They are
+# sent in a fixed binary layout now, versioned by the first byte:
+#
+#   peer:       version(B) record
+#   peer list:  version(B) count(H) record*count
+#   px delta:   DELTA(B) epoch(4s) gen(I) since(I) known_epoch(4s) known(I)
+#               n_removed(H) id(16s)*n_removed count(H) record*count
+#   record:     id(16s) vip(4s) flags(B) relays(B) port(H) ping_time(f)
+#               addr_len(B) addr  name_len(B) name  [alias_len(B) alias]
+#               n_direct(B) (ip(4s) port(H))*n_direct
+#
+# relays and ping_time are the sender's route to the peer, which is what the
+# routing table needs.  address, relay_id and timeouts are not sent, they only
+# mean something to the sender and the receiver fills them in.  A protocol 2
+# pickle always starts with 0x80, so old peers are still recognised and
+# loaded with an unpickler that won't build anything but PeerInfo.
+
+PEER_FORMAT = 2
+DELTA_FORMAT = 3
+
+_VERSION = chr(PEER_FORMAT)
+_DELTA = chr(DELTA_FORMAT)
+_DELTA_HDR = struct.Struct('!4sII4sI')
+_PICKLE = '\x80'
+_RECORD = struct.Struct('!16s4sBBHf')
+_COUNT = struct.Struct('!H')
+_DIRECT = struct.Struct('!4sH')
+
+_F_DIRECT = 0x01
+_F_ALIAS = 0x02
+
+_new = object.__new__
+_inet_ntoa = socket.inet_ntoa
+
+
+def _pack_str(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    if len(s) > 0xff:
+        raise ValueError('string too long for peer format: {0!r}'.format(s))
+    return chr(len(s)) + s
+
+def _pack_record(peer):
+    flags = _F_DIRECT if peer.is_direct else 0
+    if peer.alias is not None:
+        flags |= _F_ALIAS
+    parts = [_RECORD.pack(peer.id, peer.vip, flags, min(peer.relays, 0xff),
+                          peer.port, peer.ping_time),
+             _pack_str(peer.addr),
+             _pack_str(peer.name)]
+    if peer.alias is not None:
+        parts.append(_pack_str(peer.alias))
+    addrs = peer.direct_addresses[:0xff]
+    parts.append(chr(len(addrs)))
+    for ip, port in addrs:
+        parts.append(_DIRECT.pack(socket.inet_aton(ip), port))
+    return ''.join(parts)
+
+def _unpack_record(data, i):
+    id, vip, flags, relays, port, ping_time = _RECORD.unpack_from(data, i)
+    i += _RECORD.size
+    n = ord(data[i])
+    addr = data[i+1:i+1+n]
+    i += 1 + n
+    n = ord(data[i])
+    name = data[i+1:i+1+n]
+    i += 1 + n
+    alias = None
+    if flags & _F_ALIAS:
+        n = ord(data[i])
+        alias = data[i+1:i+1+n]
+        i += 1 + n
+    n = ord(data[i])
+    i += 1
+    direct_addresses = []
+    for j in xrange(n):
+        ip, dport = _DIRECT.unpack_from(data, i)
+        direct_addresses.append((_inet_ntoa(ip), dport))
+        i += _DIRECT.size
+    if i > len(data):
+        raise ValueError('truncated peer record')
+
+    # skip __init__, every attribute is set here (like unpickling does)
+    pi = _new(PeerInfo)
+    pi.__dict__ = {'id': id, 'name': name, 'alias': alias,
+                   'address': ('ip', 'port'),
+                   'direct_addresses': direct_addresses, 'port': port,
+                   'addr': addr, 'vip': vip,
+                   'is_direct': bool(flags & _F_DIRECT), 'relays': relays,
+                   'relay_id': 0, 'ping_time': ping_time, 'timeouts': 0}
+    return pi, i
+
+def dump_peer(peer):
+    '''Encode a PeerInfo'''
+    return _VERSION + _pack_record(peer)
+
+def dump_peer_list(peers):
+    '''Encode a list of PeerInfo'''
+    peers = list(peers)
+    return (_VERSION + _COUNT.pack(len(peers))
+            + ''.join(_pack_record(p) for p in peers))
+
+def load_peer(data):
+    '''Decode a PeerInfo from dump_peer()'''
+    _check_version(data)
+    try:
+        pi, i = _unpack_record(data, 1)
+    except (struct.error, IndexError, socket.error):
+        raise ValueError('truncated peer record')
+    return pi
+
+def load_peer_list(data):
+    '''Decode a peer list from dump_peer_list() into a dict keyed by id'''
+    _check_version(data)
+    try:
+        return _unpack_list(data, 1)[0]
+    except (struct.error, IndexError, socket.error):
+        raise ValueError('truncated peer list')
+
+def _unpack_list(data, i):
+    peer_list = {}
+    n = _COUNT.unpack_from(data, i)[0]
+    i += _COUNT.size
+    for j in xrange(n):
+        pi, i = _unpack_record(data, i)
+        peer_list[pi.id] = pi
+    return peer_list, i
+
+def dump_delta(epoch, gen, since, known, peers, removed):
+    '''Encode the peers changed and ids removed from a peer table between
+    generation since and gen.  known is the (epoch, gen) of the receiver's
+    table that the sender has.'''
+    removed = list(removed)
+    peers = list(peers)
+    return ''.join([_DELTA, _DELTA_HDR.pack(epoch, gen, since, *known),
+                    _COUNT.pack(len(removed))] + removed
+                   + [_COUNT.pack(len(peers))]
+                   + [_pack_record(p) for p in peers])
+
+def load_delta(data):
+    '''Decode dump_delta() into (epoch, gen, since, known, peer_list, removed)'''
+    if data[:1] != _DELTA:
+        raise ValueError('unknown peer delta format {0!r}'.format(data[:1]))
+    try:
+        epoch, gen, since, known_epoch, known = \
+            _DELTA_HDR.unpack_from(data, 1)
+        i = 1 + _DELTA_HDR.size
+        n = _COUNT.unpack_from(data, i)[0]
+        i += _COUNT.size
+        removed = [data[j:j+16] for j in xrange(i, i + 16 * n, 16)]
+        i += 16 * n
+        peer_list, i = _unpack_list(data, i)
+    except (struct.error, IndexError, socket.error):
+        raise ValueError('truncated peer delta')
+    if i > len(data):
+        raise ValueError('truncated peer delta')
+    return epoch, gen, since, (known_epoch, known), peer_list, removed
+
+def _check_version(data):
+    if data[:1] != _VERSION:
+        raise ValueError('unknown peer format {0!r}'.format(data[:1]))
+
+def is_legacy(data):
+    '''True if data is a pickle from a peer that predates PEER_FORMAT'''
+    return data[:1] == _PICKLE
+
+def _find_global(module, name):
+    if name == 'PeerInfo' and module.split('.')[-1] == 'peers':
+        return PeerInfo
+    raise pickle.UnpicklingError('{0}.{1} not allowed in a peer pickle'
+                                 .format(module, name))
+
+def load_legacy(data):
+    '''Unpickle a PeerInfo or peer list from an old peer'''
+    u = pickle.Unpickler(StringIO(data))
+    u.find_global = _find_global
+    obj = u.load()
+    if isinstance(obj, dict):
+        peers = obj.values()
+    else:
+        peers = [obj]
+    for pi in peers:
+        if not isinstance(pi, PeerInfo):
+            raise ValueError('peer pickle holds a {0}'.format(type(pi)))
+    return obj
+
+
 class PeerManager(object):
     '''Manages peer connections'''
     MAX_REG_TRIES = 5
     MAX_PX_TRIES = 5
     REG_TRY_DELAY = 2
     PX_TRY_DELAY = 2
+    MAX_TOMBSTONES = 1000
 
     def __init__(self, router):
         # list of peers
         self.peer_list = {}
+        # secondary indexes into peer_list, kept up to date by _index() and
+        # _unindex().  keys can be shared, so each maps to the peers that
+        # have it, the last one indexed wins.  only direct peers are indexed
+        # by address, relayed peers share their relay's address
+        self._by_vip = {}
+        self._by_addr = {}
+        self._by_name = {}
+        self._by_address = {}
+        self._indexes = (self._by_vip, self._by_addr, self._by_name,
+                         self._by_address)
         # addr to (address,port)
 #        self.addr_map = {}
 
         # for display purposes
         self.peer_map = {}
 
+        # next hop and cost for every peer, see _learn_route()
+        self.routes = RoutingTable()
+
+        # peer table generations, so PX only sends what changed.  the
+        # generation is bumped on every add/change/remove, _changed and
+        # _removed hold the generation each peer was last touched at.
+        # epoch tells a restarted PeerManager's generations from the old ones
+        self.epoch = os.urandom(4)
+        self.generation = 0
+        self._changed = {}
+        self._removed = {}
+        self._full_before = 0   # tombstones older than this were dropped
+        # peer id -> generation of our table they have,
+        #            (epoch, generation) of theirs we have
+        self._acked = {}
+        self._seen = {}
+        # peer id -> cost of our route to it when it was last touched
+        self._costs = {}
+
         # my info
         self._self = PeerInfo()
         self._self.id = router.network.id
@@ -107,7 +335,25 @@ class PeerManager(object):
         self._self.vip = util.encode_ip(router.network.ip)
         self._self.addr = '\x00'*router.addr_size # temp fake mac?
         self._self.port = router.network.wan_port
-        self._my_pickle = pickle.dumps(self._self,-1)
+
+        # pending announces, target peer id (or address) -> set of ids of
+        # the peers to announce.  flushed at most once per announce_delay
+        self._announces = {}
+        self._announce_call = None
+        self.announce_delay = settings.get_option(
+                        router.network.name + '/' + 'announce_delay', 0.2)
+        self.announce_stats = AnnounceStats()
+
+        # seconds between PX with every peer, to catch lost announces.
+        # after the first they only carry what changed.  0 turns it off
+        self.px_interval = settings.get_option(
+                        router.network.name + '/' + 'px_interval', 60)
+        self._px_lp = LoopingCall(self.refresh_px)
+
+        # peers that sent us pickles get pickles back
+        self._legacy = set()
+        self.legacy_format = settings.get_option(
+                        router.network.name + '/' + 'legacy_peer_format', False)
 
         self.router = util.get_weakref_proxy(router)
         self.sm = util.get_weakref_proxy(router.sm)
@@ -118,6 +364,8 @@ class PeerManager(object):
         router.register_handler(PacketType.REGISTER, self.handle_reg)
         router.register_handler(PacketType.REGISTER_ACK, self.handle_reg_ack)
         router.register_handler(PacketType.PEER_ANNOUNCE, self.handle_announce)
+        router.register_handler(PacketType.PEER_ANNOUNCE_BATCH,
+                                self.handle_announce_batch)
 
         event.register_handler('session-opened', None, self.do_session_opened)
         event.register_handler('session-closed', None, self.do_session_closed)
@@ -141,11 +389,14 @@ class PeerManager(object):
         logger.debug('do_session_closed:{0},{1}'.format(obj,sid.encode('hex')))
         if self.sm == obj:
             self.remove_peer(self.get(sid))
+            self._legacy.discard(sid)
+            # they may come back with a new table, and won't have ours
+            self._acked.pop(sid, None)
+            self._seen.pop(sid, None)
+            self.peer_map.pop(sid, None)
         
 
-    def _update_pickle(self):
-        self._my_pickle = pickle.dumps(self._self,-1)
-
+    def _update_self(self):
         # should announce my change to my peerz
         self.send_announce(self._self)
 
@@ -163,19 +414,27 @@ class PeerManager(object):
 
         logger.info('got the following direct_addresses: {0}'
                             .format(self._self.direct_addresses))
-        self._update_pickle()
+        self._update_self()
 
     def start(self):
         self.get_direct_addresses()
+        if self.px_interval > 0:
+            self._px_lp.start(self.px_interval, now=False)
+
+    def stop(self):
+        if self._px_lp.running:
+            self._px_lp.stop()
 
     def add_peer(self, peer):
         '''Add a peer connection'''
         if peer.id not in self.peer_list:
             if peer.relays > 0:
                 peer.is_direct = False
-                peer.relay_id = self[peer.address].id
+                if peer.relay_id not in self.peer_list:
+                    peer.relay_id = self[peer.address].id
                 #try to DC
-                reactor.callLater(1, self.sm.try_greet, peer.direct_addresses)
+                reactor.callLater(1, self.sm.try_greet, peer.direct_addresses,
+                                  peer.id)
             else:
                 peer.is_direct = True
                 peer.relay_id = None
@@ -183,24 +442,34 @@ class PeerManager(object):
                     peer.direct_addresses.append(peer.address)
 
             self.peer_list[peer.id] = peer
+            self._index(peer, self._index_keys(peer))
+            self._touch(peer.id)
+            if peer.is_direct:
+                changed = self.routes.set_link(peer.id, address=peer.address)
+            else:
+                changed = self.routes.advertise(peer.relay_id, peer.id,
+                                                peer.ping_time, peer.relays - 1)
             if peer.addr not in self.addr_map:
-                self.addr_map[peer.addr] = (peer.address, peer.id)
+                self.router.map_addr(peer.addr, peer.address, peer.id)
             elif peer.id != self.addr_map[peer.addr][1]:
                 # what if its here and has a diff id/addr? TODO
                 logger.critical('mac address collision between {0} and {1}'.format(
                             self.addr_map[peer.addr][1].encode('hex'),
                             peer.id.encode('hex') ))
-                self.addr_map[peer.addr] = (peer.address, peer.id)
+                self.router.map_addr(peer.addr, peer.address, peer.id)
             elif peer.address != self.addr_map[peer.addr][0]:
                 # what to do if the addresses are diff?
                 logger.critical('multiple addresses for mac:{0}'
                         .format(peer.addr_str))
-                self.addr_map[peer.addr] = (peer.address, peer.id)
+                self.router.map_addr(peer.addr, peer.address, peer.id)
 
             # fire event
             event.emit('peer-added', self, peer)
-            reactor.callLater(.1, self.send_announce, peer)
+            self.send_announce(peer)
             reactor.callLater(.1, self.try_px, peer)
+
+            # a new neighbor can be a better way to others
+            self._apply_routes(changed)
             
 #            self.send_announce(peer)
 #            self.try_px(peer)
@@ -208,11 +477,22 @@ class PeerManager(object):
     def remove_peer(self, peer):
         '''Remove a peer connection'''
         if peer is not None and peer.id in self.peer_list:
+            self._unindex(peer, self._index_keys(peer))
             del self.peer_list[peer.id]
+            self._touch(peer.id, removed=True)
+            changed = self.routes.forget(peer.id)
+            # the ones that still know it only send us changes, get their
+            # whole table next time so we can find another way there
+            for pid, their_map in self.peer_map.iteritems():
+                if peer.id in their_map:
+                    self._seen.pop(pid, None)
 
             # fire event
             event.emit('peer-removed', self, peer)
 
+            changed.discard(peer.id)
+            self._apply_routes(changed)
+
     def _timeout(self, peer):
         logger.warning('peer {0} on network {1} timed out'
                             .format(peer.name, self.router.network.name))
@@ -221,33 +501,19 @@ class PeerManager(object):
 
 
     def update_peer(self, opi, npi):
-        changed = False
-        if (opi.relays >= npi.relays and opi.address != npi.address):
-
-            logger.info('peer {0} relay changed: {1}->{2}, {3}->{4}'
-                              .format(opi.name, opi.relays,npi.relays,
-                                      opi.address, npi.address))
-
-            # point addr_map at better relay
-            self.addr_map[opi.addr] = (npi.address, npi.id)
-            #self.sm.session_map[npi.id] = npi.address
-            self.sm.update_map(npi.id, npi.address)
-
-            opi.address = npi.address
-            opi.relays = npi.relays
-            opi.is_direct = (opi.relays == 0)
-            if opi.is_direct > 0:
-                opi.relay_id = npi.relay_id
-            
-            changed = True
+        keys = self._index_keys(opi)
+        routes = self._learn_route(npi)
+        changed = self._reroute(opi) or self._cost_moved(opi.id)
+        routes.discard(opi.id)
 
         if opi.addr != npi.addr:
             logger.info('peer {0} addr changed: {1}->{2}'
                         .format(opi.name, opi.addr_str, npi.addr_str))
             # check for collision? TODO
             if opi.addr in self.addr_map:
-                self.addr_map[npi.addr] = self.addr_map[opi.addr]
-                del self.addr_map[opi.addr]
+                address, sid = self.addr_map[opi.addr][0:2]
+                self.router.unmap_addr(opi.addr)
+                self.router.map_addr(npi.addr, address, sid)
             opi.addr = npi.addr #todo check if this is None?
             changed = True
 
@@ -272,47 +538,318 @@ class PeerManager(object):
             logger.info('peer {0} good addresses changed: ({1})'
                 .format(opi.name, opi.direct_addresses))
             # try to DC
-            reactor.callLater(1, self.sm.try_greet, opi.direct_addresses)
+            reactor.callLater(1, self.sm.try_greet, opi.direct_addresses,
+                              opi.id)
+
+        self._reindex(opi, keys)
 
         if changed:
+            self._touch(opi.id)
             # fire event
             event.emit('peer-changed', self, opi)
             self.send_announce(opi)
 
+        # peers routed through opi
+        self._apply_routes(routes)
+
+    ###### Routing
+
+    def _learn_route(self, npi):
+        '''Put the path npi came in on into the routing table.  npi.address
+        is where it came from, npi.relay_id the peer that told us (if not
+        npi itself) and npi.relays/ping_time that peer's route to npi.
+        Returns the peers whose route changed.'''
+        hop = npi.relay_id
+        owner = self.get_by_address(npi.address)
+        if npi.relays == 0 and owner in (None, self.peer_list.get(npi.id)):
+            # it's a direct path
+            return self.routes.set_link(npi.id, address=npi.address)
+
+        if hop in (None, 0, npi.id) or hop not in self.peer_list:
+            # came through whoever is at address
+            if owner is None or owner.id == npi.id:
+                return set()
+            hop = owner.id
+        # the sender counted itself in relays
+        return self.routes.advertise(hop, npi.id, npi.ping_time,
+                                     max(npi.relays - 1, 0))
+
+    def _reroute(self, peer):
+        '''Point peer at its best route, returns True if that changed
+        anything.  The caller takes care of the indexes.'''
+        route = self.routes.best(peer.id)
+        if route is None:
+            return False
+        address = self.routes.link_address(route.hop)
+        if address is None or (address == peer.address and
+                               route.relays == peer.relays):
+            return False
+
+        logger.info('peer {0} route changed: {1} relays at {2} -> {3} '
+                    'relays at {4} ({5:.1f} ms)'
+                    .format(peer.name, peer.relays, peer.address,
+                            route.relays, address, route.cost * 1e3))
+
+        # point addr_map at the new next hop
+        self.router.map_addr(peer.addr, address, peer.id)
+        self.sm.update_map(peer.id, address)
+
+        peer.address = address
+        peer.relays = route.relays
+        peer.is_direct = (route.relays == 0)
+        peer.relay_id = None if peer.is_direct else route.hop
+        return True
+
+    def _apply_routes(self, pids):
+        '''Move the peers in pids to their best route'''
+        for pid in pids:
+            peer = self.peer_list.get(pid)
+            if peer is None:
+                continue
+            keys = self._index_keys(peer)
+            changed = self._reroute(peer)
+            if changed:
+                self._reindex(peer, keys)
+            if changed or self._cost_moved(pid):
+                self._touch(peer.id)
+                event.emit('peer-changed', self, peer)
+                self.send_announce(peer)
+
+    def set_ping_time(self, peer, dt):
+        '''A ping to peer took dt seconds.  For a direct peer that is the
+        cost of the link to it.'''
+        peer.ping_time = dt
+        if peer.is_direct and peer.id in self.peer_list:
+            self._apply_routes(self.routes.set_link(peer.id, dt))
+
+    def _split_horizon(self, peers, pid):
+        '''peers as sent to peer pid: the ones we reach through pid are
+        marked unreachable, so pid doesn't route them back through us, and
+        the rest carry the cost of our route as their ping_time'''
+        ret = []
+        for peer in peers:
+            route = self.routes.best(peer.id)
+            if peer.relay_id == pid and not peer.is_direct:
+                peer = copy.copy(peer)
+                peer.relays = 0xff
+            elif route is not None and route.cost != peer.ping_time:
+                # a relayed peer's ping goes wherever the relays send it,
+                # and a stale one would keep a loop alive
+                peer = copy.copy(peer)
+                peer.ping_time = route.cost
+            ret.append(peer)
+        return ret
+
+    def _cost_moved(self, pid):
+        '''True if the cost of our route to pid moved by more than the
+        switch margin since pid was last touched'''
+        route = self.routes.best(pid)
+        if route is None:
+            return False
+        old = self._costs.get(pid)
+        return old is None or \
+            abs(route.cost - old) > self.routes.SWITCH_MARGIN
+
+    def _index_keys(self, peer):
+        '''peer's keys, in the order of self._indexes (None if it isn't in
+        that index)'''
+        return (peer.vip, peer.addr, peer.name,
+                peer.address if peer.is_direct else None)
+
+    def _index(self, peer, keys):
+        for index, key in zip(self._indexes, keys):
+            if key is not None:
+                index.setdefault(key, []).append(peer)
+
+    def _unindex(self, peer, keys):
+        for index, key in zip(self._indexes, keys):
+            owners = index.get(key)
+            if owners is not None and peer in owners:
+                owners.remove(peer)
+                if len(owners) == 0:
+                    del index[key]
+
+    def _reindex(self, peer, keys):
+        '''Move peer from keys (_index_keys from before it changed) to its
+        current ones, if they differ'''
+        new = self._index_keys(peer)
+        if new != keys:
+            self._unindex(peer, keys)
+            self._index(peer, new)
+
+    def _touch(self, pid, removed=False):
+        '''Bump the table generation for a changed (or removed) peer'''
+        self.generation += 1
+        if removed:
+            self._costs.pop(pid, None)
+            self._changed.pop(pid, None)
+            self._removed[pid] = self.generation
+            if len(self._removed) > self.MAX_TOMBSTONES:
+                # whoever is further behind than this gets a full table
+                old = min(self._removed, key=self._removed.get)
+                self._full_before = self._removed.pop(old)
+        else:
+            route = self.routes.best(pid)
+            self._costs[pid] = route.cost if route is not None else None
+            self._removed.pop(pid, None)
+            self._changed[pid] = self.generation
+
+    def _delta(self, pid):
+        '''Encode the peer table changes peer pid hasn't acknowledged yet'''
+        since = self._acked.get(pid, 0)
+        if since < self._full_before:
+            since = 0
+        if since == 0:
+            peers = self.peer_list.values()
+            removed = []
+        else:
+            peers = [self.peer_list[x] for x, gen in self._changed.iteritems()
+                     if gen > since]
+            removed = [x for x, gen in self._removed.iteritems()
+                       if gen > since]
+        peers = self._split_horizon(peers, pid)
+        known = self._seen.get(pid, ('\x00'*4, 0))
+        return dump_delta(self.epoch, self.generation, since, known,
+                          peers, removed)
+
+    def _is_legacy(self, pid):
+        return self.legacy_format or pid in self._legacy
+
+    def _dump(self, obj, pid):
+        '''Encode a PeerInfo or the peer list in the format peer pid uses'''
+        if self._is_legacy(pid):
+            return pickle.dumps(obj, -1)
+        elif isinstance(obj, PeerInfo):
+            return dump_peer(obj)
+        else:
+            return dump_peer_list(obj.values())
+
+    def _load(self, packet, src_id, load):
+        '''Decode a PeerInfo or peer list with load, or from a pickle if
+        src_id is an old peer'''
+        if is_legacy(packet):
+            if src_id not in self._legacy:
+                logger.info('peer {0} uses the old (pickle) peer format'
+                            .format(src_id.encode('hex')))
+                self._legacy.add(src_id)
+            return load_legacy(packet)
+        self._legacy.discard(src_id)
+        return load(packet)
+
 
     ###### Announce Functions
 
     def send_announce(self, peer, address=None):
-        '''Send an announce about peer to all known connections'''
-        if peer.id != self._self.id:
-            peer.relays += 1 # inc relay so routing works right
-            peerkle = pickle.dumps(peer, -1)
-            peer.relays -= 1
+        '''Queue an announce about peer to all known connections (or just
+        address).  Announces are coalesced per target and sent by
+        _flush_announces, so repeated changes to a peer within
+        announce_delay go out once.'''
+        st = self.announce_stats
+        if address is not None:
+            targets = [address]
         else:
-            #peerkle = pickle.dumps(peer, -1)
-            peerkle = self._my_pickle
+            targets = [p.id for p in self.peer_list.values() if p.id != peer.id]
+
+        for target in targets:
+            pending = self._announces.setdefault(target, set())
+            if peer.id in pending:
+                st.suppressed += 1
+            else:
+                pending.add(peer.id)
+                st.queued += 1
+
+        if self._announces and self._announce_call is None:
+            self._announce_call = reactor.callLater(self.announce_delay,
+                                                    self._flush_announces)
+
+    def _flush_announces(self):
+        '''Send the pending announces, one packet per target'''
+        self._announce_call = None
+        announces, self._announces = self._announces, {}
+        st = self.announce_stats
+
+        records = {}
+        pickles = {}
+        for target, pids in announces.iteritems():
+            if isinstance(target, tuple):
+                tid = self.get(target)
+                tid = tid.id if tid is not None else None
+            elif target in self.peer_list:
+                tid = target
+            else:
+                # gone while it was pending
+                st.dropped += len(pids)
+                continue
+
+            peers = []
+            for pid in pids:
+                if pid == self._self.id:
+                    peers.append(self._self)
+                elif pid in self.peer_list and pid != tid:
+                    peers.append(self.peer_list[pid])
+                else:
+                    st.dropped += 1
+            if len(peers) == 0:
+                continue
+            peers = self._split_horizon(peers, tid)
+
+            # encoded once per flush (split horizon changes relays)
+            if self._is_legacy(tid):
+                # old peers only know single pickled announces
+                for peer in peers:
+                    key = (peer.id, peer.relays)
+                    if key not in pickles:
+                        pickles[key] = self._encode_announce(
+                                        peer, lambda p: pickle.dumps(p, -1))
+                    self.router.send(PacketType.PEER_ANNOUNCE,
+                                     pickles[key], target)
+                    st.packets += 1
+            else:
+                for peer in peers:
+                    key = (peer.id, peer.relays)
+                    if key not in records:
+                        records[key] = self._encode_announce(
+                                                        peer, _pack_record)
+                self.router.send(PacketType.PEER_ANNOUNCE_BATCH,
+                                 _VERSION + _COUNT.pack(len(peers))
+                                 + ''.join(records[(p.id, p.relays)]
+                                           for p in peers),
+                                 target)
+                st.packets += 1
+            st.sent += len(peers)
 
-        if address is not None:
-            self.router.send(PacketType.PEER_ANNOUNCE, peerkle, address)
             logger.info('sending announce about {0} to {1}'
-                            .format(peer.id.encode('hex'), address))
-        else:
-            for p in self.peer_list.values():
-                if p.id != peer.id:
-                    self.router.send(PacketType.PEER_ANNOUNCE, peerkle, p)
-                    logger.info('sending announce about {0} to {1}'
-                                    .format(peer.id.encode('hex'), 
-                                            p.id.encode('hex')))
+                        .format(', '.join(p.name for p in peers),
+                                tid.encode('hex') if tid else target))
 
+    def _encode_announce(self, peer, encode):
+        if peer.id == self._self.id:
+            return encode(peer)
+        peer.relays += 1 # inc relay so routing works right
+        try:
+            return encode(peer)
+        finally:
+            peer.relays -= 1
 
     def handle_announce(self, type, packet, address, src_id):
         logger.info('received an announce packet from {0}'.format(address))
         #packet = self.sm.decode(src_id, packet)
-        pi = pickle.loads(packet)
+        pi = self._load(packet, src_id, load_peer)
+        self._got_announce(pi, address, src_id)
+
+    def handle_announce_batch(self, type, packet, address, src_id):
+        logger.info('received an announce packet from {0}'.format(address))
+        self._legacy.discard(src_id)
+        for pi in load_peer_list(packet).values():
+            self._got_announce(pi, address, src_id)
+
+    def _got_announce(self, pi, address, src_id):
         pi.address = address
         pi.relay_id = src_id
         if pi.id != self._self.id:
-            if pi.id not in self.sm.session_map:
+            if pi.id not in self.peer_list and pi.relays > RoutingTable.MAX_RELAYS:
+                return      # they reach it through us
+            elif pi.id not in self.sm.session_map:
                 # init (relayed) handshake
                 self.sm.send_handshake(pi.id, address, pi.relays)
             elif pi.id not in self.peer_list:
@@ -327,7 +864,7 @@ class PeerManager(object):
     def try_px(self, peer):
         '''Initiate a peer exchange by sending a px packet.  The packet will be
         resent until an ack packet is recieved or MAX_PX_TRIES packets have been sent.
-        This px packet includes the pickled peer list.'''
+        This px packet includes the encoded peer list.'''
 
         logger.info('initiating a peer exchange with {0}'.format(peer.name))
 
@@ -336,7 +873,7 @@ class PeerManager(object):
             try:
                 logger.debug('sending PX packet #{0}'.format(i))
                 yield self.router.send(PacketType.PEER_XCHANGE, 
-                                    pickle.dumps(self.peer_list, -1), peer.id)
+                                    self._dump_px(peer.id), peer.id)
                 break            # success
             except Exception, e: # failed
                 i += 1
@@ -347,11 +884,20 @@ class PeerManager(object):
                                                 peer.id.encode('hex')))
 
 
+    def refresh_px(self):
+        '''PX with every direct peer.  Their tables cover the relayed ones,
+        and old peers are left out, they would get the whole table every
+        time.'''
+        for peer in self.peer_list.values():
+            if (peer.is_direct and peer.id in self.sm.session_map and
+                    not self._is_legacy(peer.id)):
+                self.try_px(peer)
+
     def handle_px(self, type, packet, address, src_id):
         '''Handle a peer exchange packet.  Load the peer list with the px packet
         and send an ack packet with own peer list.'''
 
-        peer_list = pickle.loads(packet)
+        px = self._load_px(packet, src_id)
 
         # reply
         logger.info('received a PX packet from {0}, sending PX ACK'.format(
@@ -359,10 +905,10 @@ class PeerManager(object):
         
         util.retry_func(self.router.send, 
                         (PacketType.PEER_XCHANGE_ACK, 
-                        pickle.dumps(self.peer_list,-1), src_id), dict(ack=True),
+                        self._dump_px(src_id), src_id), dict(ack=True),
                         delay=self.PX_TRY_DELAY)
         
-        self.parse_peer_list(self[src_id], peer_list)
+        self.parse_peer_list(self[src_id], *px)
 
 
     def handle_px_ack(self, type, packet, address, src_id):
@@ -373,22 +919,59 @@ class PeerManager(object):
         logger.info('received a PX ACK packet')
 
         #packet = self.sm.decode(src_id, packet)
-        peer_list = pickle.loads(packet)
-        self.parse_peer_list(self[src_id], peer_list)
+        px = self._load_px(packet, src_id)
+        self.parse_peer_list(self[src_id], *px)
+
+    def _dump_px(self, pid):
+        if self._is_legacy(pid):
+            return pickle.dumps(self.peer_list, -1)
+        return self._delta(pid)
+
+    def _load_px(self, packet, src_id):
+        '''Load a px packet, returns (peer_list, removed, full)'''
+        if is_legacy(packet):
+            return self._load(packet, src_id, load_legacy), [], True
+        self._legacy.discard(src_id)
+
+        epoch, gen, since, known, peer_list, removed = load_delta(packet)
+
+        # they have our table up to known, or nothing if we restarted since
+        self._acked[src_id] = known[1] if known[0] == self.epoch else 0
 
-    def parse_peer_list(self, from_peer, peer_list):
-        '''Parse a peer list from a px packet'''
+        # we have theirs up to gen, unless we missed the changes before since
+        seen_epoch, seen = self._seen.get(src_id, (None, 0))
+        if since == 0 or (seen_epoch == epoch and seen >= since):
+            self._seen[src_id] = (epoch, gen)
 
-        self.peer_map[from_peer.id] = peer_list
+        logger.debug('PX from {0}: generation {1} since {2}, {3} changed, '
+                     '{4} removed'.format(src_id.encode('hex'), gen, since,
+                                          len(peer_list), len(removed)))
+        return peer_list, removed, since == 0
+
+    def parse_peer_list(self, from_peer, peer_list, removed=(), full=True):
+        '''Parse a peer list (or the changes to one) from a px packet'''
+
+        if full or from_peer.id not in self.peer_map:
+            self.peer_map[from_peer.id] = peer_list
+        else:
+            their_map = self.peer_map[from_peer.id]
+            their_map.update(peer_list)
+            for pid in removed:
+                their_map.pop(pid, None)
+                # they can't get there any more
+                self._apply_routes(self.routes.advertise(
+                        from_peer.id, pid, 0, RoutingTable.MAX_RELAYS + 1))
 
         for peer in peer_list.values():
             if peer.id != self._self.id:
                 peer.relays += 1
                 peer.address = from_peer.address
-                #peer.relay_address = from_peer.id
+                peer.relay_id = from_peer.id
 
                 if peer.id in self.peer_list:
                     self.update_peer(self.peer_list[peer.id],peer)
+                elif peer.relays > RoutingTable.MAX_RELAYS:
+                    continue    # they reach it through us
                 elif peer.id not in self.sm.session_map:
                     self.sm.send_handshake(peer.id, peer.address, peer.relays)
                 elif peer.id not in self.peer_list:
@@ -416,14 +999,16 @@ class PeerManager(object):
 
         if (pid not in self.peer_list):
             # TODO set relay
-            self._self.relays = relays
-            packet = pickle.dumps(self._self, -1)
-            self._self.relays = 0
-            
             for i in range(self.MAX_REG_TRIES):
                 if pid in self.peer_list:
                     defer.returnValue(self.peer_list[pid])
                 else:
+                    # re-encoded each try, an old peer's REG may have
+                    # arrived in the meantime
+                    self._self.relays = relays
+                    packet = self._dump(self._self, pid)
+                    self._self.relays = 0
+
                     logger.debug('sending REG packet #{0}'.format(i))
                     self.router.send(PacketType.REGISTER, packet, addr)
                     yield util.sleep(self.REG_TRY_DELAY)
@@ -444,7 +1029,7 @@ class PeerManager(object):
             for pid in self.router.network.known_addresses:
                 if pid not in self:
                     addrs = self.router.network.known_addresses[pid]
-                    self.sm.try_greet(addrs)
+                    self.sm.try_greet(addrs, pid)
 
         # re-schedule
         interval = settings.get_option(self.router.network.name + 
@@ -459,7 +1044,7 @@ class PeerManager(object):
 
         logger.info('received REG packet, sending ACK')
 
-        pi = pickle.loads(packet)
+        pi = self._load(packet, src_id, load_peer)
         if pi.id == self._self.id:
             # we sent a reg to ourself?
             logger.warning('we recieved a reg from ourself...')
@@ -475,7 +1060,7 @@ class PeerManager(object):
 
         # TODO set relay
         self._self.relays = pi.relays
-        packet = pickle.dumps(self._self, -1)
+        packet = self._dump(self._self, src_id)
         self._self.relays = 0
 
         # wait until they get ours
@@ -488,7 +1073,7 @@ class PeerManager(object):
         logger.info('received REG ACK packet')
 
         #packet = self.sm.decode(src_id, packet)
-        pi = pickle.loads(packet)
+        pi = self._load(packet, src_id, load_peer)
 
         if pi.id == self._self.id:
             # yea yea...
@@ -509,37 +1094,29 @@ class PeerManager(object):
         '''Get a peer connection by peer name'''
         if name == self._self.name:
             return self._self
-        for p in self.peer_list.values():
-            if p.name == name:
-                return p
-        return None
+        owners = self._by_name.get(name)
+        return owners[-1] if owners else None
 
     def get_by_vip(self, vip):
         '''Get a peer connection by virtual ip'''
         if vip == self._self.vip:
             return self._self
-        for p in self.peer_list.values():
-            if p.vip == vip:
-                return p
-        return None
+        owners = self._by_vip.get(vip)
+        return owners[-1] if owners else None
 
     def get_by_addr(self, addr):
         '''Get a peer connection by mac or vip address'''
         if addr == self._self.addr:
             return self._self
-        for p in self.peer_list.values():
-            if p.addr == addr:
-                return p
-        return None
+        owners = self._by_addr.get(addr)
+        return owners[-1] if owners else None
 
     def get_by_address(self, address):
         '''Get a peer connection by real (ip,port)'''
         if address == self._self.address:
             return self._self
-        for p in self.peer_list.values():
-            if p.address == address and p.is_direct:
-                return p
-        return None
+        owners = self._by_address.get(address)
+        return owners[-1] if owners else None
 
     def iterkeys(self):
         for peer in self.peer_list:
@@ -119,6 +119,39 @@ class FilterLogger(logging.Logger):
                 pass
             logging.Logger.critical(self, fmt, **kwargs)
 
+def _noop(*args, **kwargs):
+    pass
+
+_data_path_logs = []
+
+class DataPathLog(object):
+    '''
+        trace/debug for code that runs for every packet.  Instead of checking
+        the level on every call, trace and debug are bound to the logger's
+        methods or to a no-op.  rebind_data_path() rebinds them, it is called
+        when a router is built and when the level is changed through
+        Interface.log_level.
+
+        Arguments are still evaluated, so use cheap ones (or format specs
+        like {0!r}), or check .tracing/.debugging first.
+    '''
+    def __init__(self, logger):
+        self.logger = logger
+        self.rebind()
+        _data_path_logs.append(self)
+
+    def rebind(self):
+        level = global_logger.level
+        self.tracing = level <= 5
+        self.debugging = level <= logging.DEBUG
+        self.trace = self.logger.trace if self.tracing else _noop
+        self.debug = self.logger.debug if self.debugging else _noop
+
+def rebind_data_path():
+    '''rebind DataPathLogs to the current level'''
+    for log in _data_path_logs:
+        log.rebind()
+
 def short():
     '''switch to short logging format'''
     logging.getLogger().handlers[0].setFormatter(
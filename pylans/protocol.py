@@ -1,12 +1,24 @@
 from twisted.internet import reactor, defer
 from twisted.internet import protocol
+from twisted.internet import udp
 from twisted.protocols import basic
+from platform import system
+import errno
 import logging
+import socket
 import struct
 
 from . import util
+from .net import mmsg
+from .plogging import DataPathLog
 
 logger = logging.getLogger(__name__)
+dlog = DataPathLog(logger)
+
+# linux socket options for the don't fragment bit, missing from python 2
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IPV6_MTU_DISCOVER = getattr(socket, 'IPV6_MTU_DISCOVER', 23)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
 
 
 class UDPPeerProtocol(protocol.DatagramProtocol):
@@ -14,28 +26,170 @@ class UDPPeerProtocol(protocol.DatagramProtocol):
 
     def __init__(self, recv_cb):
         self.recv = recv_cb
+        # datagrams that failed to send
+        self.dropped = 0
+        # dst id -> next hop address, for packets we only pass along.  kept
+        # up to date by the SessionManager
+        self.relay_table = {}
+        self.relayed = 0
+        self.relayed_bytes = 0
+        self.relay_loops = 0
 
     def send(self, data, address):
         '''Send data to address'''
         try:
-            logger.trace('sending {1} bytes on UDP port to {0}',
+            dlog.trace('sending {1} bytes on UDP port to {0}',
                             address, len(data))
             self.transport.write(data, address)
             
         except Exception, e:
+            self.dropped += 1
             logger.warning('UDP send threw exception:\n  {0}', e)
             ##TODO this is here because UDP socket fills up and just dies
             # but it's UDP so we can drop packets
 
+    # can send_df set the don't fragment bit
+    df_available = system() == 'Linux'
+
+    def send_df(self, data, address):
+        '''Send data to address with the don't fragment bit set, so it is
+        dropped instead of fragmented if it doesn't fit the path'''
+        sock = self.transport.socket
+        if sock.family == socket.AF_INET6:
+            level, opt = socket.IPPROTO_IPV6, IPV6_MTU_DISCOVER
+        else:
+            level, opt = socket.IPPROTO_IP, IP_MTU_DISCOVER
+        old = sock.getsockopt(level, opt)
+        sock.setsockopt(level, opt, IP_PMTUDISC_DO)
+        try:
+            self.transport.write(data, address)
+        except Exception, e:
+            # bigger than a path mtu the kernel already knows
+            logger.debug('UDP send with DF threw exception: {0}', e)
+        finally:
+            sock.setsockopt(level, opt, old)
+
     def datagramReceived(self, data, address):
         '''Called by twisted when data is received from address'''
+        # transit packets go straight back out, without the router
+        hop = self.relay_table.get(data[4:20])
+        if hop is not None:
+            return self.relay(data, address, hop)
         self.recv(data, address)
-        logger.trace('received {1} bytes on UDP port from {0}',
+        dlog.trace('received {1} bytes on UDP port from {0}',
                         address, len(data))
 
+    def relay(self, data, address, hop):
+        '''Pass a packet from address on to the next hop'''
+        if hop == address:
+            # they think we're the way there, and we think they are
+            self.relay_loops += 1
+            return
+        self.relayed += 1
+        self.relayed_bytes += len(data)
+        self.send(data, hop)
+
     def connectionRefused(self):
         logger.warning('connectionRefused on UDP port')
 
+    def send_many(self, datas, address):
+        '''Send a list of datagrams to address'''
+        send = self.send
+        for data in datas:
+            send(data, address)
+
+    def listen(self, port):
+        '''Start listening on UDP port, return the twisted port'''
+        return reactor.listenUDP(port, self)
+
+
+class MMsgUDPPort(udp.Port):
+    '''UDP port that reads bursts of datagrams with recvmmsg'''
+
+    def __init__(self, port, proto, vlen=32, **kwargs):
+        udp.Port.__init__(self, port, proto, **kwargs)
+        self.vlen = vlen
+        self.mmsg = None
+
+    def startListening(self):
+        udp.Port.startListening(self)
+        self.mmsg = mmsg.MMsg(self.fileno(), self.vlen, self.maxPacketSize,
+                              self.addressFamily)
+
+    def doRead(self):
+        '''Called when the socket is ready for reading'''
+        read = 0
+        while read < self.maxThroughput:
+            try:
+                datagrams = self.mmsg.recv()
+            except OSError, e:
+                if e.errno in (errno.EINTR, errno.ECONNREFUSED):
+                    return
+                raise
+
+            if len(datagrams) == 0:
+                return
+
+            for data, addr in datagrams:
+                read += len(data)
+            self.protocol.datagramsReceived(datagrams)
+
+
+class MMsgUDPPeerProtocol(UDPPeerProtocol):
+    '''Protocol for sending/receiving data to peers, batching syscalls with
+    sendmmsg/recvmmsg (linux only)'''
+
+    available = mmsg.available
+
+    def __init__(self, recv_cb, recv_many_cb, vlen=32):
+        UDPPeerProtocol.__init__(self, recv_cb)
+        self.recv_many = recv_many_cb
+        self.vlen = vlen
+
+    def send_many(self, datas, address):
+        '''Send a list of datagrams to address with one syscall'''
+        try:
+            dlog.trace('sending {1} datagrams on UDP port to {0}',
+                            address, len(datas))
+            sent = self.transport.mmsg.send(datas, address)
+            self.dropped += len(datas) - sent
+
+        except Exception, e:
+            self.dropped += len(datas)
+            logger.warning('UDP sendmmsg threw exception:\n  {0}', e)
+            # UDP, so we can drop packets
+
+    def datagramsReceived(self, datagrams):
+        '''Called by MMsgUDPPort with a list of (data, address)'''
+        table = self.relay_table
+        if table:
+            # pull out transit packets, and send them on per next hop
+            ours = []
+            hops = {}
+            for data, address in datagrams:
+                hop = table.get(data[4:20])
+                if hop is None:
+                    ours.append((data, address))
+                elif hop == address:
+                    self.relay_loops += 1
+                else:
+                    hops.setdefault(hop, []).append(data)
+            for hop, datas in hops.iteritems():
+                self.relayed += len(datas)
+                self.relayed_bytes += sum(map(len, datas))
+                self.send_many(datas, hop)
+            datagrams = ours
+
+        if datagrams:
+            self.recv_many(datagrams)
+        dlog.trace('received {0} datagrams on UDP port', len(datagrams))
+
+    def listen(self, port):
+        '''Start listening on UDP port, return the twisted port'''
+        p = MMsgUDPPort(port, self, vlen=self.vlen, reactor=reactor)
+        p.startListening()
+        return p
+
 
 class TCPPeerProtocol(basic.Int32StringReceiver):
     _type = 'TCP'
@@ -61,12 +215,12 @@ class TCPPeerProtocol(basic.Int32StringReceiver):
 
     def send(self, data):
         self.transport.write(struct.pack('!i',len(data))+data)
-        logger.trace('sending {0} bytes on {1} port'
+        dlog.trace('sending {0} bytes on {1} port'
                         , len(data), self._type)
         
 #    def dataReceived(self, data):
     def stringReceived(self, data):
-        logger.trace('received {0} bytes on {1} port'
+        dlog.trace('received {0} bytes on {1} port'
                         , len(data), self._type)
         self.recv(data, self._peer)
         
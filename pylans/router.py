@@ -26,19 +26,28 @@
 import logging
 import random
 from struct import pack, unpack
+from time import time
 import tuntap
 from tuntap.twisted import TwistedTunTap
 from twisted.internet import reactor, defer
 
 from . import util
+from .util import event
 from .util.event import Event
 from .packets import PacketType
+from .crypto.crypto import AuthenticationError
 from .peers import PeerManager
 from .mods.pinger import Pinger
+from .mods.pmtu import PMTUProber
 from . import sessions
 from . import settings
+from . import protocol
+from .stats import NetworkStats
+from .plogging import DataPathLog, rebind_data_path
 
 logger = logging.getLogger(__name__)
+# for per packet code
+dlog = DataPathLog(logger)
 
 PacketType.add(
     DATA=1,
@@ -56,16 +65,25 @@ class Router(object):
 
     Packet format: TBD"""
     __version__ = pack('!H', 2)
+    # handshake1 with a cipher suite list
+    __suite_version__ = pack('!H', 3)
 
     TIMEOUT = 5  # 5s
 
     # USER = 0x80
 
     def __init__(self, network, tuntap=None):
+        # bind data path logging to the configured level
+        rebind_data_path()
+
         if tuntap is None and settings.tap_access:
             mode = network.adapter_mode
+            # max # of frames to read from tun/tap per reactor wakeup
+            burst = settings.get_option(network.name + '/' + 'read_burst', 1)
             try:
-                tuntap = TwistedTunTap(self.send_packet, mode=mode)
+                tuntap = TwistedTunTap(self.send_packet,
+                                       burst_callback=self.send_packets,
+                                       burst_size=burst, mode=mode)
 
                 logger.info('Initializing router in {0} mode.',
                             'TAP' if tuntap.is_tap else 'TUN')
@@ -76,7 +94,27 @@ class Router(object):
 
         self.handlers = {}
         self._requested_acks = {}
+        # mac -> (address, sid, data header), change with map_addr()
         self.addr_map = {}
+        # sid -> set of macs routed to it in addr_map
+        self.sid_addrs = {}
+        # sid -> precomputed DATA header
+        self._headers = {}
+
+        # addr_map entry -> DATA packets waiting for the pool, see send()
+        self._batches = {}
+        self._batch_call = None
+
+        # preallocated buffer for the data send path
+        self._sbuf = bytearray(0x10000)
+        self._sview = memoryview(self._sbuf)
+
+        # copies of packet payloads made by the router (not by the cipher)
+        self.copies = 0
+        self.bytes_copied = 0
+
+        # per network/session packet counters, see get_stats()
+        self.stats = NetworkStats()
 
         # store weakref so we can be gc'd
         self.network = util.get_weakref_proxy(network)
@@ -90,14 +128,29 @@ class Router(object):
             self.sm = sessions.TCPSessionManager(self)
         else:
             logger.info('network {0} using UDP mode', self.network.name)
-            self.sm = sessions.SessionManager(self)
+            proto = None
+            if settings.get_option(self.network.name + '/' + 'use_mmsg', False):
+                if protocol.MMsgUDPPeerProtocol.available:
+                    logger.info('network {0} using sendmmsg/recvmmsg',
+                                self.network.name)
+                    proto = protocol.MMsgUDPPeerProtocol(
+                        util.get_weakref_proxy(self.recv),
+                        util.get_weakref_proxy(self.recv_many))
+                else:
+                    logger.warning('sendmmsg/recvmmsg not available, '
+                                   + 'falling back to plain UDP')
+            self.sm = sessions.SessionManager(self, proto)
         self.pm = PeerManager(self)
 
+        event.register_handler('session-opened', None, self.do_session_opened)
+        event.register_handler('session-closed', None, self.do_session_closed)
+
         #        import watcher
         #        watcher.Watcher('session_map',self.sm.__dict__)
         #        watcher.Watcher('addr_map',self.__dict__)
         # move this out of router?TODO
         self.pinger = Pinger(self)
+        self.pmtu = PMTUProber(self)
 
         self._tuntap = tuntap
 
@@ -147,6 +200,7 @@ class Router(object):
 
         self._bootstrap.start()
         self.pinger.start()
+        self.pmtu.start()
         reactor.callLater(1, util.get_weakref_proxy(self.pm.try_old_peers))
 
     @defer.inlineCallbacks
@@ -154,7 +208,13 @@ class Router(object):
         """Stop the router.  Stops the tun/tap device and stops listening on the
         UDP port."""
         self.pinger.stop()
+        self.pmtu.stop()
+        self.pm.stop()
         self._bootstrap.stop()
+        if self._batch_call is not None:
+            self._batch_call.cancel()
+            self._batch_call = None
+            self._batches.clear()
 
         if self._tuntap is not None:
             self._tuntap.stop()
@@ -167,31 +227,156 @@ class Router(object):
 
         logger.info('router stopped')
 
+    def data_header(self, sid):
+        """Get the header for DATA packets to sid.  Data packets never ask
+        for acks, so the header only depends on the session and is packed
+        once instead of for every packet."""
+        hdr = self._headers.get(sid)
+        if hdr is None:
+            hdr = pack('!2H', PacketType.DATA, 0) + sid + self.pm._self.id
+            self._headers[sid] = hdr
+        return hdr
+
+    def addr_entry(self, address, sid):
+        """Make an addr_map value for a peer reached through address"""
+        return (address, sid, self.data_header(sid))
+
+    def map_addr(self, addr, address, sid):
+        """Route addr (mac or vip) to session sid, reached through
+        address"""
+        self.unmap_addr(addr)
+        self.addr_map[addr] = self.addr_entry(address, sid)
+        self.sid_addrs.setdefault(sid, set()).add(addr)
+
+    def unmap_addr(self, addr):
+        entry = self.addr_map.pop(addr, None)
+        if entry is not None:
+            addrs = self.sid_addrs.get(entry[1])
+            if addrs is not None:
+                addrs.discard(addr)
+                if len(addrs) == 0:
+                    del self.sid_addrs[entry[1]]
+
+    def unmap_sid(self, sid):
+        """Remove the routes to session sid, returns the addrs removed"""
+        addrs = self.sid_addrs.pop(sid, ())
+        for addr in addrs:
+            del self.addr_map[addr]
+        return addrs
+
+    def do_session_opened(self, obj, sid, relays):
+        if self.sm == obj:
+            self.data_header(sid)
+
+    def do_session_closed(self, obj, sid):
+        if self.sm == obj:
+            if sid in self._headers:
+                del self._headers[sid]
+            self.stats.close(sid)
+
+    def get_stats(self):
+        """Get a dict of the network's counters, the totals plus:
+
+        peers: per-session counters, by sid
+        drops: dropped packets, by reason
+        announces: the announce scheduler's counters
+        handshakes: admission counters, with current and queued counts
+        pmtu: the path mtu to each session, by sid"""
+        st = self.stats
+        proto = getattr(self.sm, 'proto', None)
+        ret = st.totals().as_dict()
+        # relays by the protocol's fast path, and by relay() (tcp)
+        ret['relays'] = st.relays + getattr(proto, 'relayed', 0)
+        ret['relay_bytes'] = getattr(proto, 'relayed_bytes', 0)
+        ret['drops'] = {
+            'unknown_dest': st.unknown_dest,
+            'unknown_session': st.unknown_session,
+            'replayed': st.replayed,
+            'auth_failed': st.auth_failed,
+            'send_failed': getattr(proto, 'dropped', 0),
+            'relay_loop': getattr(proto, 'relay_loops', 0),
+            'pipeline_full': (self.sm.pipeline.dropped
+                              if self.sm.pipeline is not None else 0),
+        }
+        ret['peers'] = dict((sid, peer.as_dict())
+                            for sid, peer in st.peers.iteritems())
+        ret['announces'] = self.pm.announce_stats.as_dict()
+        ret['pmtu'] = dict(self.pmtu.pmtu)
+        admission = getattr(self.sm, 'admission', None)
+        if admission is not None:
+            hs = ret['handshakes'] = admission.stats.as_dict()
+            hs['shaking'] = admission.shaking
+            hs['waiting'] = admission.depth
+        return ret
+
     def relay(self, data, dst):
+        """Pass on a packet for another peer.  Over udp, the protocol does
+        this itself from SessionManager.relay_table, so only tcp packets
+        (and ones for unknown sessions) get here."""
         if dst in self.sm.session_map:
-            logger.trace('relaying packet to {0}', repr(dst))
+            dlog.trace('relaying packet to {0!r}', dst)
+            self.stats.relays += 1
             self.sm.send(data, dst, self.sm.session_map[dst])
 
     def send(self, type, data, dst, ack=False, id=0, ack_timeout=None,
-             clear=False, faddress=None):
+             clear=False, faddress=None, df=False):
         """Send a packet of type with data to address.  Address should be an id
-        if the peer is known, since address tuples aren't unique with relaying
+        if the peer is known, since address tuples aren't unique with relaying.
+        df sets the don't fragment bit, see SessionManager.send_df.
 
         Return deferred for supporting acks
         """
         # shortcut for data, to speed up teh BWs
         if type == PacketType.DATA:
-            dst_id = dst[1]
-            dst = dst[0]
+            if dst[1] in self.sm.pipelined:
+                # one pool job per destination per reactor turn
+                batch = self._batches.get(dst)
+                if batch is None:
+                    batch = self._batches[dst] = []
+                    if self._batch_call is None:
+                        self._batch_call = reactor.callLater(
+                            0, self._send_batches)
+                batch.append(data)
+                return
+            dst, dst_id, hdr = dst
+
+            if self.sm.zero_copy:
+                # encrypt straight into the send buffer behind the header
+                buf = self._sbuf
+                buf[0:36] = hdr
+                t = time()
+                try:
+                    end = self.sm.encode_into(dst_id, data, buf, 36)
+                except (sessions.UnknownSessionError, KeyError), s:
+                    self.stats.unknown_session += 1
+                    logger.critical('failed to encode data packet: {0}', s)
+                    return  # TODO
+                st = self.stats.peer(dst_id)
+                st.encrypt_time += time() - t
+                st.packets_out += 1
+                st.bytes_out += len(data)
+                self.copies += 1
+                self.bytes_copied += end - 36
+                return self.sm.send(self._sview[:end], dst_id, dst)
+
             # encode
+            t = time()
             try:
+                n = len(data)
                 data = self.sm.encode(dst_id, data)
-            except KeyError, s:
+            except (sessions.UnknownSessionError, KeyError), s:
+                self.stats.unknown_session += 1
                 logger.critical('failed to encode data packet: {0}', s)
                 return  # TODO
+            st = self.stats.peer(dst_id)
+            st.encrypt_time += time() - t
+            st.packets_out += 1
+            st.bytes_out += n
 
             # pack
-            data = pack('!2H', type, id) + dst_id + self.pm._self.id + data
+            data = hdr + data
+            self.copies += 2  # ciphertext + iv, header + data
+            self.bytes_copied += 2 * len(data) - 36
             # send
             return self.sm.send(data, dst_id, dst)
 
@@ -257,10 +442,59 @@ class Router(object):
                          type, dst, dst_id.encode('hex'))
 
         data = pack('!2H', type, id) + dst_id + self.pm._self.id + data
-        self.sm.send(data, dst_id, dst)
+        if df:
+            self.sm.send_df(data, dst_id, dst)
+        else:
+            self.sm.send(data, dst_id, dst)
 
         return d
 
+    def _send_batches(self):
+        batches, self._batches = self._batches, {}
+        self._batch_call = None
+        for dst, packets in batches.iteritems():
+            self.send_data(packets, dst)
+
+    def send_data(self, packets, dst):
+        """Send a burst of data packets to one destination.  dst is an
+        (address, sid, header) tuple like the values in addr_map.  The session
+        is resolved once for the whole burst."""
+        address, dst_id, hdr = dst
+
+        def do_send(packets):
+            out = []
+            n = 0
+            for data in packets:
+                data = hdr + data
+                n += len(data)
+                out.append(data)
+            self.copies += len(out)
+            self.bytes_copied += n
+            self.sm.send_many(out, dst_id, address)
+
+        count, size = len(packets), sum(map(len, packets))
+        t = time()
+        pipelined = dst_id in self.sm.pipelined
+        try:
+            if pipelined:
+                # encrypted off the reactor, sent when it comes back
+                self.sm.encode_async(dst_id, packets, do_send)
+            else:
+                packets = self.sm.encode_many(dst_id, packets)
+        except (sessions.UnknownSessionError, KeyError), s:
+            self.stats.unknown_session += count
+            logger.critical('failed to encode data packets: {0}', s)
+            return  # TODO
+
+        st = self.stats.peer(dst_id)
+        st.packets_out += count
+        st.bytes_out += size
+        if pipelined:
+            return
+        st.encrypt_time += time() - t
+
+        do_send(packets)
+
     def handle_ack(self, type, data, address, src):
         """called when we get an ack packet"""
         id = unpack('!H', data)[0]
@@ -286,6 +520,13 @@ class Router(object):
         """Got a packet from the tun/tap device that needs to be sent out"""
         pass
 
+    def send_packets(self, packets):
+        """Got a burst of packets from the tun/tap device that need to be sent
+        out"""
+        send_packet = self.send_packet
+        for packet in packets:
+            send_packet(packet)
+
     def recv(self, data, address):
         """Received a packet from the protocol port.
         Parse it and send it on its way.
@@ -303,12 +544,55 @@ class Router(object):
 
             if pt == PacketType.DATA:
                 # data packets are always encrypted
-                packet = self.sm.decode(src, data[36:])
+                if not self.sm.fresh(src, data):
+                    self.stats.replayed += 1
+                    return
+                if src in self.sm.pipelined:
+                    # the aead backends want a real str
+                    self.copies += 1
+                    self.bytes_copied += len(data) - 36
+
+                    def deliver(packets):
+                        if packets[0] is None or packets[0] is False:
+                            self._drop_failed(packets, [address])
+                            return
+                        self._count_in(src, packets)
+                        self.recv_packet(packets[0], src, address)
+                    try:
+                        self.sm.decode_async(src, [data[36:]], deliver)
+                    except (sessions.UnknownSessionError, KeyError):
+                        self.stats.unknown_session += 1
+                    return
+
+                # decrypt straight from the datagram, no slice copy
+                t = time()
+                try:
+                    packet = self.sm.decode(src, buffer(data, 36))
+                except (sessions.UnknownSessionError, KeyError):
+                    self.stats.unknown_session += 1
+                    return
+                except AuthenticationError:
+                    self.stats.auth_failed += 1
+                    return
+                st = self.stats.peer(src)
+                st.decrypt_time += time() - t
+                st.packets_in += 1
+                st.bytes_in += len(packet)
                 self.recv_packet(packet, src, address)
 
             else:
                 if pt == PacketType.ENCODED:
-                    packet = self.sm.decode(src, data[36:])
+                    if not self.sm.fresh(src, data):
+                        self.stats.replayed += 1
+                        return
+                    try:
+                        packet = self.sm.decode(src, data[36:])
+                    except (sessions.UnknownSessionError, KeyError):
+                        self.stats.unknown_session += 1
+                        return
+                    except AuthenticationError:
+                        self.stats.auth_failed += 1
+                        return
                     pt, packet = unpack('!H', packet[:2])[0], packet[2:]
                 else:
                     packet = data[36:]
@@ -341,10 +625,106 @@ class Router(object):
         else:
             return self.relay(data, dst)
 
+    def recv_many(self, packets):
+        """Received a burst of (data, address) packets from the protocol port.
+        Data packets for us are grouped by source session and decoded together,
+        everything else goes through recv().  Order is kept within a session.
+        """
+        my_id = self.pm._self.id
+        recv_packet = self.recv_packet
+        fresh = self.sm.fresh
+        pipelined = self.sm.pipelined
+        groups = {}
+        order = []
+
+        def deliver(datas, src, addrs):
+            for packet, address in zip(datas, addrs):
+                recv_packet(packet, src, address)
+
+        def deliver_async(datas, src, addrs):
+            if None in datas or False in datas:
+                datas, addrs = self._drop_failed(datas, addrs)
+            self._count_in(src, datas)
+            deliver(datas, src, addrs)
+
+        def flush():
+            for src in order:
+                datas, addrs = groups[src]
+                t = time()
+                try:
+                    if src in pipelined:
+                        self.sm.decode_async(src, datas,
+                            lambda datas, src=src, addrs=addrs:
+                                deliver_async(datas, src, addrs))
+                        continue
+                    datas = self.sm.decode_many(src, datas)
+                except (sessions.UnknownSessionError, KeyError), e:
+                    self.stats.unknown_session += len(datas)
+                    logger.warning('dropping {0} data packets: {1}',
+                                   len(datas), e)
+                    continue
+                if None in datas or False in datas:
+                    datas, addrs = self._drop_failed(datas, addrs)
+                st = self.stats.peer(src)
+                st.decrypt_time += time() - t
+                st.packets_in += len(datas)
+                st.bytes_in += sum(map(len, datas))
+                deliver(datas, src, addrs)
+            groups.clear()
+            del order[:]
+
+        for data, address in packets:
+            if (data[4:20] == my_id and
+                    unpack('!H', data[:2])[0] == PacketType.DATA):
+                src = data[20:36]
+                if not fresh(src, data):
+                    self.stats.replayed += 1
+                    continue
+                if src not in groups:
+                    groups[src] = ([], [])
+                    order.append(src)
+                group = groups[src]
+                if src in pipelined:
+                    # the aead backends want a real str
+                    group[0].append(data[36:])
+                    self.copies += 1
+                    self.bytes_copied += len(data) - 36
+                else:
+                    group[0].append(buffer(data, 36))
+                group[1].append(address)
+            else:
+                # keep control packets in order wrt the data around them
+                flush()
+                self.recv(data, address)
+
+        flush()
+
     def recv_packet(self, packet, address):
         """Got a data packet from a peer, need to inject it into tun/tap"""
         pass
 
+    def _drop_failed(self, datas, addrs):
+        """Filter the packets that failed authentication (None) and the
+        replays (False) out of a decoded burst, returns the (datas, addrs)
+        left"""
+        keep = []
+        for i, data in enumerate(datas):
+            if data is None:
+                self.stats.auth_failed += 1
+            elif data is False:
+                self.stats.replayed += 1
+            else:
+                keep.append(i)
+        return [datas[i] for i in keep], [addrs[i] for i in keep]
+
+    def _count_in(self, src, packets):
+        """Count data packets decoded on the crypto pipeline, unless the
+        session closed while they were in the pool."""
+        if src in self.sm.session_objs:
+            st = self.stats.peer(src)
+            st.packets_in += len(packets)
+            st.bytes_in += sum(map(len, packets))
+
     def register_handler(self, type, callback):
         """Register a handler for a specific packet type.  Handles will be
         called as 'callback(type, data, address, src_id)'."""
@@ -368,6 +748,7 @@ class TapRouter(Router):
     addr_size = 6
 
     __signature__ = 'PVA' + Router.__version__
+    __suite_signature__ = 'PVA' + Router.__suite_version__
 
     def get_my_address(self, *x):  # TODO redo this
         """Get interface address (IP/MAC)"""
@@ -417,7 +798,7 @@ class TapRouter(Router):
         # if ip in peer list
         if dst in self.addr_map:
             self.send(PacketType.DATA, packet, self.addr_map[dst])
-            logger.trace('got a {0} byte packet on the TUN/TAP wire'
+            dlog.trace('got a {0} byte packet on the TUN/TAP wire'
                          , len(packet))
 
         # or if it's a broadcast
@@ -425,14 +806,45 @@ class TapRouter(Router):
             # logger.debug('sending broadcast packet')
             for addr in self.addr_map.values():
                 self.send(PacketType.DATA, packet, addr)
-            logger.trace('got a bcast packet on the TUN/TAP wire')
+            dlog.trace('got a bcast packet on the TUN/TAP wire')
 
         # if we don't have a direct connection...
         # elif dst in self.relay_map:
         #    self.send(self.DATA, packet, self.relay_map[dst])
         else:
-            logger.debug('got packet on wire to unknown destination: \
-                         {0}', dst.encode('hex'))
+            self.stats.unknown_dest += 1
+            if dlog.debugging:
+                dlog.debug('got packet on wire to unknown destination: \
+                           {0}', dst.encode('hex'))
+
+    def send_packets(self, packets):
+        """Got a burst of packets from the tun/tap device that need to be sent
+        out.  Packets are grouped by destination so each peer is resolved and
+        sent to once per burst."""
+        addr_size = self.addr_size
+        addr_map = self.addr_map
+        groups = {}
+
+        for packet in packets:
+            dst = packet[0:addr_size]
+
+            if dst in addr_map:
+                groups.setdefault(addr_map[dst], []).append(packet)
+
+            elif self._tuntap.is_broadcast(dst):
+                for addr in addr_map.values():
+                    groups.setdefault(addr, []).append(packet)
+
+            else:
+                self.stats.unknown_dest += 1
+                if dlog.debugging:
+                    dlog.debug('got packet on wire to unknown destination: \
+                               {0}', dst.encode('hex'))
+
+        dlog.trace('got a burst of {0} packets on the TUN/TAP wire for {1}'
+                     + ' destinations', len(packets), len(groups))
+        for dst, group in groups.iteritems():
+            self.send_data(group, dst)
 
     def recv_packet(self, packet, src, address):
         """Got a data packet from a peer, need to inject it into tun/tap"""
@@ -443,15 +855,15 @@ class TapRouter(Router):
         if dst == self.pm._self.addr or tuntap.TunTapBase.is_broadcast(dst):
             if self._tuntap is not None:
                 self._tuntap.doWrite(packet)
-                logger.trace('writing {0} byte packet to TUN/TAP wire',
+                dlog.trace('writing {0} byte packet to TUN/TAP wire',
                              len(packet))
             else:
-                logger.trace('got a tun/tap back but have no tun/tap, dropping')
+                dlog.trace('got a tun/tap back but have no tun/tap, dropping')
 
             # todo what to do about this
             src_addr = packet[self.addr_size:self.addr_size * 2]
             if src_addr not in self.addr_map:  # negligible speed hit
-                self.addr_map[src_addr] = (address, src)
+                self.map_addr(src_addr, address, src)
                 logger.warning('got new addr from packet!: {0} (for {1})'
                                , src_addr.encode('hex'), src.encode('hex'))
         else:
@@ -466,6 +878,7 @@ class TunRouter(Router):
     addr_size = 4
 
     __signature__ = 'PVU' + Router.__version__
+    __suite_signature__ = 'PVU' + Router.__suite_version__
 
     def get_my_address(self):
         """Get interface address (IP)"""
@@ -482,7 +895,7 @@ class TunRouter(Router):
             logger.critical('TUN adapater has no addresses')
             self.pm._self.addr = self.pm._self.vip
 
-        self.pm._update_pickle()
+        self.pm._update_self()
 
     def send_packet(self, packet):
         """Got a packet from the tun/tap device that needs to be sent out"""
@@ -494,8 +907,10 @@ class TunRouter(Router):
         if dst in self.addr_map:
             self.send(PacketType.DATA, packet, self.addr_map[dst])
         else:
-            logger.debug('got packet on wire to unknown destination: {0}'
-                         , dst.encode('hex'))
+            self.stats.unknown_dest += 1
+            if dlog.debugging:
+                dlog.debug('got packet on wire to unknown destination: {0}'
+                           , dst.encode('hex'))
 
     def recv_packet(self, packet):
         """Got a data packet from a peer, need to inject it into tun/tap"""
@@ -506,7 +921,7 @@ class TunRouter(Router):
             self._tuntap.doWrite(packet)
         else:
             self.send_packet(packet)
-            logger.debug('got packet with different dest ip, relay packet?')
+            dlog.debug('got packet with different dest ip, relay packet?')
 
 
 def get_router(net, *args, **kw):
@@ -0,0 +1,182 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# routing.py
+# per network routing table: candidate next hops for every destination, with
+# costs from measured round trip times and relay counts.
+#
+# Distance vector.  Neighbors (peers we have a direct path to) are links,
+# with the ping time to them as cost.  Every peer tells us its own cost and
+# relay count to the peers it knows (advertisements); a route to dst via
+# neighbor n costs link(n) + n's cost to dst.  Routes are recomputed only for
+# the destinations an event touches, and for the ones routed through those.
+
+
+class Route(object):
+    '''The chosen path to dst: send to neighbor hop, which is relays relays
+    away from dst.  via is the peer whose advertisement we use (dst itself
+    for a direct path), cost the estimated round trip time in seconds.'''
+    __slots__ = ('dst', 'hop', 'via', 'cost', 'relays')
+
+    def __init__(self, dst, hop, via, cost, relays):
+        self.dst = dst
+        self.hop = hop
+        self.via = via
+        self.cost = cost
+        self.relays = relays
+
+    @property
+    def metric(self):
+        return self.cost + RoutingTable.RELAY_COST * self.relays
+
+    def __eq__(self, other):
+        return (isinstance(other, Route) and
+                (self.dst, self.hop, self.via, self.cost, self.relays) ==
+                (other.dst, other.hop, other.via, other.cost, other.relays))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Route({0}, hop={1}, via={2}, cost={3:.4f}, relays={4})'.format(
+                    *[x.encode('hex')[:8] if isinstance(x, str) else x
+                      for x in (self.dst, self.hop, self.via, self.cost,
+                                self.relays)])
+
+
+class RoutingTable(object):
+    '''Candidate routes for every destination, and the cheapest of them.
+
+    Every method that changes the table returns the set of destinations
+    whose route changed.'''
+    # cost added per relay, so equal latencies prefer the shorter path
+    RELAY_COST = 0.001
+    # a route with more relays than this is treated as unreachable, which
+    # also ends count to infinity
+    MAX_RELAYS = 8
+    # only move to a new path with as many relays if it's this much (s)
+    # cheaper, so jitter in the ping times doesn't flap routes
+    SWITCH_MARGIN = 0.002
+
+    def __init__(self):
+        # neighbor id -> [cost, address]
+        self.links = {}
+        # neighbor id -> {dst: (cost, relays)}
+        self.adverts = {}
+        # dst -> Route
+        self.routes = {}
+
+    def best(self, dst):
+        return self.routes.get(dst)
+
+    def link_address(self, hop):
+        link = self.links.get(hop)
+        return link[1] if link is not None else None
+
+    def set_link(self, hop, cost=None, address=None):
+        '''Add or update the direct path to neighbor hop.  cost None keeps
+        the old cost (or 0, so a new link gets tried).'''
+        link = self.links.get(hop)
+        if link is None:
+            self.links[hop] = [cost or 0.0, address]
+        else:
+            if cost is not None:
+                link[0] = cost
+            if address is not None:
+                link[1] = address
+        return self._update([hop])
+
+    def advertise(self, hop, dst, cost, relays):
+        '''hop can reach dst with cost, relays relays away.  relays past
+        MAX_RELAYS withdraws it.'''
+        adverts = self.adverts.setdefault(hop, {})
+        if relays > self.MAX_RELAYS:
+            if adverts.pop(dst, None) is None:
+                return set()
+        elif adverts.get(dst) == (cost, relays):
+            return set()
+        else:
+            adverts[dst] = (cost, relays)
+        return self._update([dst])
+
+    def forget(self, peer):
+        '''Drop everything known about and from peer'''
+        self.links.pop(peer, None)
+        adverts = self.adverts.pop(peer, {})
+        for adv in self.adverts.values():
+            adv.pop(peer, None)
+        changed = self._update(adverts.keys() + [peer])
+        changed.add(peer)
+        self.routes.pop(peer, None)
+        return changed
+
+    def _update(self, dsts):
+        '''Recompute the routes to dsts, and to everything routed through a
+        destination whose route changed'''
+        changed = set()
+        queue = list(dsts)
+        # every pass can only add relays, MAX_RELAYS bounds the work
+        budget = (len(self.routes) + len(queue) + 1) * (self.MAX_RELAYS + 2)
+        while queue and budget > 0:
+            budget -= 1
+            dst = queue.pop()
+            if self._recompute(dst):
+                changed.add(dst)
+                queue.extend(self.adverts.get(dst, ()))
+        return changed
+
+    def _candidates(self, dst):
+        link = self.links.get(dst)
+        if link is not None:
+            yield Route(dst, dst, dst, link[0], 0)
+
+        for via, adverts in self.adverts.iteritems():
+            if via == dst or dst not in adverts:
+                continue
+            cost, relays = adverts[dst]
+            link = self.links.get(via)
+            if link is not None:
+                hop, base, base_relays = via, link[0], 0
+            else:
+                r = self.routes.get(via)
+                if r is None or r.hop == dst or r.via == dst:
+                    continue
+                hop, base, base_relays = r.hop, r.cost, r.relays + 1
+            relays += base_relays + 1
+            if relays <= self.MAX_RELAYS:
+                yield Route(dst, hop, via, base + cost, relays)
+
+    def _recompute(self, dst):
+        old = self.routes.get(dst)
+        best = None
+        current = None
+        for route in self._candidates(dst):
+            if best is None or route.metric < best.metric:
+                best = route
+            if old is not None and route.via == old.via:
+                current = route
+
+        if (current is not None and best is not current and
+                best.relays >= current.relays and
+                best.metric > current.metric - self.SWITCH_MARGIN):
+            # not enough of an improvement to move (a path with fewer relays
+            # always gets a go, a new link hasn't been measured yet)
+            best = current
+
+        if best is None:
+            return self.routes.pop(dst, None) is not None
+        self.routes[dst] = best
+        return best != old
@@ -31,7 +31,13 @@ else:
     from time import time
 
 from .. import util
-from ..crypto import Crypter, jpake
+from .. import settings
+from ..crypto import suites
+from ..crypto.crypto import AuthenticationError
+from ..crypto.jpake_pool import JPAKEPool
+from .admission import Admission
+from . import resume
+from ..crypto.pipeline import CryptoPipeline
 from ..peers import PeerInfo
 from .. import protocol
 from ..packets import PacketType
@@ -43,9 +49,25 @@ PacketType.add(
     HANDSHAKE1=15,
     HANDSHAKE2=16,
     HANDSHAKE3=17,
+    GREET_COOKIE=24,
+    RESUME=25,
+    RESUME_ACK=26,
+    RESUME_NAK=27,
+    REKEY=30,
+    REKEY_ACK=31,
     CLOSE=13)
 
 
+# features we tell peers about after a '.' in our J-PAKE signer id, which
+# older peers treat as opaque.  r: resumption, k: rekeying
+RESUME, REKEY = 'r', 'k'
+
+
+def signer_features(signer_id):
+    '''The features a peer's signer id says it has'''
+    return set(signer_id.partition('.')[2])
+
+
 class UnknownSessionError(Exception): pass
 
 
@@ -54,6 +76,17 @@ class ArgumentError(Exception): pass
 
 class SessionManager(object):
     HANDSHAKE_TIMEOUT = 3  # seconds
+    # seconds to wait for a rekey ack, and how many times to send it
+    REKEY_TIMEOUT = 1
+    REKEY_TRIES = 3
+    # seconds the old key still decrypts after a rekey
+    REKEY_GRACE = 30
+    # acked greets sent to each address in try_greet
+    GREET_TRIES = 3
+    # seconds between starting greets to successive addresses
+    GREET_STAGGER = 0.25
+    # send() is synchronous, so it can be passed a view of a reused buffer
+    zero_copy = True
 
     def __init__(self, router, proto=None):
 
@@ -62,19 +95,73 @@ class SessionManager(object):
 
         self.proto = proto
         self.port = None
+        # shared with a udp protocol, which relays by it without the router
+        self.relay_table = getattr(proto, 'relay_table', {})
 
         self.router = util.get_weakref_proxy(router)
         # sid -> encryption object
         self.session_objs = {}
         # sid -> address
         self.session_map = {}
-        # sid -> (nonce, relays, address) for handshake
+        # sid -> [Handshake, relays, address] for handshake
         self.shaking = {}
+        # sid -> negotiated cipher suite id
+        self.suites = {}
+        # sid -> both suite offers and the pick, hashed into handshake3
+        self.suite_offers = {}
         self.keep_alives = {}
+        # sid -> [secret, epoch, nonce] the current session key came from
+        self.keys = {}
+        # sid -> [epoch, secret, crypter, nonce, tries, timer] while we
+        # wait for a rekey ack
+        self.rekeying = {}
+        # peer id -> features from its signer id, kept for resumed sessions
+        self.features = {}
 
         self.id = self.router.network.id
 
+        # optional worker pool for bulk encrypt/decrypt
+        name = self.router.network.name
+        workers = settings.get_option(name + '/' + 'crypto_workers', 0)
+        if workers > 0:
+            self.pipeline = CryptoPipeline(workers)
+        else:
+            self.pipeline = None
+        # sids whose crypter releases the GIL, only they use the pipeline
+        self.pipelined = set()
+
+        # peer id -> resumption secret, for reconnecting without J-PAKE
+        self.tickets = resume.TicketCache(
+            settings.get_option(name + '/' + 'resume_tickets', 256),
+            settings.get_option(name + '/' + 'resume_lifetime', 3600))
+
+        # handshake math on its own pool, so bulk crypto doesn't queue it
+        self.jpake = JPAKEPool(
+            settings.get_option(name + '/' + 'handshake_workers', 1),
+            settings.get_option(name + '/' + 'jpake_precompute', 4),
+            tag='.' + (RESUME if self.tickets.size > 0 else '') + REKEY)
+
+        # caps on concurrent handshakes, and a queue for the rest
+        self.admission = Admission(util.get_weakref_proxy(self),
+            settings.get_option(name + '/' + 'max_handshakes', 16),
+            settings.get_option(name + '/' + 'handshake_queue', 64))
+
+        # cipher suites we offer in handshake1, in order of preference
+        self.suite_ids = suites.ids(settings.get_option(
+            name + '/' + 'cipher_suites', [suites.DEFAULT.name]))
+        if len(self.suite_ids) == 0:
+            logger.warning('no usable cipher suites configured, using {0}',
+                           suites.DEFAULT.name)
+            self.suite_ids = [suites.DEFAULT.id]
+
         router.register_handler(PacketType.GREET, self.handle_greet)
+        router.register_handler(PacketType.GREET_COOKIE,
+                                self.handle_greet_cookie)
+        router.register_handler(PacketType.RESUME, self.handle_resume)
+        router.register_handler(PacketType.RESUME_ACK, self.handle_resume_ack)
+        router.register_handler(PacketType.RESUME_NAK, self.handle_resume_nak)
+        router.register_handler(PacketType.REKEY, self.handle_rekey)
+        router.register_handler(PacketType.REKEY_ACK, self.handle_rekey_ack)
         router.register_handler(PacketType.HANDSHAKE1, self.handle_handshake1)
         router.register_handler(PacketType.HANDSHAKE2, self.handle_handshake2)
         router.register_handler(PacketType.HANDSHAKE3, self.handle_handshake3)
@@ -87,6 +174,7 @@ class SessionManager(object):
         Update Session Map with new session id -> address
         '''
         self.session_map[sid] = address
+        self.relay_table[sid] = address
 
     def send(self, data, sid, address):
         '''
@@ -94,11 +182,26 @@ class SessionManager(object):
         '''
         self.proto.send(data, address)
 
+    def send_df(self, data, sid, address):
+        '''
+        Send data to address with the don't fragment bit set
+        '''
+        self.proto.send_df(data, address)
+
+    def send_many(self, datas, sid, address):
+        '''
+        Send a burst of data to address
+        '''
+        self.proto.send_many(datas, address)
+
     def start(self, port):
         '''
         Start listening on port
         '''
-        self.port = reactor.listenUDP(port, self.proto)
+        if self.pipeline is not None:
+            self.pipeline.start()
+        self.jpake.start()
+        self.port = self.proto.listen(port)
         return self.port
 
     def stop(self):
@@ -108,6 +211,9 @@ class SessionManager(object):
         if self.port is not None:
             self.port.stopListening()
             self.port = None
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        self.jpake.stop()
 
     def open(self, sid, session_key, relays=0):
         '''
@@ -123,15 +229,19 @@ class SessionManager(object):
             def do_reset():
                 logger.warning('doing session reset for {0}'
                                , sid.encode('hex'))
-                pself.send_handshake(sid, address, relays)
+                pself.rekey(sid, address, relays)
 
             # create encryption option TODO: does this prevent GC
-            obj = Crypter(session_key, callback=do_reset)
+            obj = self.new_crypter(sid, session_key, do_reset)
             self.session_objs[sid] = obj
+            if self.pipeline is not None and obj.releases_gil:
+                self.pipelined.add(sid)
+            self.keys[sid] = [session_key, 0, None]
+            self._cancel_rekey(sid)
 
             # update sid -> address map
             self.update_map(sid, address)
-            del self.shaking[sid]
+            self.end_handshake(sid)
 
             self.keep_alives[sid] = time()
 
@@ -139,6 +249,23 @@ class SessionManager(object):
         else:
             raise Exception, "TODO: key-exchange"
 
+    def end_handshake(self, sid):
+        '''
+        Forget the handshake state for sid, letting a queued one start
+        '''
+        if sid in self.shaking:
+            del self.shaking[sid]
+            self.admission.release()
+
+    def new_crypter(self, sid, session_key, callback):
+        '''
+        Create the encryption object for the suite negotiated with sid
+        '''
+        suite = suites.get(self.suites.pop(sid, suites.DEFAULT.id))
+        logger.info('using cipher suite {0} with {1}', suite.name,
+                    sid.encode('hex'))
+        return suite.cls(session_key, callback=callback)
+
     def handle_close(self, pt, data, addr, sid):
         '''
         Handle incoming close packet
@@ -159,26 +286,33 @@ class SessionManager(object):
         # remove encryption object
         if sid in self.session_objs:
             del self.session_objs[sid]
+        self.keys.pop(sid, None)
+        self._cancel_rekey(sid)
+        if self.pipeline is not None:
+            self.pipeline.discard((sid, 'e'))
+            self.pipeline.discard((sid, 'd'))
+        self.pipelined.discard(sid)
+        self.jpake.discard(sid)
 
         # remove address map
         if sid in self.session_map:
             # send a close packet for the other side
             self.router.send(PacketType.CLOSE, '', sid)
             del self.session_map[sid]
+        self.relay_table.pop(sid, None)
 
         # remove incomplete session
-        if sid in self.shaking:
-            del self.shaking[sid]
+        self.end_handshake(sid)
+        self.admission.discard(sid)
+        if sid in self.suites:
+            del self.suites[sid]
+        self.suite_offers.pop(sid, None)
 
         # clear unreachable routes
         # addr map uses mac addresses as keys, not sids
-        # gen a list incase there are multiple addresses for an sid
-        aslist = [k for k in self.router.addr_map
-                  if self.router.addr_map[k][-1] == sid]
-        for x in aslist:
+        for x in self.router.unmap_sid(sid):
             logger.debug('removing addr map {0}->{1}',
                          util.decode_mac(x), sid.encode('hex'))
-            del self.router.addr_map[x]
         util.emit_async('session-closed', self, sid)
 
     def encode(self, sid, data):
@@ -196,27 +330,167 @@ class SessionManager(object):
 
     def decode(self, sid, data):
         '''
-        Decode data with session key associated with an id
+        Decode data with session key associated with an id, and mark it seen
+        once it authenticated
+        '''
+        if isinstance(sid, PeerInfo):
+            sid = sid.id
+
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                      .format(sid.encode('hex')))
+
+        self.keep_alives[sid] = time()
+        obj = self.session_objs[sid]
+        packet = obj.decrypt(data)
+        obj.mark(data)
+        return packet
+
+    def fresh(self, sid, data):
+        '''
+        False if data is a replay from sid, or too old to tell.  Call this
+        before decoding, it only looks at the cipher trailer.  Decoding marks
+        it seen.
+        '''
+        obj = self.session_objs.get(sid)
+        if obj is None:
+            return True  # decoding it will complain
+        return obj.check(data)
+
+    def encode_into(self, sid, data, buf, offset):
+        '''
+        Encode data into buf at offset, returns the end offset
+        '''
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                      .format(sid.encode('hex')))
+        return self.session_objs[sid].encrypt_into(data, buf, offset)
+
+    def encode_many(self, sid, datas):
+        '''
+        Encode a burst of data with the session key associated with an id
         '''
         if isinstance(sid, PeerInfo):
             sid = sid.id
 
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                      .format(sid.encode('hex')))
+        encrypt = self.session_objs[sid].encrypt
+        return [encrypt(data) for data in datas]
+
+    def decode_many(self, sid, datas):
+        '''
+        Decode a burst of data with the session key associated with an id.
+        Packets that fail authentication are None in the list returned, and
+        copies of one earlier in the burst False.
+        '''
+        if isinstance(sid, PeerInfo):
+            sid = sid.id
+
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                      .format(sid.encode('hex')))
+
+        self.keep_alives[sid] = time()
+        obj = self.session_objs[sid]
+        decrypt = obj.decrypt
+        try:
+            packets = [decrypt(data) for data in datas]
+        except AuthenticationError:
+            packets = self._decode_each(obj, datas)
+        return self._accept(obj, datas, packets)
+
+    def _decode_each(self, obj, datas):
+        # something in the burst is forged, find it and keep the rest
+        ret = []
+        for data in datas:
+            try:
+                ret.append(obj.decrypt(data))
+            except AuthenticationError:
+                ret.append(None)
+        return ret
+
+    def _accept(self, obj, datas, packets):
+        # mark what authenticated seen, in order, so a copy later in the
+        # burst (or still in the pipeline) is caught
+        mark = obj.mark
+        for i, data in enumerate(datas):
+            if packets[i] is not None and not mark(data):
+                packets[i] = False
+        return packets
+
+    def encode_async(self, sid, datas, callback):
+        '''
+        Encode a burst of data on the crypto pipeline.  Counter positions are
+        reserved here, callback(datas) is called on the reactor thread in
+        per-session order.
+        '''
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                      .format(sid.encode('hex')))
+        obj = self.session_objs[sid]
+        self.pipeline.submit((sid, 'e'), obj.job_encrypt,
+                             (obj.job_key, obj.reserve(datas)), callback)
+
+    def decode_async(self, sid, datas, callback):
+        '''
+        Decode a burst of data on the crypto pipeline, callback(datas) is
+        called on the reactor thread in per-session order.  Like
+        decode_many, packets that fail authentication are None and replays
+        False.
+        '''
         if sid not in self.session_objs:
             logger.warning('unknown session id: {0}', sid.encode('hex'))
             raise UnknownSessionError("unknown session id: {0}"
                                       .format(sid.encode('hex')))
 
         self.keep_alives[sid] = time()
-        return self.session_objs[sid].decrypt(data)
+        obj = self.session_objs[sid]
+
+        def done(packets):
+            # marked on delivery, a copy may have been queued meanwhile
+            callback(self._accept(obj, datas, packets))
+
+        if obj.other is not None:
+            # rekeying, some may be for the other key.  done here, but
+            # queued behind the rest so they stay in order
+            try:
+                plain = [obj.decrypt(data) for data in datas]
+            except AuthenticationError:
+                plain = self._decode_each(obj, datas)
+            self.pipeline.submit((sid, 'd'), list, (plain,), done)
+            return
+
+        def failed(e):
+            if isinstance(e, AuthenticationError):
+                # rare, so sort it out here on the reactor thread
+                done(self._decode_each(obj, datas))
+            else:
+                logger.warning('crypto job failed: {0}', e)
+        self.pipeline.submit((sid, 'd'), obj.job_decrypt,
+                             (obj.job_key, datas), done, failed)
 
     ###### ###### ###### Session Initiation/Handshake functions ###### ###### ######
 
     def connect(self, addrs):
         self.try_greet(self, addrs)
 
-    @defer.inlineCallbacks
-    def try_greet(self, addrs):
-        '''Try and send 'greet' packets to given address.'''
+    def try_greet(self, addrs, pid=None):
+        '''Try and send 'greet' packets to given addresses.
+
+        The addresses are raced (happy eyeballs): each one starts
+        greet_stagger seconds after the one before it, or right away if that
+        one failed, and the first to ack wins and calls off the rest.  If
+        pid is given (or addrs is a PeerInfo), the winner is remembered first
+        in the network's known_addresses for next time.
+
+        Returns a deferred that fires with the winning address, or None.'''
         if isinstance(addrs, tuple):
             # It's an (address,port) pair
             addrs = [addrs]
@@ -224,8 +498,8 @@ class SessionManager(object):
         elif isinstance(addrs, PeerInfo):
             if addrs.is_direct:
                 # don't need to...
-                return
-                # yield defer.succeed(None)
+                return defer.succeed(None)
+            pid = addrs.id
 
             # it's a peer, try direct_addresses
             # if a NAT scrambled the port, re-add it to the list for each IP
@@ -245,21 +519,85 @@ class SessionManager(object):
             raise ArgumentError('try_greet called with incorrect parameter: {0}'
                                 .format(addrs))
 
-        for address in addrs:
+        # last winner first, no dupes
+        if pid is not None:
+            addrs = self.router.network.known_addresses.get(pid, [])[:1] + addrs
+        seen = set()
+        addrs = [x for x in addrs if not (x in seen or seen.add(x))]
+
+        d = defer.Deferred()
+        if len(addrs) == 0:
+            d.callback(None)
+            return d
+
+        stagger = settings.get_option(self.router.network.name + '/' +
+                                      'greet_stagger', self.GREET_STAGGER)
+        started = set()
+        failed = set()
+        timers = {}
+
+        def start(address):
+            timers.pop(address, None)
+            if not d.called and address not in started:
+                started.add(address)
+                attempt(address)
+
+        @defer.inlineCallbacks
+        def attempt(address):
             logger.info('sending greet to {0}', address)
-            for i in range(3):
-                logger.debug('sending greet packet #{0}', i)
+            self.admission.greet(address)
+            for i in range(self.GREET_TRIES):
+                if d.called:
+                    return  # someone else won
+                logger.debug('sending greet packet #{0} to {1}', i, address)
                 try:
-                    ret = yield self.send_greet(address, ack=True)
-                    return  # stop trying if successful TODO: return address?
+                    yield self.send_greet(address, ack=True)
                 except Exception, e:
                     logger.info('(greet) address {0} failed: {1}'
                                 , address, e)
                     # just keep trying...
+                    continue
+                win(address)
+                return
 
-        logger.info('Could not establish connection with addresses.')
-        return  # same as defer.returnValue(None)
-        # raise Exception('Could not establish connection with addresses.')
+            failed.add(address)
+            if d.called:
+                return  # decided while our last try was out
+            if len(failed) == len(addrs):
+                logger.info('Could not establish connection with addresses.')
+                d.callback(None)
+                return
+            # the next one doesn't have to wait for its turn
+            for x in addrs:
+                if x not in started:
+                    timer = timers.pop(x, None)
+                    if timer is not None:
+                        timer.cancel()
+                    start(x)
+                    break
+
+        def win(address):
+            if d.called:
+                return
+            for call in timers.values():
+                call.cancel()
+            timers.clear()
+            logger.info('greet to {0} acked', address)
+            if pid is not None:
+                self._remember_address(pid, address)
+            d.callback(address)
+
+        for i, address in enumerate(addrs):
+            timers[address] = reactor.callLater(i * stagger, start, address)
+        return d
+
+    def _remember_address(self, pid, address):
+        '''Put address first in the network's known_addresses for pid'''
+        known = self.router.network.known_addresses
+        addrs = known.get(pid, [])
+        if addrs[:1] != [address]:
+            known[pid] = [address] + [x for x in addrs if x != address]
+            self.router.network.known_addresses = known
 
     def connect(self, address, ack=False):
         self.send_greet(address, ack)
@@ -281,7 +619,17 @@ class SessionManager(object):
         if (src_id not in self.session_map or self.router.pm[src_id].timeouts > 0) \
                 and src_id not in self.shaking:
             # unknown peer not currently shaking hands, start handshake
-            self.send_handshake(src_id, address, 0)
+            if len(packet) > 0:
+                # echoed cookie
+                if not self.admission.check_cookie(src_id, address, packet):
+                    logger.info('bad greet cookie from {0}', address)
+                    return
+                priority = Admission.VERIFIED
+            else:
+                priority = self.admission.priority(src_id, address)
+                if self.challenge(src_id, address, priority):
+                    return
+            self.send_handshake(src_id, address, 0, priority)
         else:
             # check to see if we found a direct route
             if src_id in self.router.pm:
@@ -300,47 +648,120 @@ class SessionManager(object):
                     # return the favor
                     self.send_greet(address)
 
-    def send_handshake(self, sid, address, relays=0):
-        '''Send handshake packet to session id or address'''
+    def challenge(self, sid, address, priority):
+        '''Send an unverified source a cookie instead of starting a
+        handshake, if we're under load.  Returns True if it was sent.'''
+        if priority != Admission.UNVERIFIED or not self.admission.under_load():
+            return False
+        logger.info('sending greet cookie to {0}', address)
+        self.router.send(PacketType.GREET_COOKIE,
+                         self.admission.cookie(sid, address), address,
+                         clear=True)
+        return True
+
+    def handle_greet_cookie(self, type, packet, address, src_id):
+        '''Handle a cookie, greet back with it'''
+        if len(packet) != Admission.COOKIE_SIZE:
+            return
+        logger.info('got greet cookie from {0}', address)
+        self.router.send(PacketType.GREET, packet, address, clear=True)
+
+    def send_handshake(self, sid, address, relays=0, priority=None,
+                       retry=None):
+        '''Send handshake packet to session id or address.  If too many are
+        running, it's queued (by priority) and retry() is called when it can
+        start, which sends it by default.'''
         # todo make retry for fails
         if sid not in self.shaking:
-            logger.info('sending handshake to {0}', sid.encode('hex'))
+            if retry is None:
+                retry = lambda: self.send_handshake(sid, address, relays,
+                                                    priority)
+            if not self.admission.admit(sid, address, retry, priority):
+                return
 
-            j = jpake.JPAKE(self.router.network.key)
-            send1 = j.pack_one(j.one())
-            j._one = True
-            j._two = False
-            self.shaking[sid] = [j, relays, address]
+            entry = self.shaking[sid] = [None, relays, address]
 
             # timeout handshake
             reactor.callLater(self.HANDSHAKE_TIMEOUT,
                               self.handshake_timeout, sid)
 
-            # don't need ack, should get handshake-ack or timeout
-            data = self.router.__signature__ + pack('!B', relays) + send1
-            return self.router.send(PacketType.HANDSHAKE1,
-                                    data,
-                                    sid, clear=True)
+            secret = self.tickets.get(sid)
+            if secret is not None:
+                return self.send_resume(sid, entry, secret)
+            return self._start_jpake(sid, entry)
 
         else:
             logger.info('send_handshake called on {0} while already shaking'
                         , sid.encode('hex'))
 
+    def _start_jpake(self, sid, entry):
+        logger.info('sending handshake to {0}', sid.encode('hex'))
+
+        hs = entry[0] = self.jpake.handshake(sid, self.router.network.key)
+
+        # round one is usually precomputed, so this fires right away
+        d = hs.one()
+        d.addCallback(self._send_handshake1, sid, entry)
+        d.addErrback(self._jpake_failed, sid)
+        return d
+
+    def _send_handshake1(self, send1, sid, entry):
+        if self.shaking.get(sid) is not entry:
+            return
+        relays = entry[1]
+
+        # don't need ack, should get handshake-ack or timeout
+        if self.suite_ids == [suites.DEFAULT.id]:
+            # old format, so peers without suite support can connect
+            data = self.router.__signature__ + pack('!B', relays) + send1
+        else:
+            data = (self.router.__suite_signature__ + pack('!B', relays)
+                    + pack('!B', len(self.suite_ids))
+                    + ''.join(chr(x) for x in self.suite_ids) + send1)
+        return self.router.send(PacketType.HANDSHAKE1,
+                                data,
+                                sid, clear=True)
+
+    def _jpake_failed(self, f, sid):
+        logger.warning('handshake with {0} failed in jpake: {1}',
+                       sid.encode('hex'), f.getErrorMessage())
+        self.handshake_fail(sid)
+
     def handle_handshake1(self, type, packet, address, src_id):
         '''Handle first handshake packet'''
         logger.info('got handshake1 from {0}', src_id.encode('hex'))
 
         sig, r, recv1 = packet[:5], packet[5], packet[6:]
 
-        if sig != self.router.__signature__:
+        if sig == self.router.__signature__:
+            theirs, offer = [suites.DEFAULT.id], None
+        elif sig == self.router.__suite_signature__:
+            n = ord(recv1[0])
+            theirs, recv1 = [ord(x) for x in recv1[1:n+1]], recv1[n+1:]
+            offer = theirs
+        else:
             logger.warning(('got a handshake1 from peer {0} using an ' +
                             'incompatible version'), src_id.encode('hex'))
             return self.handshake_fail(src_id)
 
+        suite = suites.negotiate(self.suite_ids, theirs, self.id < src_id)
+        if suite is None:
+            logger.warning('no common cipher suite with peer {0}',
+                           src_id.encode('hex'))
+            return self.handshake_fail(src_id)
+
         r = unpack('!B', r)[0]
 
         if src_id in self.shaking:
-            j, relays, addr = self.shaking[src_id]
+            hs, relays, addr = self.shaking[src_id]
+            if isinstance(hs, resume.Resume):
+                # they're doing it the long way, so we are too.  the
+                # ticket stays until a handshake replaces it, anyone can
+                # send a handshake1
+                logger.info('got handshake1 from {0} while resuming',
+                            src_id.encode('hex'))
+                self._start_jpake(src_id, self.shaking[src_id])
+                hs = self.shaking[src_id][0]
             if relays < r:
                 # incoming hs1 came over more hops
                 r = relays
@@ -350,31 +771,61 @@ class SessionManager(object):
                 self.shaking[src_id][2] = address
 
         else:
-            self.send_handshake(src_id, address, r)
-            j = self.shaking[src_id][0]
-
-        send2 = j.pack_two(j.two(j.unpack_one(recv1)))
-        j._two = True
-        logger.info('sending handshake2 to {0}', src_id.encode('hex'))
-        return self.router.send(PacketType.HANDSHAKE2, send2, src_id, clear=True)
+            priority = self.admission.priority(src_id, address)
+            if self.challenge(src_id, address, priority):
+                return
+            # if it has to wait, handle this packet again when it's let in
+            self.send_handshake(src_id, address, r, priority,
+                retry=lambda: self.handle_handshake1(type, packet, address,
+                                                     src_id))
+            if src_id not in self.shaking:
+                return
+            hs = self.shaking[src_id][0]
+
+        self.suites[src_id] = suite
+        # what we sent, see _send_handshake1
+        ours = None if self.suite_ids == [suites.DEFAULT.id] \
+                    else self.suite_ids
+        self.suite_offers[src_id] = suites.transcript(
+            ours, offer, self.id < src_id, suite)
+
+        entry = self.shaking[src_id]
+        d = hs.two(recv1)
+        d.addCallback(self._send_handshake2, src_id, entry)
+        d.addErrback(self._jpake_failed, src_id)
+        return d
+
+    def _send_handshake2(self, send2, sid, entry):
+        if self.shaking.get(sid) is not entry:
+            return
+        logger.info('sending handshake2 to {0}', sid.encode('hex'))
+        return self.router.send(PacketType.HANDSHAKE2, send2, sid, clear=True)
 
     @defer.inlineCallbacks
     def handle_handshake2(self, type, packet, address, src_id):
         '''Handle second handshake packet'''
         if src_id in self.shaking:
             logger.info('got handshake2 from {0}', src_id.encode('hex'))
-            j = self.shaking[src_id][0]
+            entry = self.shaking[src_id]
+            hs = entry[0]
 
             # make sure we got hs1 before hs2
-            if not j._two:
+            if not hs.got_one:
                 logger.warning('handshake2 arrived but never got handshake1 '
                                + 'from {0}', src_id.encode('hex'))
                 self.handshake_fail(src_id)
                 return
 
-            recv2 = j.unpack_two(packet)
-            session_key = j.three(recv2)
-            hsh = hashlib.sha256(session_key).digest()
+            try:
+                session_key = yield hs.three(packet)
+            except Exception, e:
+                logger.warning('handshake with {0} failed in jpake: {1}',
+                               src_id.encode('hex'), e)
+                self.handshake_fail(src_id)
+                return
+            if self.shaking.get(src_id) is not entry:
+                return
+            hsh = self._confirmation(src_id, session_key)
 
             for i in range(3):  # 3 retrys
                 logger.info('sending handshake3 to {0}', src_id.encode('hex'))
@@ -414,7 +865,7 @@ class SessionManager(object):
             logger.info('got handshake3 from {0}', src_id.encode('hex'))
             session_key = self.shaking[src_id][3]
 
-            if packet == hashlib.sha256(session_key).digest():
+            if packet == self._confirmation(src_id, session_key):
                 self.handshake_done(src_id)
             else:
                 logger.warning('handshake with {0} verification failed'
@@ -425,6 +876,12 @@ class SessionManager(object):
             logger.warning(('got handshake3 from {0}, but not currently' +
                             ' shaking'), src_id.encode('hex'))
 
+    def _confirmation(self, sid, session_key):
+        # the suite offers went in the clear, so make sure both sides saw
+        # the same ones
+        return hashlib.sha256(session_key
+                              + self.suite_offers.get(sid, '')).digest()
+
     def handshake_done(self, sid):
         '''Called when a handshake finishes (successfully)'''
         logger.info('handshake finished with {0}', sid.encode('hex'))
@@ -433,10 +890,211 @@ class SessionManager(object):
             session_key = self.shaking[sid][3]
             #            session_key = hashlib.md5(session_key).digest()
             r = self.shaking[sid][1]
+            hs = self.shaking[sid][0]
+            features = self.features[sid] = signer_features(hs.their_id or '')
+            self.suite_offers.pop(sid, None)
 
             # init encryption
             self.open(sid, session_key, relays=r)
 
+            # next time, skip all that if they can
+            if self.tickets.size > 0 and RESUME in features:
+                self.tickets.put(sid, resume.new_secret(session_key))
+            else:
+                self.tickets.discard(sid)
+
+    ###### Rekeying
+
+    def rekey(self, sid, address=None, relays=0):
+        '''
+        Replace the session key for sid with one derived from the session
+        secret, without closing the session.  Both keys decrypt until the
+        switch is done on both sides, and the old one for REKEY_GRACE after.
+        Peers that can't do that get a new handshake (to address).
+        '''
+        if sid not in self.session_objs or sid in self.rekeying:
+            return
+        if sid not in self.keys or REKEY not in self.features.get(sid, ()):
+            if address is not None:
+                self.send_handshake(sid, address, relays)
+            return
+
+        logger.info('rekeying session with {0}', sid.encode('hex'))
+        secret, epoch, _ = self.keys[sid]
+        epoch += 1
+        nonce = resume.new_nonce()
+        key, secret = resume.derive_rekey(secret, epoch, nonce)
+
+        old = self.session_objs[sid]
+        new = old.__class__(key, callback=old.callback, phase=epoch & 1)
+        # they switch when they get the rekey, we when they ack it
+        old.other = new
+        self.rekeying[sid] = [epoch, secret, new, nonce, 0, None]
+        self._send_rekey(sid, address, relays)
+
+    def _send_rekey(self, sid, address, relays):
+        state = self.rekeying.get(sid)
+        if state is None:
+            return
+        if state[4] >= self.REKEY_TRIES:
+            logger.warning('rekey with {0} timed out', sid.encode('hex'))
+            self._cancel_rekey(sid)
+            if address is not None:
+                self.send_handshake(sid, address, relays)
+            return
+
+        state[4] += 1
+        state[5] = reactor.callLater(self.REKEY_TIMEOUT, self._send_rekey,
+                                     sid, address, relays)
+        self.router.send(PacketType.REKEY, pack('!I', state[0]) + state[3],
+                         sid)
+
+    def _cancel_rekey(self, sid):
+        state = self.rekeying.pop(sid, None)
+        if state is not None:
+            if state[5] is not None and state[5].active():
+                state[5].cancel()
+            obj = self.session_objs.get(sid)
+            if obj is not None and obj.other is state[2]:
+                obj.other = None
+
+    def _switch_key(self, sid, epoch, secret, nonce, new):
+        '''Start sending with new, the old key stays for the grace period'''
+        old = self.session_objs[sid]
+        old.other = None
+        new.other = old
+        self.session_objs[sid] = new
+        self.keys[sid] = [secret, epoch, nonce]
+        reactor.callLater(self.REKEY_GRACE, self._end_grace, sid, new)
+        logger.info('session with {0} rekeyed to epoch {1}',
+                    sid.encode('hex'), epoch)
+
+    def _end_grace(self, sid, obj):
+        if self.session_objs.get(sid) is obj:
+            obj.other = None
+
+    def handle_rekey(self, type, packet, address, src_id):
+        '''Handle a rekey, switch to the new key and ack it'''
+        if len(packet) != 4 + resume.NONCE_SIZE or src_id not in self.keys:
+            return
+        epoch, nonce = unpack('!I', packet[:4])[0], packet[4:]
+        secret, current, last = self.keys[src_id]
+
+        if epoch == current and nonce == last:
+            # our ack got lost
+            self.router.send(PacketType.REKEY_ACK, packet[:4], src_id)
+            return
+        if epoch != current + 1:
+            logger.warning('rekey from {0} for epoch {1}, expected {2}',
+                           src_id.encode('hex'), epoch, current + 1)
+            return
+
+        if src_id in self.rekeying:
+            # both started at once, the lower id's goes
+            if self.id < src_id:
+                return
+            self._cancel_rekey(src_id)
+
+        key, secret = resume.derive_rekey(secret, epoch, nonce)
+        old = self.session_objs[src_id]
+        new = old.__class__(key, callback=old.callback, phase=epoch & 1)
+        self._switch_key(src_id, epoch, secret, nonce, new)
+        self.router.send(PacketType.REKEY_ACK, packet[:4], src_id)
+
+    def handle_rekey_ack(self, type, packet, address, src_id):
+        '''Handle a rekey ack, switch to the new key'''
+        state = self.rekeying.get(src_id)
+        if state is None or packet != pack('!I', state[0]):
+            return
+        epoch, secret, new, nonce = state[:4]
+        self._cancel_rekey(src_id)
+        self._switch_key(src_id, epoch, secret, nonce, new)
+
+    ###### Resumption
+
+    def send_resume(self, sid, entry, secret):
+        '''Open a new session with sid from its resumption secret, in one
+        round trip.  Falls back to J-PAKE if they don't have it.'''
+        logger.info('resuming session with {0}', sid.encode('hex'))
+        r = entry[0] = resume.Resume(secret)
+        data = resume.pack_resume(secret, self.id, sid, r.nonce, entry[1],
+                                  self.suite_ids)
+        return self.router.send(PacketType.RESUME, data, sid, clear=True)
+
+    def handle_resume(self, type, packet, address, src_id):
+        '''Handle a resume, open the session and ack it if we have the
+        secret for it, otherwise nak'''
+        entry = self.shaking.get(src_id)
+        if entry is not None and isinstance(entry[0], resume.Resume) \
+                and self.id < src_id:
+            # both resuming at once, ours wins
+            return
+
+        secret = self.tickets.get(src_id)
+        msg = None
+        if secret is not None:
+            msg = resume.unpack_resume(secret, src_id, self.id, packet)
+        if msg is None:
+            # keep the ticket, this could be from anyone.  if they really
+            # lost theirs, the handshake after the nak replaces it
+            logger.info('cannot resume session with {0}',
+                        src_id.encode('hex'))
+            # by id if we can, it may have been relayed
+            dst = src_id if src_id in self.router.pm else address
+            self.router.send(PacketType.RESUME_NAK, packet[:resume.NONCE_SIZE],
+                             dst, clear=True)
+            return
+
+        nonce_a, r, theirs = msg
+        suite = suites.negotiate(self.suite_ids, theirs, self.id < src_id)
+        if suite is None:
+            logger.warning('no common cipher suite with peer {0}',
+                           src_id.encode('hex'))
+            return
+
+        logger.info('resuming session with {0}', src_id.encode('hex'))
+        nonce_b = resume.new_nonce()
+        session_key, next_secret = resume.derive(secret, nonce_a, nonce_b)
+        self.tickets.put(src_id, next_secret)
+
+        # a new entry, so anything still running for the old one stops
+        self.shaking[src_id] = [None, r, address]
+        self.router.send(PacketType.RESUME_ACK,
+                         resume.pack_ack(secret, self.id, src_id, nonce_a,
+                                         nonce_b, suite),
+                         src_id, clear=True)
+        self.suites[src_id] = suite
+        self.open(src_id, session_key, relays=r)
+
+    def handle_resume_ack(self, type, packet, address, src_id):
+        '''Handle a resume ack, open the session'''
+        entry = self.shaking.get(src_id)
+        if entry is None or not isinstance(entry[0], resume.Resume):
+            return
+        r = entry[0]
+
+        msg = resume.unpack_ack(r.secret, src_id, self.id, r.nonce, packet)
+        if msg is None or msg[1] not in self.suite_ids:
+            logger.warning('bad resume ack from {0}', src_id.encode('hex'))
+            return
+
+        logger.info('resumed session with {0}', src_id.encode('hex'))
+        nonce_b, suite = msg
+        session_key, next_secret = resume.derive(r.secret, r.nonce, nonce_b)
+        self.tickets.put(src_id, next_secret)
+        self.suites[src_id] = suite
+        self.open(src_id, session_key, relays=entry[1])
+
+    def handle_resume_nak(self, type, packet, address, src_id):
+        '''They don't have our secret, do a full handshake'''
+        entry = self.shaking.get(src_id)
+        if entry is None or not isinstance(entry[0], resume.Resume) \
+                or packet != entry[0].nonce:
+            return
+        logger.info('{0} cannot resume, falling back to handshake',
+                    src_id.encode('hex'))
+        self._start_jpake(src_id, entry)
+
     def handshake_timeout(self, sid):
         '''Called when a handshake times out'''
         if sid in self.shaking and sid not in self.session_map:
@@ -0,0 +1,228 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# admission.py
+# caps on concurrent handshakes, a priority queue for the rest, and
+# stateless greet cookies for sources we know nothing about
+
+import hashlib
+import heapq
+import hmac
+import itertools
+import logging
+import os
+import weakref
+from time import time
+
+from ..stats import HandshakeStats
+
+logger = logging.getLogger(__name__)
+
+# every Admission in the process, for the global cap
+_all = weakref.WeakSet()
+
+
+class Admission(object):
+    '''
+        Decides when a SessionManager may start a handshake.  At most `limit`
+        entries in its shaking map at once, and MAX_GLOBAL across every
+        network.  Past that, handshakes wait in a queue ordered by priority:
+
+            KNOWN       peers we have (or had, in known_addresses)
+            VERIFIED    sources that proved their address: they echoed a
+                        cookie, answered our greet, or are a peer's address
+            UNVERIFIED  anyone else
+
+        Under load, an UNVERIFIED greet gets a cookie back instead of a
+        handshake, which costs us no state and no modexp.
+    '''
+    KNOWN, VERIFIED, UNVERIFIED = range(3)
+
+    MAX_GLOBAL = 64
+    # seconds a queued handshake stays useful, the other side gives up
+    QUEUE_TIMEOUT = 10
+    # seconds between cookie secret changes, cookies are good for two
+    COOKIE_ROTATE = 30
+    COOKIE_SIZE = 16
+    # seconds an address we greeted counts as verified
+    GREETED_TIMEOUT = 10
+
+    def __init__(self, sm, limit=16, queue_size=64):
+        self.sm = sm
+        self.limit = limit
+        self.queue_size = queue_size
+        self.stats = HandshakeStats()
+
+        # heap of (priority, seq, sid), sid -> [priority, seq, time, retry]
+        self._heap = []
+        self._queued = {}
+        self._seq = itertools.count()
+
+        self._secrets = [os.urandom(16), os.urandom(16)]
+        self._rotated = time()
+        # address -> time we last greeted it
+        self._greeted = {}
+
+        _all.add(self)
+
+    ###### Limits
+
+    @property
+    def shaking(self):
+        return len(self.sm.shaking)
+
+    @property
+    def depth(self):
+        return len(self._queued)
+
+    @staticmethod
+    def total():
+        return sum(len(a.sm.shaking) for a in _all)
+
+    def full(self):
+        return self.shaking >= self.limit or self.total() >= self.MAX_GLOBAL
+
+    def under_load(self):
+        '''True once half the slots are taken, or anything is waiting'''
+        return (len(self._queued) > 0 or self.shaking * 2 >= self.limit
+                or self.total() * 2 >= self.MAX_GLOBAL)
+
+    def priority(self, sid, address):
+        router = self.sm.router
+        if sid in router.pm or sid in router.network.known_addresses:
+            return self.KNOWN
+        if self.greeted(address) or router.pm.get_by_address(address):
+            return self.VERIFIED
+        return self.UNVERIFIED
+
+    ###### Queue
+
+    def admit(self, sid, address, retry, priority=None):
+        '''
+            True if a handshake with sid can start now.  Otherwise retry()
+            is queued to be called once one can, or dropped if the queue is
+            full of more important ones.
+        '''
+        if not self.full():
+            self.stats.admitted += 1
+            return True
+
+        if priority is None:
+            priority = self.priority(sid, address)
+
+        entry = self._queued.get(sid)
+        if entry is not None:
+            # already waiting, keep its place unless this one ranks higher
+            entry[2:4] = time(), retry
+            if priority >= entry[0]:
+                return False
+
+        elif len(self._queued) >= self.queue_size:
+            worst = max(self._queued, key=lambda x: self._queued[x][:2])
+            if priority >= self._queued[worst][0]:
+                self.stats.rejected += 1
+                logger.info('handshake queue full, rejecting {0}',
+                            sid.encode('hex'))
+                return False
+            logger.info('handshake queue full, dropping {0}',
+                        worst.encode('hex'))
+            del self._queued[worst]
+            self.stats.rejected += 1
+
+        else:
+            self.stats.queued += 1
+
+        seq = self._seq.next()
+        self._queued[sid] = [priority, seq, time(), retry]
+        heapq.heappush(self._heap, (priority, seq, sid))
+        if len(self._heap) > 2 * self.queue_size + 16:
+            # too many replaced or dropped items, rebuild from the live ones
+            self._heap = [(e[0], e[1], x) for x, e in self._queued.items()]
+            heapq.heapify(self._heap)
+        logger.info('queued handshake with {0} ({1} waiting)',
+                    sid.encode('hex'), len(self._queued))
+        return False
+
+    def release(self):
+        '''A handshake finished, start queued ones in every network that
+        has room'''
+        self._drain()
+        for a in list(_all):
+            if a is not self and len(a._queued) > 0:
+                a._drain()
+
+    def _drain(self):
+        now = time()
+        while len(self._heap) > 0 and not self.full():
+            priority, seq, sid = heapq.heappop(self._heap)
+            entry = self._queued.get(sid)
+            if entry is None or entry[:2] != [priority, seq]:
+                continue  # replaced or dropped
+            del self._queued[sid]
+
+            if now - entry[2] > self.QUEUE_TIMEOUT:
+                self.stats.expired += 1
+                continue
+
+            logger.debug('starting queued handshake with {0}',
+                         sid.encode('hex'))
+            try:
+                entry[3]()
+            except Exception, e:
+                logger.error('queued handshake with {0} raised exception: {1}',
+                             sid.encode('hex'), e, exc_info=True)
+
+    def discard(self, sid):
+        '''Forget a queued handshake with sid'''
+        self._queued.pop(sid, None)
+
+    ###### Cookies
+
+    def greet(self, address):
+        '''Remember that we greeted address'''
+        now = time()
+        if len(self._greeted) >= 1024:
+            for x, t in self._greeted.items():
+                if now - t > self.GREETED_TIMEOUT:
+                    del self._greeted[x]
+        self._greeted[address] = now
+
+    def greeted(self, address):
+        t = self._greeted.get(address)
+        return t is not None and time() - t <= self.GREETED_TIMEOUT
+
+    def cookie(self, sid, address, secret=None):
+        '''Stateless cookie binding sid to address'''
+        if secret is None:
+            self._rotate()
+            secret = self._secrets[0]
+            self.stats.cookies_sent += 1
+        return hmac.new(secret, sid + repr(address),
+                        hashlib.sha256).digest()[:self.COOKIE_SIZE]
+
+    def check_cookie(self, sid, address, cookie):
+        self._rotate()
+        for secret in self._secrets:
+            if hmac.compare_digest(self.cookie(sid, address, secret), cookie):
+                return True
+        self.stats.cookies_bad += 1
+        return False
+
+    def _rotate(self):
+        now = time()
+        if now - self._rotated > self.COOKIE_ROTATE:
+            self._secrets = [os.urandom(16), self._secrets[0]]
+            self._rotated = now
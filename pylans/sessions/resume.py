@@ -0,0 +1,144 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# resume.py
+# session resumption: a secret both sides keep per peer after a handshake,
+# good for one new session key without another J-PAKE exchange
+#
+# resume     nonce_a(16) relays(1) n(1) suites(n) mac(16)
+# resume ack nonce_b(16) suite(1) mac(16)
+# resume nak nonce_a(16)
+#
+# key = HMAC(secret, 'key' + nonce_a + nonce_b), and the secret is replaced
+# by HMAC(secret, 'next' + nonce_a + nonce_b), so each one is used once.
+#
+# An open session's secret also gives its next key when rekeying in place:
+#
+# rekey      epoch(4) nonce(16)
+# rekey ack  epoch(4)
+#
+# secret = HMAC(secret, 'rekey' + epoch + nonce), key = HMAC(secret, 'key')
+
+import collections
+import hashlib
+import hmac
+import os
+from struct import pack
+from time import time
+
+NONCE_SIZE = 16
+MAC_SIZE = 16
+
+
+def _mac(secret, *parts):
+    return hmac.new(secret, ''.join(parts), hashlib.sha256).digest()
+
+
+def new_secret(session_key):
+    '''The first resumption secret, from a J-PAKE session key'''
+    return _mac(session_key, 'resume')
+
+
+def derive(secret, nonce_a, nonce_b):
+    '''Returns (session key, next secret)'''
+    return (_mac(secret, 'key', nonce_a, nonce_b),
+            _mac(secret, 'next', nonce_a, nonce_b))
+
+
+def derive_rekey(secret, epoch, nonce):
+    '''Returns (session key, secret) for epoch'''
+    secret = _mac(secret, 'rekey', pack('!I', epoch), nonce)
+    return _mac(secret, 'key'), secret
+
+
+def new_nonce():
+    return os.urandom(NONCE_SIZE)
+
+
+def pack_resume(secret, src, dst, nonce_a, relays, suite_ids):
+    body = (nonce_a + chr(relays) + chr(len(suite_ids))
+            + ''.join(chr(x) for x in suite_ids))
+    return body + _mac(secret, 'resume', src, dst, body)[:MAC_SIZE]
+
+
+def unpack_resume(secret, src, dst, packet):
+    '''Returns (nonce_a, relays, suite ids), or None if it doesn't check out'''
+    body, mac = packet[:-MAC_SIZE], packet[-MAC_SIZE:]
+    if len(body) < NONCE_SIZE + 2 or \
+            len(body) != NONCE_SIZE + 2 + ord(body[NONCE_SIZE + 1]):
+        return None
+    if not hmac.compare_digest(
+            _mac(secret, 'resume', src, dst, body)[:MAC_SIZE], mac):
+        return None
+    return (body[:NONCE_SIZE], ord(body[NONCE_SIZE]),
+            [ord(x) for x in body[NONCE_SIZE + 2:]])
+
+
+def pack_ack(secret, src, dst, nonce_a, nonce_b, suite):
+    body = nonce_b + chr(suite)
+    return body + _mac(secret, 'ack', src, dst, nonce_a, body)[:MAC_SIZE]
+
+
+def unpack_ack(secret, src, dst, nonce_a, packet):
+    '''Returns (nonce_b, suite id), or None if it doesn't check out'''
+    body, mac = packet[:-MAC_SIZE], packet[-MAC_SIZE:]
+    if len(body) != NONCE_SIZE + 1 or not hmac.compare_digest(
+            _mac(secret, 'ack', src, dst, nonce_a, body)[:MAC_SIZE], mac):
+        return None
+    return body[:NONCE_SIZE], ord(body[NONCE_SIZE])
+
+
+class Resume(object):
+    '''Stands in for the Handshake in a shaking entry while we resume'''
+    got_one = False
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.nonce = new_nonce()
+
+
+class TicketCache(object):
+    '''
+        peer id -> resumption secret, expiring after `lifetime` seconds and
+        dropping the least recently used past `size`
+    '''
+
+    def __init__(self, size=256, lifetime=3600):
+        self.size = size
+        self.lifetime = lifetime
+        # pid -> (secret, expires), oldest first
+        self._tickets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def get(self, pid):
+        entry = self._tickets.pop(pid, None)
+        if entry is None:
+            return None
+        if entry[1] < time():
+            return None
+        self._tickets[pid] = entry
+        return entry[0]
+
+    def put(self, pid, secret):
+        self._tickets.pop(pid, None)
+        self._tickets[pid] = (secret, time() + self.lifetime)
+        while len(self._tickets) > self.size:
+            self._tickets.popitem(last=False)
+
+    def discard(self, pid):
+        self._tickets.pop(pid, None)
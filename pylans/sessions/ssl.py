@@ -34,7 +34,7 @@ class SSLSessionManager(TCPSessionManager):
 
     def update_map(self, sid, addr):
         if isinstance(addr, protocol.SSLPeerProtocol):
-            self.session_map[sid] = addr
+            self._map_conn(sid, addr)
         else:
             raise ValueError, "session map stores ssl connections, not {0}"\
                                     .format(addr)
@@ -59,6 +59,7 @@ class SSLSessionManager(TCPSessionManager):
 
 
     def start(self, port):
+        self.jpake.start()
         self.port = reactor.listenSSL(port, self,
                 ssl.DefaultOpenSSLContextFactory('key.pem','cert.pem'))
         return self.port
@@ -69,7 +70,7 @@ class SSLSessionManager(TCPSessionManager):
             # shouldn't be in shaking if not in connecting
 #            self.session_map[sid] = self.connecting[addr][2]
             self.update_map(sid, self.connecting[addr][2])
-            del self.shaking[sid]
+            self.end_handshake(sid)
             del self.connecting[addr]
             util.emit_async('session-opened', self, sid, relays)
             
@@ -18,7 +18,6 @@ from twisted.internet import reactor, defer
 import logging
 import struct
 
-from ..crypto import Crypter
 from ..packets import PacketType
 from ..peers import PeerInfo
 from .. import util
@@ -30,9 +29,13 @@ logger = logging.getLogger(__name__)
 
         
 class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
+    # tcp transports buffer writes, so they need their own copy
+    zero_copy = False
 
     def __init__(self, router):
         self.connecting = {}
+        # connection -> set of sids using it
+        self.conn_sids = {}
         SessionManager.__init__(self, router, proto=self)
         
         
@@ -78,11 +81,8 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
             
         logger.info('connection closing: {0}, {1}'.format(addr, proto))
 
-        # get sids using this protocol
-        sids = [ k for k in self.session_map.keys() if self.session_map[k] == proto ]
-
-        # close them down
-        for sid in sids:
+        # close down sids using this protocol
+        for sid in list(self.conn_sids.get(proto, ())):
             self.close(sid)
         
         
@@ -97,10 +97,30 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
 
     def update_map(self, sid, addr):
         if isinstance(addr, protocol.TCPPeerProtocol):
-            self.session_map[sid] = addr
+            self._map_conn(sid, addr)
         else:
             raise ValueError, "session map stores tcp connections, not {0}".format(addr)
 
+    def _map_conn(self, sid, conn):
+        '''Set the connection for sid, keeping conn_sids up to date'''
+        if sid in self.session_map:
+            self._unmap_conn(sid, self.session_map[sid])
+        self.session_map[sid] = conn
+        self.conn_sids.setdefault(conn, set()).add(sid)
+
+    def _unmap_conn(self, sid, conn):
+        sids = self.conn_sids.get(conn)
+        if sids is not None:
+            sids.discard(sid)
+            if len(sids) == 0:
+                del self.conn_sids[conn]
+
+    def close(self, sid):
+        conn = self.session_map.get(sid)
+        SessionManager.close(self, sid)
+        if conn is not None:
+            self._unmap_conn(sid, conn)
+
     def connect(self, address):
         # check if already connected
         if address not in self.connecting:
@@ -135,16 +155,16 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
             def do_reset():
                 logger.warning('doing session reset for {0}'
                                     .format(sid.encode('hex')))
-                pself.send_handshake(sid, address, relays)
+                pself.send_handshake(sid, addr, relays)
                 
             # create encryption option
-            obj = Crypter(session_key, callback=do_reset)
+            obj = self.new_crypter(sid, session_key, do_reset)
             self.session_objs[sid] = obj
             
             # update sid -> address map
             self.update_map(sid, self.connecting[addr][2])
 #            self.session_map[sid] = self.connecting[addr][2]
-            del self.shaking[sid]
+            self.end_handshake(sid)
             del self.connecting[addr]
             
             util.emit_async('session-opened', self, sid, relays)
@@ -169,6 +189,9 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
         print 'three'
 
     def start(self, port):
+        if self.pipeline is not None:
+            self.pipeline.start()
+        self.jpake.start()
         self.port = reactor.listenTCP(port, self)
         return self.port
         
@@ -176,6 +199,9 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
         if self.port is not None:
             self.port.stopListening()
             self.port = None
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        self.jpake.stop()
         
     def send(self, data, sid, address):
         if sid in self.session_map:
@@ -200,6 +226,10 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
             logger.error("cannot send to sid not in session map")
             raise KeyError, "cannot send to sid not in session map"
             
+    def send_many(self, datas, sid, address):
+        for data in datas:
+            self.send(data, sid, address)
+
     def encode(self, sid, data):
         if isinstance(sid, PeerInfo):
             sid = sid.id
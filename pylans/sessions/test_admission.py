@@ -0,0 +1,97 @@
+import os
+import unittest
+
+from .admission import Admission
+
+
+class FakePeers(dict):
+    def get_by_address(self, address):
+        return None
+
+
+class FakeNetwork(object):
+    def __init__(self):
+        self.known_addresses = {}
+
+
+class FakeRouter(object):
+    def __init__(self):
+        self.pm = FakePeers()
+        self.network = FakeNetwork()
+
+
+class FakeSessions(object):
+    '''just what Admission needs, send_handshake fills a slot'''
+    def __init__(self):
+        self.router = FakeRouter()
+        self.shaking = {}
+        self.started = []
+
+    def send_handshake(self, sid):
+        self.shaking[sid] = True
+        self.started.append(sid)
+
+
+class Queue(unittest.TestCase):
+    def setUp(self):
+        self.sm = FakeSessions()
+        self.adm = Admission(self.sm, limit=2, queue_size=3)
+
+    def start(self, sid, address=('1.2.3.4', 8015)):
+        if self.adm.admit(sid, address,
+                          lambda: self.start(sid, address)):
+            self.sm.send_handshake(sid)
+
+    def finish(self, sid):
+        del self.sm.shaking[sid]
+        self.adm.release()
+
+    def test_limit(self):
+        for sid in 'abcd':
+            self.start(sid)
+        self.assertEqual(self.sm.started, ['a', 'b'])
+        self.assertEqual(self.adm.depth, 2)
+
+        self.finish('a')
+        self.assertEqual(self.sm.started, ['a', 'b', 'c'])
+        self.assertEqual(self.adm.stats.as_dict()['queued'], 2)
+
+    def test_priority(self):
+        self.start('a')
+        self.start('b')
+        self.sm.router.network.known_addresses['k'] = [('5.6.7.8', 8015)]
+        self.adm.greet(('9.9.9.9', 8015))
+        for sid in 'xyz':
+            self.start(sid)
+        self.start('v', ('9.9.9.9', 8015))
+        self.start('k')
+
+        # full queue, the newest unverified one made room for k
+        self.assertEqual(self.adm.stats.rejected, 2)
+        self.finish('a')
+        self.finish('b')
+        self.assertEqual(self.sm.started[2:], ['k', 'v'])
+
+    def test_cookie(self):
+        sid, address = os.urandom(16), ('1.2.3.4', 8015)
+        cookie = self.adm.cookie(sid, address)
+        self.assertEqual(len(cookie), Admission.COOKIE_SIZE)
+        self.assertTrue(self.adm.check_cookie(sid, address, cookie))
+        self.assertFalse(self.adm.check_cookie(sid, ('1.2.3.4', 8016),
+                                               cookie))
+
+        # good for one rotation, not two
+        self.adm._rotated = 0
+        self.assertTrue(self.adm.check_cookie(sid, address, cookie))
+        self.adm._rotated = 0
+        self.assertFalse(self.adm.check_cookie(sid, address, cookie))
+        self.assertEqual(self.adm.stats.cookies_bad, 2)
+
+    def test_under_load(self):
+        self.assertFalse(self.adm.under_load())
+        self.start('a')
+        self.assertTrue(self.adm.under_load())
+
+
+if __name__ == '__main__':
+    unittest.main()
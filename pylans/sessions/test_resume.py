@@ -0,0 +1,61 @@
+import os
+import unittest
+
+from . import resume
+
+
+class Tickets(unittest.TestCase):
+    def test_lru(self):
+        tickets = resume.TicketCache(size=2)
+        tickets.put('a', 'secret a')
+        tickets.put('b', 'secret b')
+        self.assertEqual(tickets.get('a'), 'secret a')
+        tickets.put('c', 'secret c')
+        # b was the least recently used
+        self.assertEqual(tickets.get('b'), None)
+        self.assertEqual(len(tickets), 2)
+
+    def test_expiry(self):
+        tickets = resume.TicketCache(lifetime=-1)
+        tickets.put('a', 'secret a')
+        self.assertEqual(tickets.get('a'), None)
+
+
+class Exchange(unittest.TestCase):
+    def test_resume(self):
+        a, b = os.urandom(16), os.urandom(16)
+        secret = resume.new_secret(os.urandom(32))
+        nonce_a = resume.new_nonce()
+
+        packet = resume.pack_resume(secret, a, b, nonce_a, 1, [2, 0])
+        self.assertEqual(resume.unpack_resume(secret, a, b, packet),
+                         (nonce_a, 1, [2, 0]))
+        # bound to the ids, and to the secret
+        self.assertEqual(resume.unpack_resume(secret, b, a, packet), None)
+        self.assertEqual(resume.unpack_resume(os.urandom(32), a, b, packet),
+                         None)
+        self.assertEqual(resume.unpack_resume(secret, a, b, packet[1:]), None)
+
+        nonce_b = resume.new_nonce()
+        ack = resume.pack_ack(secret, b, a, nonce_a, nonce_b, 2)
+        self.assertEqual(resume.unpack_ack(secret, b, a, nonce_a, ack),
+                         (nonce_b, 2))
+        # an ack for some other resume
+        self.assertEqual(resume.unpack_ack(secret, b, a, nonce_b, ack), None)
+
+        key, next_secret = resume.derive(secret, nonce_a, nonce_b)
+        self.assertEqual(len(key), 32)
+        self.assertNotEqual(next_secret, secret)
+
+    def test_rekey(self):
+        secret, nonce = os.urandom(32), resume.new_nonce()
+        key, next_secret = resume.derive_rekey(secret, 1, nonce)
+        self.assertEqual(resume.derive_rekey(secret, 1, nonce),
+                         (key, next_secret))
+        # each epoch gets its own key
+        self.assertNotEqual(resume.derive_rekey(next_secret, 2, nonce)[0], key)
+        self.assertNotEqual(resume.derive_rekey(secret, 2, nonce)[0], key)
+
+
+if __name__ == '__main__':
+    unittest.main()
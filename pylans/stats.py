@@ -0,0 +1,110 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# stats.py
+# data path (and peer announce) counters, cheap enough to leave on all
+# the time
+
+
+class PeerStats(object):
+    '''Counters for one session.  Plain slots, so updating one costs about
+    as much as an attribute store.'''
+    __slots__ = ('packets_in', 'bytes_in', 'packets_out', 'bytes_out',
+                 'encrypt_time', 'decrypt_time')
+
+    def __init__(self):
+        self.packets_in = 0
+        self.bytes_in = 0
+        self.packets_out = 0
+        self.bytes_out = 0
+        self.encrypt_time = 0.0
+        self.decrypt_time = 0.0
+
+    def add(self, other):
+        for name in PeerStats.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in PeerStats.__slots__)
+
+
+class NetworkStats(object):
+    '''Counters for one network (router).  Per-session counters are folded
+    into the totals when the session closes.'''
+
+    def __init__(self):
+        # sid -> PeerStats
+        self.peers = {}
+        self.closed = PeerStats()
+        self.relays = 0
+        # drops
+        self.unknown_dest = 0
+        self.unknown_session = 0
+        self.replayed = 0
+        self.auth_failed = 0
+
+    def peer(self, sid):
+        '''Get the counters for sid, only call this for open sessions'''
+        st = self.peers.get(sid)
+        if st is None:
+            st = self.peers[sid] = PeerStats()
+        return st
+
+    def close(self, sid):
+        st = self.peers.pop(sid, None)
+        if st is not None:
+            self.closed.add(st)
+
+    def totals(self):
+        st = PeerStats()
+        st.add(self.closed)
+        for peer in self.peers.values():
+            st.add(peer)
+        return st
+
+
+class AnnounceStats(object):
+    '''Counters for PeerManager's announce scheduler'''
+    __slots__ = ('queued', 'suppressed', 'dropped', 'sent', 'packets')
+
+    def __init__(self):
+        self.queued = 0         # (target, peer) announces queued
+        self.suppressed = 0     # merged into one already queued
+        self.dropped = 0        # target or peer went away before the flush
+        self.sent = 0           # peer records sent
+        self.packets = 0        # packets sent
+
+    def as_dict(self):
+        return dict((name, getattr(self, name))
+                    for name in AnnounceStats.__slots__)
+
+
+class HandshakeStats(object):
+    '''Counters for SessionManager's handshake admission control'''
+    __slots__ = ('admitted', 'queued', 'rejected', 'expired', 'cookies_sent',
+                 'cookies_bad')
+
+    def __init__(self):
+        self.admitted = 0       # handshakes started
+        self.queued = 0         # had to wait for a free slot
+        self.rejected = 0       # queue was full
+        self.expired = 0        # waited too long in the queue
+        self.cookies_sent = 0   # unverified sources challenged under load
+        self.cookies_bad = 0    # greets with a wrong or stale cookie
+
+    def as_dict(self):
+        return dict((name, getattr(self, name))
+                    for name in HandshakeStats.__slots__)
@@ -0,0 +1,303 @@
+import cPickle as pickle
+import os
+import random
+import unittest
+
+from . import peers
+from .packets import PacketType
+from .peers import PeerManager, PeerInfo
+from .router import Router
+
+
+class FakeNetwork(object):
+    def __init__(self):
+        self.id = os.urandom(16)
+        self.name = 'test'
+        self.username = 'me'
+        self.ip = '10.1.1.1'
+        self.wan_port = 8015
+
+
+class FakeSessions(object):
+    def __init__(self):
+        self.session_map = {}
+
+    def update_map(self, sid, address):
+        pass
+
+    def try_greet(self, addrs, pid=None):
+        pass
+
+    def send_handshake(self, sid, address, relays=0):
+        pass
+
+
+class FakeRouter(object):
+    '''just what PeerManager needs'''
+    addr_size = 6
+
+    def __init__(self):
+        self.network = FakeNetwork()
+        self.sm = FakeSessions()
+        self.addr_map = {}
+        self.sid_addrs = {}
+        self.sent = []
+
+    map_addr = Router.map_addr.im_func
+    unmap_addr = Router.unmap_addr.im_func
+    unmap_sid = Router.unmap_sid.im_func
+
+    def register_handler(self, type, callback):
+        pass
+
+    def addr_entry(self, address, sid):
+        return (address, sid, None)
+
+    def send(self, type, data, dst, **kwargs):
+        self.sent.append((type, dst))
+
+
+def new_peer(i, direct=True):
+    pi = PeerInfo()
+    pi.id = os.urandom(16)
+    pi.name = 'peer%d' % i
+    pi.vip = chr(10) + chr(2) + chr(i / 256) + chr(i % 256)
+    pi.addr = '\x02\x00\x00\x00' + chr(i / 256) + chr(i % 256)
+    pi.address = ('192.168.%d.%d' % (i / 256, i % 256), 8015)
+    pi.relays = 0 if direct else 1
+    return pi
+
+
+class Indexes(unittest.TestCase):
+    def setUp(self):
+        self.router = FakeRouter()
+        self.pm = PeerManager(self.router)
+        random.seed(1)
+
+    def check(self):
+        '''indexes must match a linear scan of peer_list'''
+        pm = self.pm
+        peers = pm.peer_list.values()
+        for attr, index, direct in [('vip', pm._by_vip, False),
+                                    ('addr', pm._by_addr, False),
+                                    ('name', pm._by_name, False),
+                                    ('address', pm._by_address, True)]:
+            keys = set(getattr(p, attr) for p in peers
+                       if p.is_direct or not direct)
+            self.assertEqual(set(index.keys()), keys, attr)
+            for key, owners in index.items():
+                for p in owners:
+                    self.assertTrue(pm.peer_list.get(p.id) is p, attr)
+                    self.assertEqual(getattr(p, attr), key, attr)
+            indexed = [p for p in peers if p.is_direct or not direct]
+            self.assertEqual(sum(map(len, index.values())), len(indexed),
+                             attr)
+
+        # sid -> addrs is the reverse of addr_map
+        sid_addrs = {}
+        for addr, entry in self.router.addr_map.items():
+            sid_addrs.setdefault(entry[1], set()).add(addr)
+        self.assertEqual(self.router.sid_addrs, sid_addrs)
+
+    def test_add_remove(self):
+        peers = [new_peer(i) for i in range(300)]
+        for p in peers:
+            self.pm.add_peer(p)
+        self.check()
+
+        for p in peers:
+            self.assertTrue(self.pm.get_by_vip(p.vip) is p)
+            self.assertTrue(self.pm.get_by_addr(p.addr) is p)
+            self.assertTrue(self.pm.get_by_name(p.name) is p)
+            self.assertTrue(self.pm.get_by_address(p.address) is p)
+            self.assertTrue(self.pm[p.address] is p)
+            self.assertTrue(p.vip in self.pm)
+
+        for p in random.sample(peers, 150):
+            self.pm.remove_peer(p)
+            self.assertFalse(p.addr in self.pm)
+            # what SessionManager.close does
+            self.assertEqual(self.router.unmap_sid(p.id), set([p.addr]))
+        self.check()
+
+    def test_update(self):
+        peers = [new_peer(i) for i in range(100)]
+        for p in peers:
+            self.pm.add_peer(p)
+
+        for i in range(500):
+            opi = random.choice(self.pm.peer_list.values())
+            npi = new_peer(random.randint(0, 150),
+                           direct=random.random() < .5)
+            npi.id = opi.id
+            if npi.relays > 0:
+                npi.relays = opi.relays + 1  # not a better route
+                npi.address = random.choice(peers).address
+            self.pm.update_peer(opi, npi)
+            self.check()
+
+    def test_duplicate_keys(self):
+        a, b = new_peer(1), new_peer(2)
+        b.name = a.name
+        self.pm.add_peer(a)
+        self.pm.add_peer(b)
+        self.pm.remove_peer(b)
+        # a is still findable by the shared name
+        self.assertTrue(self.pm.get_by_name(a.name) is a)
+        self.check()
+
+    def test_delta(self):
+        peers_ = [new_peer(i) for i in range(100)]
+        for p in peers_:
+            self.pm.add_peer(p)
+        other, other_epoch = os.urandom(16), os.urandom(4)
+
+        def px():
+            return peers.load_delta(self.pm._delta(other))
+
+        def ack(known):
+            packet = peers.dump_delta(other_epoch, 1, 0, known, [], [])
+            self.pm._load_px(packet, other)
+
+        # first exchange is the whole table
+        epoch, gen, since, known, peer_list, removed = px()
+        self.assertEqual((since, len(peer_list)), (0, 100))
+
+        # then only what changed since they acknowledged gen
+        ack((epoch, gen))
+        npi = new_peer(200)
+        npi.id = peers_[0].id
+        self.pm.update_peer(peers_[0], npi)
+        self.pm.remove_peer(peers_[1])
+        epoch, gen2, since, known, peer_list, removed = px()
+        self.assertEqual(since, gen)
+        self.assertEqual(peer_list.keys(), [peers_[0].id])
+        self.assertEqual(removed, [peers_[1].id])
+
+        # they don't know this epoch (we restarted), full table again
+        ack((os.urandom(4), gen2))
+        self.assertEqual(px()[2], 0)
+
+    def test_reconnect(self):
+        for i in range(10):
+            self.pm.add_peer(new_peer(i))
+        other, other_epoch = os.urandom(16), os.urandom(4)
+        epoch, gen = peers.load_delta(self.pm._delta(other))[:2]
+        self.pm._load_px(peers.dump_delta(other_epoch, 5, 0, (epoch, gen),
+                                          [], []), other)
+        self.pm.peer_map[other] = {}
+        self.assertEqual(peers.load_delta(self.pm._delta(other))[2], gen)
+
+        # the session closes, the first PX after it opens again is full
+        self.pm.do_session_closed(self.pm.sm, other)
+        epoch, gen, since, known, peer_list, removed = \
+            peers.load_delta(self.pm._delta(other))
+        self.assertEqual((since, len(peer_list)), (0, 10))
+        self.assertEqual(known, ('\x00'*4, 0))
+        self.assertTrue(other not in self.pm.peer_map)
+
+    def test_px(self):
+        # two PeerManagers, each router hands packets to the other's
+        a, b = FakeRouter(), FakeRouter()
+        for router, other in ((a, b), (b, a)):
+            router.handlers = {}
+            router.register_handler = router.handlers.__setitem__
+            router.send = (lambda type, data, dst, router=router, other=other,
+                                  **kw: router.sent.append((type, data))
+                           or other.handlers[type](type, data, ('a', 1),
+                                                   router.network.id))
+        pa, pb = PeerManager(a), PeerManager(b)
+        peer_a, peer_b = new_peer(1), new_peer(2)
+        peer_a.id, peer_b.id = a.network.id, b.network.id
+        pa.add_peer(peer_b)
+        pb.add_peer(peer_a)
+        a.sm.session_map[peer_b.id] = b.sm.session_map[peer_a.id] = ('a', 1)
+        peers_ = [new_peer(i) for i in range(10, 30)]
+        for p in peers_:
+            pa.add_peer(p)
+
+        def exchange():
+            del a.sent[:], b.sent[:]
+            pa.refresh_px()
+            (px_type, px), = a.sent
+            (ack_type, ack), = b.sent
+            self.assertEqual((px_type, ack_type),
+                             (PacketType.PEER_XCHANGE,
+                              PacketType.PEER_XCHANGE_ACK))
+            return peers.load_delta(px), peers.load_delta(ack)
+
+        # first one is the whole table, both ways
+        px, ack = exchange()
+        self.assertEqual((px[2], len(px[4])), (0, 21))
+        self.assertEqual((ack[2], len(ack[4])), (0, 1))
+
+        # then only what changed since
+        npi = new_peer(100)
+        npi.id = peers_[0].id
+        pa.update_peer(peers_[0], npi)
+        px, ack = exchange()
+        self.assertEqual((px[2], px[4].keys()), (pa.generation - 1,
+                                                 [peers_[0].id]))
+        self.assertEqual((ack[2], len(ack[4])), (pb.generation, 0))
+
+    def test_announce_coalescing(self):
+        peers_ = [new_peer(i) for i in range(10)]
+        for p in peers_:
+            self.pm.add_peer(p)
+        self.pm._flush_announces()
+        del self.router.sent[:]
+
+        # a burst of changes to every peer, one packet per target
+        st = self.pm.announce_stats
+        suppressed = st.suppressed
+        for n in range(5):
+            for p in peers_:
+                npi = new_peer(100 + n)
+                npi.id = p.id
+                self.pm.update_peer(p, npi)
+        self.assertEqual(st.suppressed - suppressed, 4 * 10 * 9)
+        self.pm._flush_announces()
+        self.assertEqual(sorted(dst for type, dst in self.router.sent),
+                         sorted(p.id for p in peers_))
+        self.assertEqual(set(type for type, dst in self.router.sent),
+                         set([PacketType.PEER_ANNOUNCE_BATCH]))
+
+
+class WireFormat(unittest.TestCase):
+    def same(self, a, b):
+        for attr in ('id', 'name', 'alias', 'vip', 'addr', 'port', 'relays',
+                     'is_direct', 'direct_addresses'):
+            self.assertEqual(getattr(a, attr), getattr(b, attr), attr)
+
+    def test_peer(self):
+        p = new_peer(7, direct=False)
+        p.alias = 'seven'
+        p.port = 8015
+        p.direct_addresses = [p.address, ('10.0.0.7', 9000)]
+        self.same(peers.load_peer(peers.dump_peer(p)), p)
+
+    def test_peer_list(self):
+        peer_list = dict((p.id, p) for p in (new_peer(i) for i in range(50)))
+        loaded = peers.load_peer_list(peers.dump_peer_list(peer_list.values()))
+        self.assertEqual(set(loaded), set(peer_list))
+        for pid in peer_list:
+            self.same(loaded[pid], peer_list[pid])
+
+    def test_truncated(self):
+        data = peers.dump_peer(new_peer(1))
+        for i in range(len(data)):
+            self.assertRaises(ValueError, peers.load_peer, data[:i])
+
+    def test_legacy(self):
+        p = new_peer(3)
+        data = pickle.dumps({p.id: p}, -1)
+        self.assertTrue(peers.is_legacy(data))
+        self.same(peers.load_legacy(data)[p.id], p)
+
+        # nothing but PeerInfo gets built from a pickle
+        evil = pickle.dumps(random.Random(), -1)
+        self.assertRaises(pickle.UnpicklingError, peers.load_legacy, evil)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+import copy
+import heapq
+import math
+import random
+import time
+import unittest
+
+from .peers import PeerManager
+from .routing import RoutingTable
+from .test_peers import FakeRouter, FakeSessions, new_peer
+
+
+class Sessions(FakeSessions):
+    def send_handshake(self, sid, address, relays=0):
+        # goes through at once, the next PX adds the peer
+        self.session_map[sid] = address
+
+
+class Node(FakeRouter):
+    '''A router whose packets go straight to the other nodes' handlers,
+    along the path its PeerManager's routes say (and nowhere if they
+    don't lead there)'''
+
+    def __init__(self, mesh, info):
+        FakeRouter.__init__(self)
+        self.sm = Sessions()
+        self.mesh = mesh
+        self.info = info
+        self.network.id = info.id
+        self.handlers = {}
+        self.pm = PeerManager(self)
+        if mesh.margin is not None:
+            self.pm.routes.SWITCH_MARGIN = mesh.margin
+
+    def register_handler(self, type, callback):
+        self.handlers[type] = callback
+
+    def send(self, type, data, dst, **kwargs):
+        dst = self.mesh.nodes[dst]
+        if (self.mesh.path_cost(self.info.id, dst.info.id) is not None and
+                self.info.id in dst.pm.peer_list):
+            dst.handlers[type](type, data, self.info.address, self.info.id)
+
+
+class Mesh(object):
+    '''In process mesh of PeerManagers, exchanging peer lists (PX) and
+    pinging each other in synchronous rounds.  Sessions are taken as open
+    between every pair, the ones that aren't linked go through relays.'''
+
+    def __init__(self, n, degree, seed=1, margin=None):
+        self.rnd = rnd = random.Random(seed)
+        self.margin = margin
+        self.nodes = {}
+        self.ids = []
+        self.links = {}
+        for i in range(n):
+            self.add_node(i)
+        pos = dict((x, (rnd.random(), rnd.random())) for x in self.ids)
+
+        def dist(a, b):
+            return math.hypot(pos[a][0] - pos[b][0], pos[a][1] - pos[b][1])
+
+        # link everyone to their nearest neighbors, and to one random node
+        # so the mesh is connected and not too deep
+        for a in self.ids:
+            near = sorted(self.ids, key=lambda b: dist(a, b))[1:degree + 1]
+            for b in near + [rnd.choice(self.ids)]:
+                if b != a:
+                    # 1 unit across the map is 100ms
+                    self.link(a, b, 0.1 * dist(a, b) + 0.001)
+
+    def add_node(self, i):
+        info = new_peer(i)
+        info.id = '%016x' % self.rnd.getrandbits(64)
+        node = Node(self, info)
+        for x in self.ids:
+            node.sm.session_map[x] = None
+            self.nodes[x].sm.session_map[info.id] = None
+        self.nodes[info.id] = node
+        self.ids.append(info.id)
+        return info.id
+
+    def tables(self):
+        return dict((x, set((r.dst, r.hop, r.via, r.cost, r.relays)
+                            for r in self.nodes[x].pm.routes.routes.values()))
+                    for x in self.ids)
+
+    def link(self, a, b, cost):
+        '''Link a and b (or change the link's cost), as pings on a direct
+        session would see it'''
+        self.links.setdefault(a, {})[b] = cost
+        self.links.setdefault(b, {})[a] = cost
+        for x, y in ((a, b), (b, a)):
+            pm = self.nodes[x].pm
+            # what registering on the direct session brings
+            npi = copy.deepcopy(self.nodes[y].info)
+            if y in pm.peer_list:
+                pm.update_peer(pm.peer_list[y], npi)
+            else:
+                pm.add_peer(npi)
+            pm.set_ping_time(pm.peer_list[y], cost)
+
+    def unlink(self, a, b):
+        '''The link between a and b is gone, so are the sessions on it'''
+        del self.links[a][b]
+        del self.links[b][a]
+        for x, y in ((a, b), (b, a)):
+            node = self.nodes[x]
+            del node.sm.session_map[y]
+            node.unmap_sid(y)
+            node.pm.do_session_closed(node.pm.sm, y)
+
+    def round(self):
+        '''Everyone pings and PXes with everyone they know, returns the
+        number of routes that changed'''
+        before = self.tables()
+        for x in self.ids:
+            pm = self.nodes[x].pm
+            for peer in pm.peer_list.values():
+                dt = self.path_cost(x, peer.id)
+                if dt is not None:
+                    pm.set_ping_time(peer, dt)
+        for x in self.ids:
+            self.nodes[x].pm.refresh_px()
+        after = self.tables()
+        return sum(len(before[x] ^ after[x]) for x in self.ids)
+
+    def converge(self, max_rounds=100):
+        '''Returns the rounds it took'''
+        for i in xrange(max_rounds):
+            if self.round() == 0:
+                return i + 1
+        raise AssertionError('no convergence in {0} rounds'.format(max_rounds))
+
+    def shortest(self, src):
+        '''Dijkstra over the link costs'''
+        dist = {src: 0.0}
+        heap = [(0.0, src)]
+        while heap:
+            d, a = heapq.heappop(heap)
+            if d > dist[a]:
+                continue
+            for b, cost in self.links.get(a, {}).items():
+                if d + cost < dist.get(b, float('inf')):
+                    dist[b] = d + cost
+                    heapq.heappush(heap, (d + cost, b))
+        return dist
+
+    def path_cost(self, src, dst):
+        '''Follow next hops from src to dst, returns the cost of the path or
+        None if it doesn't get there'''
+        cost = 0.0
+        x = src
+        for i in xrange(RoutingTable.MAX_RELAYS + 1):
+            route = self.nodes[x].pm.routes.best(dst)
+            if route is None or route.hop not in self.links.get(x, ()):
+                return None
+            cost += self.links[x][route.hop]
+            x = route.hop
+            if x == dst:
+                return cost
+        return None
+
+    def walk(self, src, dst):
+        cost = self.path_cost(src, dst)
+        if cost is None:
+            raise AssertionError('no loop free path {0} -> {1}'
+                                 .format(src, dst))
+        return cost
+
+
+class Simulation(unittest.TestCase):
+    def check_paths(self, mesh):
+        '''Every pair has a loop free path, within what the switch margin
+        and relay cost allow of the shortest one.  Returns the fraction of
+        pairs on a shortest path.'''
+        slack = RoutingTable.SWITCH_MARGIN + RoutingTable.RELAY_COST
+        optimal = 0
+        total = 0
+        for src in mesh.ids:
+            dist = mesh.shortest(src)
+            for dst in mesh.ids:
+                if dst == src or dst not in dist:
+                    continue
+                cost = mesh.walk(src, dst)
+                total += 1
+                self.assertTrue(cost <= dist[dst] +
+                                slack * (RoutingTable.MAX_RELAYS + 1),
+                                (src, dst, cost, dist[dst]))
+                if cost <= dist[dst] + 1e-9:
+                    optimal += 1
+        return float(optimal) / total
+
+    def test_50_nodes(self):
+        mesh = Mesh(50, 4)
+        t = time.time()
+        rounds = mesh.converge()
+        elapsed = time.time() - t
+
+        self.assertTrue(rounds <= RoutingTable.MAX_RELAYS + 2, rounds)
+        # the whole PeerManager, packets encoded and decoded
+        self.assertTrue(elapsed < 20, elapsed)
+        self.check_paths(mesh)
+
+        # break the busiest links, everything still gets a loop free path
+        busiest = sorted(((len(mesh.links[a]), a) for a in mesh.ids),
+                         reverse=True)[:3]
+        for n, a in busiest:
+            b = sorted(mesh.links[a])[0]
+            mesh.unlink(a, b)
+        mesh.converge()
+        self.check_paths(mesh)
+
+    def test_50_nodes_shortest(self):
+        # without the switch margin, nearly everything is on a shortest path
+        # (the rest trade a little latency for fewer relays)
+        mesh = Mesh(50, 4, seed=2, margin=0)
+        mesh.converge()
+        self.assertTrue(self.check_paths(mesh) > 0.9)
+
+    def test_lowest_latency(self):
+        mesh = Mesh(0, 0)
+        a, b, c = [mesh.add_node(i) for i in range(3)]
+        mesh.link(a, b, 0.100)
+        mesh.link(a, c, 0.010)
+        mesh.link(c, b, 0.010)
+        mesh.converge()
+        # a slow direct link loses to a fast relay
+        peer = mesh.nodes[a].pm.peer_list[b]
+        self.assertEqual((peer.relay_id, peer.relays), (c, 1))
+        self.assertAlmostEqual(mesh.nodes[a].pm.routes.best(b).cost, 0.020)
+
+        # and wins again when the relay gets slow (only the path in use is
+        # pinged, so a faster direct link alone would go unnoticed)
+        mesh.link(c, b, 0.200)
+        mesh.converge()
+        peer = mesh.nodes[a].pm.peer_list[b]
+        self.assertEqual((peer.relay_id, peer.relays), (None, 0))
+
+    def test_hysteresis(self):
+        t = RoutingTable()
+        t.set_link('b', 0.050, 'b')
+        t.set_link('c', 0.010, 'c')
+        t.advertise('c', 'b', 0.045, 0)
+        self.assertEqual(t.best('b').hop, 'b')
+        # 1ms better isn't worth moving for
+        t.advertise('c', 'b', 0.038, 0)
+        self.assertEqual(t.best('b').hop, 'b')
+        t.advertise('c', 'b', 0.020, 0)
+        self.assertEqual(t.best('b').hop, 'c')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,9 @@ from twisted.internet import reactor, utils, defer
 from twisted.internet.interfaces import IReadDescriptor
 from twisted.internet.threads import deferToThread
 from zope.interface import implements
+import errno
 import logging
+import os
 from . import util
 
 logger = logging.getLogger(__name__)
@@ -19,6 +21,7 @@ import platform
 if platform.system() == 'Linux':
     logger.info('Linux detected, using TapTunLinux')
     from .linux import TunTapLinux
+    from fcntl import fcntl, F_GETFL, F_SETFL
 
 
     class TunTapWindows(TunTapUnsupported):
@@ -44,16 +47,30 @@ class TwistedTTL(TunTapLinux):
     # so it can be used in twisted's main loop
     implements(IReadDescriptor)
 
-    def __init__(self, callback, **kwargs):
+    def __init__(self, callback, burst_callback=None, burst_size=1, **kwargs):
         '''
             initialize tun/tap device.
 
             callback(data) - function that gets called with data when something is
             read on the tun/tap wire.
+
+            burst_callback(frames) - optional function that gets called with a
+            list of frames when burst reads are enabled.
+
+            burst_size - max number of frames to read per reactor wakeup.  If
+            greater than 1, the device is switched to non-blocking mode and
+            drained until empty or burst_size frames have been read.
         '''
         self.callback = callback
+        self.burst_callback = burst_callback
+        self.burst_size = max(1, burst_size)
         super(TwistedTTL, self).__init__(**kwargs)
 
+        if self.burst_size > 1:
+            fcntl(self._f, F_SETFL, fcntl(self._f, F_GETFL) | os.O_NONBLOCK)
+            logger.info('tun/tap burst reads enabled ({0} frames)',
+                        self.burst_size)
+
     def start(self):
         '''Start monitoring tun/tap for input'''
         # add to twisted mainloop
@@ -126,8 +143,28 @@ class TwistedTTL(TunTapLinux):
         '''
             New data is coming in on the tun/tap 'wire'.  Called by twisted.
         '''
-        data = self.read()
-        self.callback(data)
+        if self.burst_size == 1:
+            self.callback(self.read())
+            return
+
+        # drain the device (non-blocking) so one wakeup handles a whole burst
+        frames = []
+        read = self.read
+        append = frames.append
+        try:
+            for i in xrange(self.burst_size):
+                append(read())
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        if len(frames) > 0:
+            if self.burst_callback is not None:
+                self.burst_callback(frames)
+            else:
+                callback = self.callback
+                for data in frames:
+                    callback(data)
 
     def doWrite(self, data):
         '''
@@ -165,7 +202,9 @@ class TwistedTTW(TunTapWindows):
         and returns data when it's available.
     '''
 
-    def __init__(self, callback, **kwargs):
+    def __init__(self, callback, burst_callback=None, burst_size=1, **kwargs):
+        # the polling thread hands frames over one at a time, so burst reads
+        # are not used here
         self.callback = callback
         self._running = False
         super(TwistedTTW, self).__init__(**kwargs)